@@ -0,0 +1,48 @@
+"""QueryLogicTest.build のメモリ使用量のベンチマーク
+
+tracemalloc で計測したピークメモリを、生成されたクエリの大きさとの比で表示する::
+
+    python benchmarks/bench_build_memory.py
+"""
+import sys
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bqqtest.table import Query, QueryLogicTest  # noqa: E402
+from bench_serializer import synthetic_table  # noqa: E402
+
+
+def synthetic_query_logic_test(n_rows, n_tables):
+    types = ["STRING", "INT64", "FLOAT64", "BOOL"]
+    tables = []
+    for i in range(n_tables):
+        table = synthetic_table(n_rows, types, seed=i)
+        table._name = f"INPUT{i}"
+        tables.append(table)
+    expected = synthetic_table(n_rows, types, seed=n_tables)
+    expected._name = "EXPECTED"
+    query = Query("ACTUAL", "SELECT * FROM t0", [], {"t0": "INPUT0"})
+    return QueryLogicTest(None, expected, tables, query)
+
+
+def measure(fn):
+    tracemalloc.start()
+    result = fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return len(result), peak
+
+
+def main():
+    print("rows,tables,query_bytes,peak_bytes,peak_ratio")
+    for n_rows in [10_000, 100_000]:
+        for n_tables in [1, 4]:
+            qlt = synthetic_query_logic_test(n_rows, n_tables)
+            size, peak = measure(qlt.build)
+            print(f"{n_rows},{n_tables},{size},{peak},{peak / size:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""CompiledQueryTest のベンチマーク
+
+同じクエリに対してテストデータだけを変えた N 件のテストを作るのにかかる時間を、
+毎回 QueryTest を作る場合と比べる::
+
+    python benchmarks/bench_compiled.py
+"""
+import contextlib
+import io
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bqqtest.fake import FakeClient  # noqa: E402
+from bqqtest.table import CompiledQueryTest, QueryTest  # noqa: E402
+
+
+def synthetic_query(n_ctes):
+    # 実際の集計クエリのように、CTEごとに括弧の入れ子を含む長い式を入れる
+    expression = " + ".join(f"IF((value > {j}), (value * {j}), 0)" for j in range(20))
+    ctes = ["c0 AS (SELECT * FROM src)"]
+    ctes += [
+        f"c{i} AS (SELECT name, SUM({expression}) AS value FROM c{i - 1} GROUP BY name)"
+        for i in range(1, n_ctes)
+    ]
+    return {
+        "query": "WITH " + ",\n".join(ctes) + f"\nSELECT * FROM c{n_ctes - 1}",
+        "params": [],
+    }
+
+
+def synthetic_case(i, n_columns):
+    schema = [{"name": "name", "type": "STRING"}, {"name": "value", "type": "INT64"}]
+    schema += [{"name": f"c{j}", "type": "ARRAY<STRING>"} for j in range(n_columns)]
+    datum = [["a", i] + [[]] * n_columns]
+    tables = {"src": {"schema": schema, "datum": datum}}
+    expected = {"schema": schema[:2], "datum": [["a", i]]}
+    return expected, tables
+
+
+def main():
+    client = FakeClient()
+    print("cases,ctes,columns,query_test_sec,compiled_sec,speedup")
+    for n_ctes, n_columns in [(5, 10), (40, 100)]:
+        query = synthetic_query(n_ctes)
+        for n_cases in [10, 200]:
+            cases = [synthetic_case(i, n_columns) for i in range(n_cases)]
+
+            def without_compile():
+                for expected, tables in cases:
+                    QueryTest(client, expected, tables, query)
+
+            def with_compile():
+                compiled = CompiledQueryTest(client, query)
+                for expected, tables in cases:
+                    compiled.case(expected, tables)
+
+            # util.get_query_from_with_clause のデバッグ出力を捨てる
+            with contextlib.redirect_stdout(io.StringIO()):
+                plain = min(timeit.repeat(without_compile, number=1, repeat=3))
+                compiled = min(timeit.repeat(with_compile, number=1, repeat=3))
+            print(
+                f"{n_cases},{n_ctes},{n_columns},{plain:.4f},{compiled:.4f},"
+                f"{plain / compiled:.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
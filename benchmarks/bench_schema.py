@@ -0,0 +1,65 @@
+"""Schema を作る時間のベンチマーク
+
+500列のスキーマを何度も作るときの時間を、型の構文木をキャッシュする現在の実装と、
+列ごとに正規表現で検証していた以前の実装で比べる::
+
+    python benchmarks/bench_schema.py
+"""
+import re
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from bqqtest.table import ColumnMeta, Schema  # noqa: E402
+
+TYPES = [
+    "INT64",
+    "STRING",
+    "ARRAY<STRING>",
+    "STRUCT<a INT64, b ARRAY<STRING>>",
+    "ARRAY<STRUCT<x FLOAT64, y STRUCT<z DATE>>>",
+]
+
+
+def legacy_is_usable_type(t):
+    """以前の ``ColumnMeta.is_usable_type``"""
+    if t in ColumnMeta.usable_primitive_types:
+        return True
+
+    if re.match(r"^(ARRAY|STRUCT)<.*>$", t):
+        new_t = re.sub(r"^(ARRAY|STRUCT)<", "", t)
+        new_t = re.sub(r">$", "", new_t)
+        return legacy_is_usable_type(new_t)
+
+    return False
+
+
+def legacy_schema(columns):
+    # 以前の実装はフィールドを並べたSTRUCTを受け付けないので、結果は使わずに時間だけ測る
+    return [legacy_is_usable_type(column["type"]) for column in columns]
+
+
+def measure(make_schema, columns, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        make_schema(columns)
+    return time.perf_counter() - started
+
+
+def main():
+    print("implementation,columns,schemas,seconds")
+    for n_columns in [50, 500]:
+        columns = [
+            {"name": f"c{i}", "type": TYPES[i % len(TYPES)]} for i in range(n_columns)
+        ]
+        repeat = 1000
+        for name, make_schema in [("legacy", legacy_schema), ("current", Schema)]:
+            elapsed = measure(make_schema, columns, repeat)
+            print(f"{name},{n_columns},{repeat},{elapsed:.3f}")
+
+
+if __name__ == "__main__":
+    main()
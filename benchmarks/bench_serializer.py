@@ -0,0 +1,166 @@
+"""Table のリテラル生成のベンチマーク
+
+列単位の変換と、以前の行ごとのループとを比較する。
+入れ子の型を含む横に広いテーブルでは、型ごとに組み立てておいた変換関数と、
+値ごとに型で分岐する変換とを比較する::
+
+    python benchmarks/bench_serializer.py
+"""
+import datetime
+import random
+import re
+import string
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bqqtest.encoders import escape, value_encoder  # noqa: E402
+from bqqtest.table import Table  # noqa: E402
+from bqqtest.types import ArrayType, PrimitiveType, parse_type  # noqa: E402
+
+
+def legacy_dataframe_to_string_list(table):
+    """行ごとに変換していた以前の実装"""
+    df_types = dict(zip(table._schema.names(), table._schema.types()))
+    rows = []
+    for columns in table._rows.itertuples():
+        cols = columns._asdict()
+        new_columns = []
+        for key in cols.keys():
+            if key == "Index":
+                continue
+            if cols[key] is None:
+                new_columns += ["null"]
+            elif repr(cols[key]) == "nan":
+                new_columns += ["null"]
+            elif df_types[key] == "int64":
+                new_columns += [str(int(cols[key]))]
+            elif type(cols[key]) is str:
+                escaped_double_quotes = re.sub('"', r"\"", str(cols[key]))
+                new_columns += [f'"{escaped_double_quotes}"']
+            else:
+                new_columns += [str(cols[key])]
+        rows += [new_columns]
+
+    return rows
+
+
+def legacy_rows_sql(table):
+    return Table.sql_string(legacy_dataframe_to_string_list(table))
+
+
+def random_value(typ, rng):
+    if rng.random() < 0.1:
+        return None
+    if typ == "STRING":
+        return "".join(rng.choices(string.ascii_letters + '"', k=rng.randint(0, 12)))
+    if typ == "INT64":
+        return rng.randint(-(10 ** 12), 10 ** 12)
+    if typ == "FLOAT64":
+        return rng.uniform(-1e6, 1e6)
+    return rng.random() < 0.5
+
+
+def synthetic_table(n_rows, types, seed=0):
+    rng = random.Random(seed)
+    schema = [{"name": f"c{i}", "type": t} for i, t in enumerate(types)]
+    records = [[random_value(t, rng) for t in types] for _ in range(n_rows)]
+    return Table(records, schema, "BENCH")
+
+
+NESTED_TYPES = [
+    "DATE",
+    "TIMESTAMP",
+    "ARRAY<INT64>",
+    "STRUCT<a INT64, b ARRAY<STRING>, c STRUCT<d DATE>>",
+    "ARRAY<STRUCT<x NUMERIC, y STRING>>",
+]
+
+
+def nested_value(t, i):
+    return {
+        "DATE": datetime.date(2020, 1, 1 + i % 28),
+        "TIMESTAMP": f"2020-01-01 00:00:{i % 60:02d}",
+        "ARRAY<INT64>": [i, i + 1, None],
+        "STRUCT<a INT64, b ARRAY<STRING>, c STRUCT<d DATE>>": {
+            "a": i,
+            "b": ["x", 'y"'],
+            "c": {"d": "2020-01-02"},
+        },
+        "ARRAY<STRUCT<x NUMERIC, y STRING>>": [{"x": "1.5", "y": "z"}] * 2,
+    }[t]
+
+
+def dispatch_literal(value, parsed):
+    """値ごとに型で分岐してリテラルにする変換"""
+    if value is None:
+        return "null"
+    if isinstance(parsed, ArrayType):
+        return "[" + ",".join(dispatch_literal(v, parsed.element) for v in value) + "]"
+    if isinstance(parsed, PrimitiveType):
+        return value_encoder(parsed)(value)
+    if isinstance(value, dict):
+        value = [value.get(name) for name, _ in parsed.fields]
+    return (
+        "STRUCT("
+        + ",".join(dispatch_literal(v, t) for v, (_, t) in zip(value, parsed.fields))
+        + ")"
+    )
+
+
+def dispatch_rows_sql(table):
+    parsed_types = table.schema().parsed_types()
+    return Table.sql_string(
+        [
+            [dispatch_literal(v, parsed) for v, parsed in zip(row, parsed_types)]
+            for row in table.dataframe().itertuples(index=False)
+        ]
+    )
+
+
+def nested_main():
+    print("columns,rows,dispatch_sec,encoders_sec,speedup")
+    n_columns = 50
+    types = [NESTED_TYPES[i % len(NESTED_TYPES)] for i in range(n_columns)]
+    schema = [{"name": f"c{i}", "type": t} for i, t in enumerate(types)]
+    for n_rows in [1_000, 10_000]:
+        records = [[nested_value(t, i) for t in types] for i in range(n_rows)]
+        table = Table(records, schema, "BENCH", backend="columns")
+        assert dispatch_rows_sql(table) == table.rows_sql()
+        dispatch = min(
+            timeit.repeat(lambda: dispatch_rows_sql(table), number=1, repeat=3)
+        )
+        encoders = min(timeit.repeat(table.rows_sql, number=1, repeat=3))
+        print(
+            f"nested{n_columns},{n_rows},{dispatch:.4f},{encoders:.4f},"
+            f"{dispatch / encoders:.1f}"
+        )
+
+
+def main():
+    column_sets = {
+        "string": ["STRING"] * 4,
+        "int64": ["INT64"] * 4,
+        "mixed": ["STRING", "INT64", "FLOAT64", "BOOL"],
+    }
+    print("columns,rows,legacy_sec,vectorized_sec,speedup")
+    for label, types in column_sets.items():
+        for n_rows in [1_000, 10_000, 100_000]:
+            table = synthetic_table(n_rows, types)
+            assert legacy_rows_sql(table) == table.rows_sql()
+            legacy = min(
+                timeit.repeat(lambda: legacy_rows_sql(table), number=1, repeat=3)
+            )
+            vectorized = min(timeit.repeat(table.rows_sql, number=1, repeat=3))
+            print(
+                f"{label},{n_rows},{legacy:.4f},{vectorized:.4f},"
+                f"{legacy / vectorized:.1f}"
+            )
+    print()
+    nested_main()
+
+
+if __name__ == "__main__":
+    main()
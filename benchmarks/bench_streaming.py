@@ -0,0 +1,62 @@
+"""ファイルのテストデータからSQLを作るときのメモリ使用量のベンチマーク
+
+gzipした改行区切りのJSONを ``Table`` で読み込んでからSQLを作る場合と、
+``StreamingTable`` で少しずつ読みながらSQLを作る場合の時間とピークメモリ
+(tracemalloc)を比べる。SQLは連結せずに長さだけを数える::
+
+    python benchmarks/bench_streaming.py
+"""
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from bqqtest import StreamingTable, Table  # noqa: E402
+from bqqtest.loaders import write_records  # noqa: E402
+
+SCHEMA = [
+    {"name": "name", "type": "STRING", "mode": "NULLABLE"},
+    {"name": "value", "type": "INT64", "mode": "NULLABLE"},
+    {"name": "ratio", "type": "FLOAT64", "mode": "NULLABLE"},
+]
+
+
+def measure(make_table):
+    tracemalloc.start()
+    started = time.perf_counter()
+    length = sum(len(fragment) for fragment in make_table().iter_sql())
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak, length
+
+
+def main():
+    print("table,rows,file_bytes,seconds,peak_bytes,sql_length")
+    with tempfile.TemporaryDirectory() as directory:
+        for n_rows in [10_000, 100_000]:
+            path = str(Path(directory) / f"fixture_{n_rows}.ndjson.gz")
+            write_records(
+                path,
+                (
+                    {"name": f"name{i}", "value": i, "ratio": i / 7}
+                    for i in range(n_rows)
+                ),
+            )
+            size = Path(path).stat().st_size
+            cases = {
+                "Table(pandas)": lambda: Table(path, SCHEMA, "T"),
+                "Table(columns)": lambda: Table(path, SCHEMA, "T", backend="columns"),
+                "StreamingTable": lambda: StreamingTable(path, SCHEMA, "T"),
+            }
+            for name, make_table in cases.items():
+                elapsed, peak, length = measure(make_table)
+                print(f"{name},{n_rows},{size},{elapsed:.3f},{peak},{length}")
+
+
+if __name__ == "__main__":
+    main()
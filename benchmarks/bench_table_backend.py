@@ -0,0 +1,80 @@
+"""Table のバックエンドごとの起動時間とメモリ使用量のベンチマーク
+
+``from bqqtest import Table`` にかかる時間と、3行のテストデータを大量に作ったときの
+時間とメモリ(tracemalloc)を、pandasとcolumnsのバックエンドで比べる::
+
+    python benchmarks/bench_table_backend.py
+"""
+import subprocess
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from bqqtest import Table  # noqa: E402
+
+SCHEMA = [
+    {"name": "name", "type": "STRING", "mode": "NULLABLE"},
+    {"name": "value", "type": "INT64", "mode": "NULLABLE"},
+    {"name": "ratio", "type": "FLOAT64", "mode": "NULLABLE"},
+]
+
+
+def startup(statement, repeat=5):
+    """新しいプロセスで ``statement`` を実行するのにかかる秒数の最小値"""
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, "-c", statement], cwd=ROOT, check=True)
+        times.append(time.perf_counter() - started)
+    return min(times)
+
+
+def fixtures(backend, n_tables):
+    return [
+        Table(
+            [["abc", i, 0.5], ["def", i + 1, None], [None, i + 2, 1.5]],
+            SCHEMA,
+            f"T{i}",
+            backend=backend,
+        )
+        for i in range(n_tables)
+    ]
+
+
+def measure(backend, n_tables):
+    tracemalloc.start()
+    started = time.perf_counter()
+    tables = fixtures(backend, n_tables)
+    sql = [table.to_sql() for table in tables]
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(sql) == n_tables
+    return elapsed, peak
+
+
+def main():
+    baseline = startup("pass")
+    lazy = startup("from bqqtest import Table")
+    eager = startup("import pandas, google.cloud.bigquery; from bqqtest import Table")
+    print("case,seconds")
+    print(f"python_startup,{baseline:.3f}")
+    print(f"import_bqqtest,{lazy:.3f}")
+    print(f"import_bqqtest_with_pandas_and_bigquery,{eager:.3f}")
+    print()
+
+    print("backend,tables,build_and_to_sql_sec,peak_bytes,bytes_per_table")
+    # pandasの読み込みを計測に含めないように、先に一度だけ作っておく
+    fixtures("pandas", 1)
+    for n_tables in [1_000, 10_000]:
+        for backend in ["pandas", "columns"]:
+            elapsed, peak = measure(backend, n_tables)
+            print(f"{backend},{n_tables},{elapsed:.3f},{peak},{peak // n_tables}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""WITH句の解析のベンチマーク
+
+字句解析による split_with_clause と、以前の再帰正規表現による実装とを、
+大きな合成クエリで比べる::
+
+    python benchmarks/bench_with_clause.py
+"""
+import sys
+import timeit
+from pathlib import Path
+
+import regex
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bqqtest.util import split_with_clause  # noqa: E402
+
+_legacy_cte = regex.compile(
+    r"(?<name>\w+)\s+AS\s+(?<query>\((?:[^\(\)]+|(?&query))*\))",
+    flags=regex.MULTILINE | regex.IGNORECASE,
+)
+
+
+def legacy_split_with_clause(sql):
+    """以前の実装。CTEの抽出とWITH句の除去で2回の再帰正規表現を使う"""
+    stripped = regex.sub(r"--.*$", "", sql, flags=regex.MULTILINE)
+    stripped = regex.sub(r"#.*$", "", stripped, flags=regex.MULTILINE)
+    stripped = regex.sub(r"/\*.*\*/", "", stripped, flags=regex.DOTALL)
+    ctes = [
+        (name, query[1:-1].strip()) for name, query in _legacy_cte.findall(stripped)
+    ]
+    query = regex.sub(
+        r"WITH\s+(?<name>\w+)\s+AS\s+(?<query>\((?:[^\(\)]+|(?&query))*\))", "", sql
+    )
+    return ctes, query
+
+
+def synthetic_query(n_ctes, lines_per_cte):
+    ctes = []
+    for i in range(n_ctes):
+        source = "src" if i == 0 else f"c{i - 1}"
+        columns = ",\n".join(
+            f"    IF((value > {j}), (value * {j}), 0) AS v{j} -- column {j}"
+            for j in range(lines_per_cte)
+        )
+        ctes.append(
+            f"c{i} AS (\n  /* step {i} */\n  SELECT\n{columns}\n  FROM {source}\n)"
+        )
+    return "WITH " + ",\n".join(ctes) + f"\nSELECT * FROM c{n_ctes - 1}"
+
+
+def main():
+    """``paren_in_string`` は最初のCTEに ``'('`` という文字列リテラルを含むクエリ。
+    以前の実装は括弧の対応を取り違えて、CTEを見失ったうえに遅くなる"""
+    print("case,ctes,lines,legacy_sec,lexer_sec,speedup,legacy_ctes,lexer_ctes")
+    for case in ["plain", "paren_in_string"]:
+        for n_ctes, lines_per_cte in [(10, 20), (40, 50), (100, 100)]:
+            sql = synthetic_query(n_ctes, lines_per_cte)
+            if case == "paren_in_string":
+                sql = sql.replace("SELECT\n", "SELECT '(' AS open_paren,\n", 1)
+            legacy = min(
+                timeit.repeat(lambda: legacy_split_with_clause(sql), number=1, repeat=3)
+            )
+            lexer = min(
+                timeit.repeat(lambda: split_with_clause(sql), number=1, repeat=3)
+            )
+            print(
+                f"{case},{n_ctes},{sql.count(chr(10)) + 1},{legacy:.4f},{lexer:.4f},"
+                f"{legacy / lexer:.1f},{len(legacy_split_with_clause(sql)[0])},"
+                f"{len(split_with_clause(sql)[0])}"
+            )
+
+
+if __name__ == "__main__":
+    main()
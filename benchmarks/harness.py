@@ -0,0 +1,342 @@
+"""SQL生成のパイプライン全体のベンチマーク
+
+BigQueryには接続せず、合成したテストデータとフェイククライアントだけで計測するので、
+どの環境でも同じ条件で繰り返せる。計測する処理と、大きさを変えるパラメータは ``CASES`` にある。
+結果は1行1件のJSON(既定)かCSVで出力する::
+
+    python benchmarks/harness.py --output result.jsonl
+    python benchmarks/harness.py --quick --format csv
+    python benchmarks/harness.py --filter to_sql --baseline result.jsonl
+
+``--baseline`` に以前の結果を渡すと、最小時間が ``--threshold`` 倍を超えて遅くなった
+計測を標準エラーに表示し、終了コード1で終わる
+"""
+import argparse
+import contextlib
+import csv
+import io
+import json
+import platform
+import random
+import statistics
+import string
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from bqqtest.fake import FakeClient  # noqa: E402
+from bqqtest.registry import FixtureRegistry  # noqa: E402
+from bqqtest.table import Query, QueryTest, Table  # noqa: E402
+from bqqtest.util import get_query_from_with_clause  # noqa: E402
+
+TYPES = ["STRING", "INT64", "FLOAT64", "BOOL"]
+
+
+def synthetic_schema(n_columns):
+    return [
+        {"name": f"c{i}", "type": TYPES[i % len(TYPES)], "mode": "NULLABLE"}
+        for i in range(n_columns)
+    ]
+
+
+def synthetic_value(typ, rng):
+    if rng.random() < 0.1:
+        return None
+    if typ == "STRING":
+        return "".join(rng.choices(string.ascii_letters + '"', k=rng.randint(0, 12)))
+    if typ == "INT64":
+        return rng.randint(-(10 ** 12), 10 ** 12)
+    if typ == "FLOAT64":
+        return round(rng.uniform(-1e6, 1e6), 3)
+    return rng.random() < 0.5
+
+
+def synthetic_records(n_rows, n_columns, seed=0):
+    rng = random.Random(seed)
+    types = [TYPES[i % len(TYPES)] for i in range(n_columns)]
+    return [[synthetic_value(t, rng) for t in types] for _ in range(n_rows)]
+
+
+def synthetic_query(n_ctes, n_tables=1):
+    """``n_ctes`` 個のCTEを順に参照し、 ``n_tables`` 個のテーブルを読むクエリ"""
+    expression = " + ".join(f"IF((c1 > {j}), (c1 * {j}), 0)" for j in range(20))
+    sources = " UNION ALL ".join(
+        f"SELECT * FROM `project.dataset.t{i}`" for i in range(n_tables)
+    )
+    ctes = [f"s0 AS ({sources})"]
+    ctes += [
+        f"s{i} AS (SELECT c0, SUM({expression}) AS c1 FROM s{i - 1} GROUP BY c0)"
+        for i in range(1, max(n_ctes, 1))
+    ]
+    return "WITH " + ",\n".join(ctes) + f"\nSELECT * FROM s{len(ctes) - 1}"
+
+
+def write_csv(path, records):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_ALL)
+        for record in records:
+            writer.writerow(["" if v is None else v for v in record])
+
+
+def write_json(path, records):
+    with open(path, "w") as f:
+        json.dump(records, f)
+
+
+# 計測する処理。 setup(directory, **params) が計測する関数を返す
+
+
+def table_from_list(directory, rows, columns):
+    records = synthetic_records(rows, columns)
+    schema = synthetic_schema(columns)
+    return lambda: Table(records, schema, "T")
+
+
+def table_from_csv(directory, rows, columns):
+    # CSVは型の情報を持たないので、すべて文字列の列にする
+    path = str(Path(directory) / f"t_{rows}_{columns}.csv")
+    write_csv(path, synthetic_records(rows, columns))
+    schema = [
+        {"name": f"c{i}", "type": "STRING", "mode": "NULLABLE"} for i in range(columns)
+    ]
+    return lambda: Table(path, schema, "T")
+
+
+def table_from_json(directory, rows, columns):
+    path = str(Path(directory) / f"t_{rows}_{columns}.json")
+    write_json(path, synthetic_records(rows, columns))
+    schema = synthetic_schema(columns)
+    return lambda: Table(path, schema, "T")
+
+
+def dataframe_to_string_list(directory, rows, columns):
+    table = Table(synthetic_records(rows, columns), synthetic_schema(columns), "T")
+    return table.dataframe_to_string_list
+
+
+def table_to_sql(directory, rows, columns):
+    table = Table(synthetic_records(rows, columns), synthetic_schema(columns), "T")
+    return table.to_sql
+
+
+def with_clause(directory, ctes):
+    query = synthetic_query(ctes)
+    return lambda: get_query_from_with_clause(query)
+
+
+def query_to_sql(directory, tables, ctes):
+    table_map = {f"project.dataset.t{i}": f"ALIAS{i}" for i in range(tables)}
+    # 参照されないテーブル名も書き換えの候補として渡す
+    table_map.update({f"project.dataset.unused{i}": f"U{i}" for i in range(tables)})
+    query = synthetic_query(ctes, tables)
+    return lambda: Query("ACTUAL", query, [], table_map).to_sql()
+
+
+def query_test_inputs(rows, columns, tables, ctes):
+    schema = synthetic_schema(columns)
+    fixtures = {
+        f"project.dataset.t{i}": {
+            "schema": schema,
+            "datum": synthetic_records(rows, columns, seed=i),
+        }
+        for i in range(tables)
+    }
+    expected = {"schema": schema[:2], "datum": synthetic_records(rows, 2)}
+    query = {"query": synthetic_query(ctes, tables), "params": []}
+    return expected, fixtures, query
+
+
+def query_test_build(directory, rows, columns, tables, ctes):
+    # 毎回空のレジストリを使い、テストデータの変換を含めて計る
+    expected, fixtures, query = query_test_inputs(rows, columns, tables, ctes)
+    client = FakeClient()
+    return lambda: QueryTest(
+        client, expected, fixtures, query, registry=FixtureRegistry()
+    ).build()
+
+
+def query_test_build_shared(directory, rows, columns, tables, ctes):
+    # 同じテストデータを使うテストが続くときは、2回目からレジストリのSQLを使う
+    expected, fixtures, query = query_test_inputs(rows, columns, tables, ctes)
+    client = FakeClient()
+    registry = FixtureRegistry()
+    return lambda: QueryTest(
+        client, expected, fixtures, query, registry=registry
+    ).build()
+
+
+def query_test_run(directory, rows, columns, tables, ctes):
+    expected, fixtures, query = query_test_inputs(rows, columns, tables, ctes)
+    client = FakeClient()
+
+    def run():
+        QueryTest(
+            client, expected, fixtures, query, registry=FixtureRegistry()
+        ).run()
+        # セーフティネットと本番のジョブが記録されていること
+        assert len(client.jobs) % 2 == 0
+
+    return run
+
+
+TABLE_SIZES = [{"rows": r, "columns": c} for r in (100, 10_000) for c in (4, 40)]
+
+CASES = [
+    (table_from_list, TABLE_SIZES),
+    (table_from_csv, [{"rows": r, "columns": 8} for r in (100, 10_000)]),
+    (table_from_json, [{"rows": r, "columns": 8} for r in (100, 10_000)]),
+    (dataframe_to_string_list, TABLE_SIZES),
+    (table_to_sql, TABLE_SIZES),
+    (with_clause, [{"ctes": n} for n in (10, 100, 400)]),
+    (query_to_sql, [{"tables": t, "ctes": 20} for t in (10, 100, 500)]),
+    (
+        query_test_build,
+        [
+            {"rows": 10, "columns": 4, "tables": 5, "ctes": 10},
+            {"rows": 1_000, "columns": 20, "tables": 5, "ctes": 50},
+            {"rows": 100, "columns": 4, "tables": 50, "ctes": 100},
+        ],
+    ),
+    (
+        query_test_build_shared,
+        [
+            {"rows": 10, "columns": 4, "tables": 5, "ctes": 10},
+            {"rows": 1_000, "columns": 20, "tables": 5, "ctes": 50},
+        ],
+    ),
+    (
+        query_test_run,
+        [
+            {"rows": 10, "columns": 4, "tables": 5, "ctes": 10},
+            {"rows": 1_000, "columns": 20, "tables": 5, "ctes": 50},
+        ],
+    ),
+]
+
+
+def quick_params(params):
+    """``--quick`` 用に行数を1/10にしたパラメータ"""
+    return {
+        key: max(1, value // 10) if key == "rows" else value
+        for key, value in params.items()
+    }
+
+
+def measure(fn, repeat):
+    # 1回目は読み込みやキャッシュの準備を含むので捨てる
+    fn()
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - started)
+    return min(times), statistics.median(times)
+
+
+def case_key(record):
+    return (record["case"], json.dumps(record["params"], sort_keys=True))
+
+
+def run(cases, repeat, quick):
+    records = []
+    with tempfile.TemporaryDirectory() as directory:
+        for setup, param_sets in cases:
+            for params in param_sets:
+                params = quick_params(params) if quick else params
+                fn = setup(directory, **params)
+                # util のデバッグ出力を計測結果に混ぜない
+                with contextlib.redirect_stdout(io.StringIO()):
+                    best, median = measure(fn, repeat)
+                records.append(
+                    {
+                        "case": setup.__name__,
+                        "params": params,
+                        "repeat": repeat,
+                        "min_sec": round(best, 6),
+                        "median_sec": round(median, 6),
+                    }
+                )
+    return records
+
+
+def regressions(records, baseline_path, threshold):
+    """基準の結果より ``threshold`` 倍以上遅くなった計測のリスト"""
+    with open(baseline_path) as f:
+        baseline = {
+            case_key(record): record
+            for record in map(json.loads, f)
+            if "case" in record
+        }
+    slower = []
+    for record in records:
+        base = baseline.get(case_key(record))
+        if base is None or base["min_sec"] <= 0:
+            continue
+        ratio = record["min_sec"] / base["min_sec"]
+        if ratio > threshold:
+            slower.append((record, base, ratio))
+    return slower
+
+
+def write(records, fmt, out):
+    if fmt == "csv":
+        writer = csv.writer(out)
+        writer.writerow(["case", "params", "repeat", "min_sec", "median_sec"])
+        for r in records:
+            params = " ".join(f"{k}={v}" for k, v in r["params"].items())
+            writer.writerow(
+                [r["case"], params, r["repeat"], r["min_sec"], r["median_sec"]]
+            )
+        return
+
+    environment = {
+        "environment": {
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "machine": platform.machine(),
+            "platform": platform.platform(),
+        }
+    }
+    out.write(json.dumps(environment) + "\n")
+    for record in records:
+        out.write(json.dumps(record) + "\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--format", choices=["json", "csv"], default="json")
+    parser.add_argument("--output", help="結果を書き出すファイル。省略すると標準出力")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--quick", action="store_true", help="行数を1/10にする")
+    parser.add_argument("--filter", default="", help="名前にこの文字列を含む計測だけ")
+    parser.add_argument("--baseline", help="比べる以前の結果(JSON)")
+    parser.add_argument("--threshold", type=float, default=1.5)
+    args = parser.parse_args(argv)
+
+    cases = [case for case in CASES if args.filter in case[0].__name__]
+    records = run(cases, args.repeat, args.quick)
+
+    if args.output:
+        with open(args.output, "w", newline="") as out:
+            write(records, args.format, out)
+    else:
+        write(records, args.format, sys.stdout)
+
+    if args.baseline:
+        slower = regressions(records, args.baseline, args.threshold)
+        for record, base, ratio in slower:
+            print(
+                f"遅くなりました: {record['case']} {record['params']} "
+                f"{base['min_sec']:.6f}s -> {record['min_sec']:.6f}s ({ratio:.2f}倍)",
+                file=sys.stderr,
+            )
+        return 1 if slower else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
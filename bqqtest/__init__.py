@@ -1 +1,3 @@
-from .table import Table, Query, QueryTest
+from .table import Table, StreamingTable, Query, QueryTest
+from .suite import QueryTestSuite, run_many
+from .batch import QueryTestBatch, run_batched
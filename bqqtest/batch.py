@@ -0,0 +1,217 @@
+"""たくさんのテストをひとつのクエリにまとめて実行する"""
+import decimal
+import json
+import time
+
+from .encoders import json_value_decoder
+from .spill import MAX_QUERY_LENGTH
+from .suite import QueryTestResult
+
+
+class QueryTestBatch:
+    """テストを UNION ALL でつないだひとつのクエリにまとめて実行する
+
+    各テストのクエリは副問合せに入れるので、CTEの名前はテストごとに閉じていて衝突しない。
+    列の違う差分をつなげるために、差分のレコードは ``TO_JSON_STRING`` で1列にし、
+    テストの番号を付ける。結果はテストごとに分けて ``(success, diff)`` に戻す。
+    差分の値は期待するテーブルの列の型で読み直すので、ひとつずつ実行したときと同じ型になる
+
+    クエリは ``max_query_length`` を超えない範囲でできるだけ多くのテストをまとめる。
+    クライアントが違うテストや、同じ名前で値の違うクエリパラメータを持つテストは
+    別のクエリにする。まとめたクエリが失敗したときは、半分に分けて実行し直し、
+    最後はテストをひとつずつ実行して失敗したテストを特定する
+
+    Args:
+        tests (list): ``QueryTest`` か ``QueryLogicTest`` のリスト
+        max_query_length (int): まとめたクエリの長さの上限
+    """
+
+    _tests = []
+    _max_query_length = MAX_QUERY_LENGTH
+    _sqls = {}
+
+    def __init__(self, tests: list, max_query_length: int = MAX_QUERY_LENGTH):
+        assert isinstance(tests, list)
+        assert max_query_length > 0
+        # 循環importを避ける
+        from .table import QueryTest
+
+        self._tests = [
+            test.query_logic_test() if isinstance(test, QueryTest) else test
+            for test in tests
+        ]
+        self._max_query_length = max_query_length
+        self._sqls = {}
+
+    @staticmethod
+    def envelope(test_id: int, sql: str):
+        """テストひとつ分のクエリを、テストの番号付きの差分を返す副問合せにする"""
+        return (
+            f"SELECT {test_id} AS test_id, TO_JSON_STRING(d) AS row"
+            f" FROM (\n{sql}\n) AS d"
+        )
+
+    def build(self, indices: list):
+        """``indices`` 番目のテストをまとめたクエリ"""
+        return "\nUNION ALL\n".join(self.envelope(i, self._sql(i)) for i in indices)
+
+    @staticmethod
+    def _parameters(test):
+        return {
+            p.name: json.dumps(p.to_api_repr(), sort_keys=True, default=str)
+            for p in test.query().query_parameters()
+        }
+
+    def _sql(self, i: int):
+        if i not in self._sqls:
+            self._sqls[i] = self._tests[i].build()
+        return self._sqls[i]
+
+    def batches(self):
+        """まとめて実行するテストの番号のリストのリスト
+
+        テストの順番を保ったまま、先頭から詰められるだけ詰める
+        """
+        batches = []
+        current, length, client, parameters = [], 0, None, {}
+        for i, test in enumerate(self._tests):
+            size = len(self.envelope(i, self._sql(i))) + len("\nUNION ALL\n")
+            test_parameters = self._parameters(test)
+            compatible = (
+                test.client() is client
+                and length + size <= self._max_query_length
+                and all(parameters.get(k, v) == v for k, v in test_parameters.items())
+            )
+            if current and not compatible:
+                batches.append(current)
+                current, length, parameters = [], 0, {}
+            current.append(i)
+            length += size
+            client = test.client()
+            parameters.update(test_parameters)
+        if current:
+            batches.append(current)
+        return batches
+
+    def _decoders(self, i: int):
+        """``i`` 番目のテストの差分の列を元の型に戻す関数のリスト"""
+        schema = self._tests[i].expected_schema()
+        return [json_value_decoder(parsed) for parsed in schema.parsed_types()]
+
+    @staticmethod
+    def _decode(record: dict, decoders: list):
+        """``TO_JSON_STRING`` の差分のレコードの値を列の型に戻す
+
+        差分の列は先頭の mark と末尾の n のあいだに、期待するテーブルと同じ順で並ぶ
+        """
+        values = list(record.values())
+        columns = [
+            None if v is None else decode(v)
+            for v, decode in zip(values[1:-1], decoders)
+        ]
+        return (values[0], *columns, values[-1])
+
+    def _job_config(self, indices: list, dry_run: bool = False):
+        from google.cloud import bigquery
+
+        parameters = {}
+        for i in indices:
+            for p in self._tests[i].query().query_parameters():
+                parameters.setdefault(p.name, p)
+        return bigquery.QueryJobConfig(
+            query_parameters=list(parameters.values()),
+            dry_run=dry_run,
+            # まとめたテストがすべてクエリキャッシュを使うときだけ使う
+            use_query_cache=all(self._tests[i].uses_query_cache() for i in indices),
+        )
+
+    def _run_batch(self, indices: list, single_job: bool, dry_run: bool):
+        """まとめたクエリを実行し、テストの番号から ``(success, diff)`` への辞書を返す"""
+        # 循環importを避ける
+        from .table import ZERO_SCAN_MESSAGE, is_bytes_processed_allowed
+
+        client = self._tests[indices[0]].client()
+        sql = self.build(indices)
+        if dry_run or not single_job:
+            job = client.query(sql, job_config=self._job_config(indices, dry_run))
+            if not dry_run:
+                job.result()
+            assert is_bytes_processed_allowed(job), ZERO_SCAN_MESSAGE
+
+        job = client.query(sql, job_config=self._job_config(indices))
+        result = job.result()
+        if single_job and not dry_run:
+            assert is_bytes_processed_allowed(job), ZERO_SCAN_MESSAGE
+
+        from google.cloud import bigquery
+
+        decoders = {i: self._decoders(i) for i in indices}
+        diffs = {i: [] for i in indices}
+        for row in result:
+            # NUMERICの桁が落ちないように、小数はDecimalで読む
+            record = json.loads(row["row"], parse_float=decimal.Decimal)
+            field_to_index = {name: j for j, name in enumerate(record)}
+            values = self._decode(record, decoders[row["test_id"]])
+            diffs[row["test_id"]].append(bigquery.Row(values, field_to_index))
+        # 副問合せの中の ORDER BY は効かないので、ここで並べ直す
+        return {
+            i: (diff == [], sorted(diff, key=lambda r: r["n"]))
+            for i, diff in diffs.items()
+        }
+
+    def _run(self, indices: list, single_job: bool, dry_run: bool):
+        """失敗したら半分に分けて実行し直す。テストの番号から結果への辞書を返す"""
+        if len(indices) == 1:
+            test = self._tests[indices[0]]
+            started = time.perf_counter()
+            try:
+                success, diff = test.run(single_job=single_job, dry_run=dry_run)
+                error = None
+            except Exception as e:
+                success, diff, error = False, [], e
+            latency = time.perf_counter() - started
+            return {
+                indices[0]: QueryTestResult(
+                    success, diff, latency, error, test.metrics()
+                )
+            }
+
+        started = time.perf_counter()
+        try:
+            outcomes = self._run_batch(indices, single_job, dry_run)
+        except Exception:
+            middle = len(indices) // 2
+            results = self._run(indices[:middle], single_job, dry_run)
+            results.update(self._run(indices[middle:], single_job, dry_run))
+            return results
+        latency = time.perf_counter() - started
+        return {
+            i: QueryTestResult(success, diff, latency)
+            for i, (success, diff) in outcomes.items()
+        }
+
+    def run(self, single_job: bool = False, dry_run: bool = False):
+        """すべてのテストを実行する
+
+        Args:
+            single_job (bool): ``QueryLogicTest.run`` を参照
+            dry_run (bool): ``QueryLogicTest.run`` を参照
+
+        Returns:
+            list: ``QueryTestResult`` のリスト。 ``tests`` と同じ順。
+                latency はまとめたクエリ全体の実行時間
+        """
+        results = {}
+        for indices in self.batches():
+            results.update(self._run(indices, single_job, dry_run))
+        return [results[i] for i in range(len(self._tests))]
+
+
+def run_batched(
+    tests: list,
+    max_query_length: int = MAX_QUERY_LENGTH,
+    single_job: bool = False,
+    dry_run: bool = False,
+):
+    """``QueryTestBatch(tests, max_query_length).run(...)`` の省略形"""
+    return QueryTestBatch(tests, max_query_length).run(single_job, dry_run)
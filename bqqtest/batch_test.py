@@ -0,0 +1,132 @@
+import datetime
+import decimal
+import json
+
+from google.cloud import bigquery
+
+from .batch import QueryTestBatch, run_batched
+from .fake import FakeClient
+from .table import QueryTest
+
+
+def diff_row(test_id, mark, value, n):
+    record = json.dumps({"mark": mark, "name": "abc", "value": value, "n": n})
+    return bigquery.Row((test_id, record), {"test_id": 0, "row": 1})
+
+
+def test_テストをひとつのクエリにまとめて結果をテストごとに分ける(query_test):
+    def handler(query, job_config):
+        # 2番目のテストだけ差分がある
+        return [diff_row(1, "-", 1, 2), diff_row(1, "+", 9, 1)], 0
+
+    client = FakeClient(handler)
+    results = run_batched(
+        [query_test(client, [["abc", i]]) for i in range(3)], single_job=True
+    )
+
+    assert len(client.jobs) == 1
+    assert client.jobs[0].query.count("TO_JSON_STRING(d)") == 3
+    assert [r.success for r in results] == [True, False, True]
+    assert [(row["mark"], row["n"]) for row in results[1].diff] == [("+", 1), ("-", 2)]
+
+
+def test_クエリの長さの上限に収まるように分ける(query_test):
+    client = FakeClient()
+    tests = [query_test(client, [["abc", i]]) for i in range(5)]
+    length = len(QueryTestBatch.envelope(0, tests[0].build())) + len("\nUNION ALL\n")
+
+    batch = QueryTestBatch(tests, max_query_length=length * 2)
+    assert batch.batches() == [[0, 1], [2, 3], [4]]
+    assert all(r.success for r in batch.run(single_job=True))
+    assert len(client.jobs) == 3
+
+
+def test_クライアントやクエリパラメータが違うテストは分ける(query_test):
+    client1, client2 = FakeClient(), FakeClient()
+    p1 = [bigquery.ScalarQueryParameter("v", "INT64", 1)]
+    p2 = [bigquery.ScalarQueryParameter("v", "INT64", 2)]
+    tests = [
+        query_test(client1, [["abc", 0]], params=p1),
+        query_test(client1, [["abc", 1]], params=p1),
+        query_test(client1, [["abc", 2]], params=p2),
+        query_test(client2, [["abc", 3]], params=p2),
+    ]
+    assert QueryTestBatch(tests).batches() == [[0, 1], [2], [3]]
+
+
+def test_失敗したクエリは分割して失敗したテストを特定する(query_test):
+    def handler(query, job_config):
+        if ",3)" in query:
+            raise ValueError("invalid query")
+        return [], 0
+
+    client = FakeClient(handler)
+    results = run_batched(
+        [query_test(client, [["abc", i]]) for i in range(6)], single_job=True
+    )
+
+    assert [r.success for r in results] == [True, True, True, False, True, True]
+    assert isinstance(results[3].error, ValueError)
+    assert all(r.error is None for i, r in enumerate(results) if i != 3)
+
+
+def test_データを走査するテストは失敗にする(query_test):
+    client = FakeClient(lambda query, job_config: ([], 100 if ",1)" in query else 0))
+    results = run_batched([query_test(client, [["abc", i]]) for i in range(2)])
+
+    assert results[0].success and results[0].error is None
+    assert isinstance(results[1].error, AssertionError)
+
+
+def test_すべてのテストがクエリキャッシュを使うときだけ使う(query_test):
+    client = FakeClient()
+    run_batched([query_test(client, [["abc", i]], query_cache=True) for i in range(2)])
+    run_batched(
+        [
+            query_test(client, [["abc", 0]], query_cache=True),
+            query_test(client, [["abc", 1]]),
+        ],
+        single_job=True,
+    )
+    assert [job.job_config.use_query_cache for job in client.jobs] == [
+        True,
+        True,
+        False,
+    ]
+
+
+def test_差分の値は期待するテーブルの列の型に戻す():
+    schema = [
+        {"name": "d", "type": "DATE", "mode": "NULLABLE"},
+        {"name": "b", "type": "BYTES", "mode": "NULLABLE"},
+        {"name": "x", "type": "NUMERIC", "mode": "NULLABLE"},
+        {"name": "f", "type": "FLOAT64", "mode": "NULLABLE"},
+        {"name": "t", "type": "TIMESTAMP", "mode": "NULLABLE"},
+    ]
+    # TO_JSON_STRING はDATEを文字列、BYTESをBase64、FLOAT64のinfを文字列にする
+    record = (
+        '{"mark":"-","d":"2020-01-02","b":"YWJj","x":0.10000000000000000001,'
+        '"f":"Infinity","t":"2020-01-02T03:04:05.5Z","n":1}'
+    )
+    client = FakeClient(
+        lambda query, job_config: (
+            [bigquery.Row((0, record), {"test_id": 0, "row": 1})],
+            0,
+        )
+    )
+    expected = {"schema": schema, "datum": []}
+    tests = [QueryTest(client, expected, {}, {"query": "SELECT 1", "params": []})] * 2
+
+    (row,) = run_batched(tests, single_job=True)[0].diff
+    assert list(row.items()) == [
+        ("mark", "-"),
+        ("d", datetime.date(2020, 1, 2)),
+        ("b", b"abc"),
+        ("x", decimal.Decimal("0.10000000000000000001")),
+        ("f", float("inf")),
+        (
+            "t",
+            datetime.datetime(2020, 1, 2, 3, 4, 5, 500000, datetime.timezone.utc),
+        ),
+        ("n", 1),
+    ]
@@ -0,0 +1,259 @@
+"""変更のないテストを再実行しないための、テスト結果のディスクキャッシュ"""
+import base64
+import datetime
+import decimal
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+from pathlib import Path
+
+from .util import scan_literals
+
+# 実行するたびに結果が変わりうる関数。これらを含むクエリの結果はキャッシュしない
+NONDETERMINISTIC_FUNCTIONS = {
+    "CURRENT_DATE",
+    "CURRENT_DATETIME",
+    "CURRENT_TIME",
+    "CURRENT_TIMESTAMP",
+    "GENERATE_UUID",
+    "RAND",
+    "SESSION_USER",
+}
+
+# 名前がこれで始まる関数も結果が変わりうる。近似集計は実行ごとに結果が揺れる
+NONDETERMINISTIC_PREFIXES = {"APPROX_"}
+
+# キャッシュするエントリの大きさの合計の既定の上限(バイト)
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+_space = re.compile(r"\s+")
+_nondeterministic = re.compile(
+    r"(?<!\w)(?:{}|(?:{})\w*)(?!\w)".format(
+        "|".join(sorted(NONDETERMINISTIC_FUNCTIONS)),
+        "|".join(sorted(NONDETERMINISTIC_PREFIXES)),
+    ),
+    flags=re.IGNORECASE,
+)
+
+
+def normalize_sql(sql: str):
+    """文字列リテラルの外のコメントと連続した空白をひとつの空白にする"""
+    pieces = []
+    for token in scan_literals(sql):
+        if token.kind in ("string", "quoted"):
+            text = token.text
+        else:
+            text = " " if token.kind == "comment" else _space.sub(" ", token.text)
+            if pieces and pieces[-1].endswith(" "):
+                text = text.lstrip(" ")
+        if text:
+            pieces.append(text)
+    return "".join(pieces).strip()
+
+
+def is_deterministic(query: str):
+    """何度実行しても同じ結果になるクエリか
+
+    文字列リテラルとコメントの外に ``NONDETERMINISTIC_FUNCTIONS`` の関数名か、
+    ``NONDETERMINISTIC_PREFIXES`` で始まる関数名があればFalse
+    """
+    return not any(
+        _nondeterministic.search(token.text)
+        for token in scan_literals(query)
+        if token.kind == "code"
+    )
+
+
+# JSONにない型の値は、型名と文字列の組で保存する
+_encoders = [
+    (datetime.datetime, "datetime", lambda v: v.isoformat()),
+    (datetime.date, "date", lambda v: v.isoformat()),
+    (datetime.time, "time", lambda v: v.isoformat()),
+    (decimal.Decimal, "decimal", str),
+    (bytes, "bytes", lambda v: base64.b64encode(v).decode("ascii")),
+]
+
+_decoders = {
+    "datetime": datetime.datetime.fromisoformat,
+    "date": datetime.date.fromisoformat,
+    "time": datetime.time.fromisoformat,
+    "decimal": decimal.Decimal,
+    "bytes": base64.b64decode,
+}
+
+
+def _json_default(value):
+    for typ, name, encode in _encoders:
+        if isinstance(value, typ):
+            return {"__type__": name, "value": encode(value)}
+    raise TypeError(f"{type(value).__name__} はキャッシュに保存できません")
+
+
+def _json_object_hook(obj):
+    if obj.keys() == {"__type__", "value"} and obj["__type__"] in _decoders:
+        return _decoders[obj["__type__"]](obj["value"])
+    return obj
+
+
+def _row_to_items(row):
+    from google.cloud import bigquery
+
+    if isinstance(row, bigquery.Row):
+        return ("row", list(row.items()))
+    return ("raw", row)
+
+
+def _items_to_row(item):
+    kind, value = item
+    if kind == "row":
+        from google.cloud import bigquery
+
+        return bigquery.Row(
+            tuple(v for _, v in value), {k: i for i, (k, _) in enumerate(value)}
+        )
+    return value
+
+
+class ResultCache:
+    """テスト結果 ``(success, diff)`` をディレクトリにJSONで保存する
+
+    キーはクエリとクエリパラメータから作る。エントリのファイルの更新時刻を
+    最後に使った時刻として、保存したときと取り出したときに更新する。
+    ``ttl`` 秒使われなかったエントリは無効になり、ファイルの大きさの合計が
+    ``max_bytes`` を超えるか、数が ``max_entries`` を超えると、
+    最近使われていないものから削除する。
+    日付や NUMERIC 、 BYTES の値は型名を付けて保存し、読み込むときに元の型に戻す
+
+    Args:
+        directory (str): 保存先のディレクトリ
+        ttl (float): エントリの有効期間(秒)。Noneなら無期限
+        max_bytes (int): 保存するエントリのファイルの大きさの合計の上限(バイト)
+        max_entries (int): 保存するエントリの数の上限。Noneなら数では制限しない
+    """
+
+    _directory = None
+    _ttl = None
+    _max_bytes = DEFAULT_MAX_BYTES
+    _max_entries = None
+
+    def __init__(
+        self,
+        directory: str = ".bqqtest_cache",
+        ttl: float = 7 * 24 * 60 * 60,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        max_entries: int = None,
+    ):
+        assert ttl is None or ttl > 0
+        assert max_bytes > 0
+        assert max_entries is None or max_entries > 0
+        self._directory = Path(directory)
+        self._ttl = ttl
+        self._max_bytes = max_bytes
+        self._max_entries = max_entries
+
+    @staticmethod
+    def key(query: str, query_parameters: list, **options):
+        """キャッシュのキー
+
+        Args:
+            query (str): 実行するクエリ
+            query_parameters (list): クエリパラメータ
+            options: 結果に影響する実行時のオプション
+
+        Returns:
+            (str): SHA-256のハッシュ値
+        """
+        payload = json.dumps(
+            {
+                "query": normalize_sql(query),
+                "params": [p.to_api_repr() for p in query_parameters],
+                "options": options,
+            },
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str):
+        return self._directory / f"{key}.json"
+
+    def get(self, key: str):
+        """保存した結果を返す。ないか期限切れならNone
+
+        返したエントリは最近使ったものとして、ファイルの更新時刻を今にする
+        """
+        path = self._path(key)
+        try:
+            if self._ttl is not None and time.time() - path.stat().st_mtime > self._ttl:
+                self.invalidate(key)
+                return None
+            with open(path, "r", encoding="utf-8") as f:
+                success, diff = json.load(f, object_hook=_json_object_hook)
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            return None
+        return (success, [_items_to_row(item) for item in diff])
+
+    def set(self, key: str, outcome: tuple):
+        """結果を保存する
+
+        JSONにできない値を含む結果と、それだけで ``max_bytes`` を超える結果は保存しない
+        """
+        success, diff = outcome
+        try:
+            content = json.dumps(
+                [success, [_row_to_items(row) for row in diff]],
+                default=_json_default,
+                ensure_ascii=False,
+            )
+        except TypeError:
+            return
+        data = content.encode("utf-8")
+        if len(data) > self._max_bytes:
+            self.invalidate(key)
+            return
+        self._directory.mkdir(parents=True, exist_ok=True)
+        # 書き込み途中のファイルを読まないように、一時ファイルに書いてから置き換える
+        fd, tmp = tempfile.mkstemp(dir=self._directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, self._path(key))
+        self.evict()
+
+    def invalidate(self, key: str):
+        """エントリを削除する"""
+        try:
+            self._path(key).unlink()
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        """すべてのエントリを削除する"""
+        for path in self._directory.glob("*.json"):
+            path.unlink()
+
+    def evict(self):
+        """期限切れのエントリと、上限を超えた最近使われていないエントリを削除する"""
+        entries = []
+        for path in self._directory.glob("*.json"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort(key=lambda entry: entry[0], reverse=True)
+
+        now = time.time()
+        total = 0
+        for i, (mtime, size, path) in enumerate(entries):
+            total += size
+            expired = self._ttl is not None and now - mtime > self._ttl
+            too_many = self._max_entries is not None and i >= self._max_entries
+            if expired or too_many or total > self._max_bytes:
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
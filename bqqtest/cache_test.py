@@ -0,0 +1,173 @@
+import datetime
+import decimal
+import os
+import time
+
+import pytest
+from google.cloud import bigquery
+
+from .cache import ResultCache, is_deterministic, normalize_sql
+from .fake import FakeClient
+
+
+def test_normalize_sqlは文字列リテラルの中の空白を変えない():
+    assert normalize_sql(' SELECT  "a  b",\n\t`x  y` ') == 'SELECT "a  b", `x  y`'
+
+
+def test_normalize_sqlはコメントを空白にする():
+    assert normalize_sql("SELECT 1 -- a\n/* b */ + 2 # c") == "SELECT 1 + 2"
+    assert normalize_sql("SELECT '-- a'") == "SELECT '-- a'"
+
+
+def test_キーはクエリパラメータとオプションで変わる():
+    p1 = [bigquery.ScalarQueryParameter("a", "INT64", 1)]
+    p2 = [bigquery.ScalarQueryParameter("a", "INT64", 2)]
+    assert ResultCache.key("SELECT  1", p1) == ResultCache.key("SELECT 1", p1)
+    assert ResultCache.key("SELECT 1", p1) != ResultCache.key("SELECT 1", p2)
+    assert ResultCache.key("SELECT 1", []) != ResultCache.key(
+        "SELECT 1", [], client_diff=True
+    )
+
+
+def test_キーは実行環境で変わる(query_test):
+    from .local import SQLiteBackend
+
+    qt = query_test(FakeClient())
+    assert qt.cache_key() != qt.cache_key(backend=SQLiteBackend())
+    assert qt.cache_key(backend=SQLiteBackend()) == qt.cache_key(
+        backend=SQLiteBackend(fallback=False)
+    )
+
+
+def test_保存した結果を取り出せる(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    row = bigquery.Row(("+", "abc", 1), {"mark": 0, "name": 1, "n": 2})
+    cache.set("k", (False, [row]))
+
+    assert cache.get("k") == (False, [row])
+    assert cache.get("unknown") is None
+
+
+def test_日付やBYTESの値も元の型で取り出せる(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    values = (
+        "+",
+        datetime.date(2020, 1, 2),
+        datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc),
+        decimal.Decimal("1.10"),
+        b"\x00\xff",
+        {"a": [1, None]},
+        1,
+    )
+    names = ["mark", "d", "ts", "num", "b", "s", "n"]
+    row = bigquery.Row(values, {name: i for i, name in enumerate(names)})
+    cache.set("k", (False, [row]))
+
+    (got,) = cache.get("k")[1]
+    assert got == row
+    assert [type(v) for v in got.values()] == [type(v) for v in values]
+    assert not list(tmp_path.glob("*.pickle"))
+
+
+def test_JSONにできない値を含む結果は保存しない(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    cache.set("k", (False, [object()]))
+    assert cache.get("k") is None
+
+
+def test_期限切れのエントリは返さない(tmp_path):
+    cache = ResultCache(str(tmp_path), ttl=60)
+    cache.set("k", (True, []))
+    old = time.time() - 120
+    os.utime(tmp_path / "k.json", (old, old))
+
+    assert cache.get("k") is None
+    assert not (tmp_path / "k.json").exists()
+
+
+def test_上限を超えると古いエントリから削除する(tmp_path):
+    cache = ResultCache(str(tmp_path), max_entries=2)
+    now = time.time()
+    for i, key in enumerate(["a", "b", "c"]):
+        cache.set(key, (True, []))
+        os.utime(tmp_path / f"{key}.json", (now - 100 + i, now - 100 + i))
+    cache.set("d", (True, []))
+
+    assert sorted(p.stem for p in tmp_path.glob("*.json")) == ["c", "d"]
+
+
+def test_大きさの合計が上限を超えると最近使われていないエントリから削除する(tmp_path):
+    row = bigquery.Row(("+", "x" * 100, 1), {"mark": 0, "name": 1, "n": 2})
+    cache = ResultCache(str(tmp_path), max_bytes=500)
+    now = time.time()
+    for i, key in enumerate(["a", "b", "c"]):
+        cache.set(key, (False, [row]))
+        os.utime(tmp_path / f"{key}.json", (now - 100 + i, now - 100 + i))
+    assert len(list(tmp_path.glob("*.json"))) == 3
+
+    # 取り出した a は最近使ったものになり、代わりに b が削除される
+    assert cache.get("a") == (False, [row])
+    cache.set("d", (False, [row]))
+    assert sorted(p.stem for p in tmp_path.glob("*.json")) == ["a", "c", "d"]
+    assert sum(p.stat().st_size for p in tmp_path.glob("*.json")) <= 500
+
+
+def test_上限より大きい結果は保存しない(tmp_path):
+    row = bigquery.Row(("+", "x" * 100, 1), {"mark": 0, "name": 1, "n": 2})
+    cache = ResultCache(str(tmp_path), max_bytes=100)
+    cache.set("k", (False, [row]))
+    assert cache.get("k") is None
+    assert list(tmp_path.glob("*")) == []
+
+
+def test_invalidateとclear(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    cache.set("a", (True, []))
+    cache.set("b", (True, []))
+
+    cache.invalidate("a")
+    assert cache.get("a") is None and cache.get("b") == (True, [])
+    cache.clear()
+    assert cache.get("b") is None
+
+
+def test_変わっていないテストはBigQueryで実行しない(query_test, tmp_path):
+    cache = ResultCache(str(tmp_path))
+    client = FakeClient()
+
+    assert query_test(client).run(cache=cache) == (True, [])
+    assert len(client.jobs) == 2
+    assert query_test(client).run(cache=cache) == (True, [])
+    assert len(client.jobs) == 2
+    query_test(client, [["abc", 2]], expected=[["abc", 1]]).run(cache=cache)
+    assert len(client.jobs) == 4
+
+
+@pytest.mark.parametrize(
+    "query",
+    **{
+        "argvalues": [
+            "SELECT CURRENT_DATE() AS d",
+            "SELECT current_timestamp AS d",
+            "SELECT RAND() AS d",
+            "SELECT APPROX_COUNT_DISTINCT(name) AS d FROM test.table",
+            "SELECT approx_quantiles(value, 2) AS d FROM test.table",
+        ],
+        "ids": ["CURRENT_DATE", "小文字", "RAND", "APPROX_COUNT_DISTINCT", "近似の小文字"],
+    },
+)
+def test_実行ごとに結果が変わるクエリはキャッシュしない(query_test, tmp_path, query):
+    cache = ResultCache(str(tmp_path))
+    client = FakeClient()
+    qt = query_test(client, [], query=query)
+
+    qt.run(cache=cache)
+    qt.run(cache=cache)
+    assert len(client.jobs) == 4
+    assert qt.metrics().result_cache_hit is False
+    assert list(tmp_path.glob("*.json")) == []
+
+
+def test_文字列やコメントの中の関数名は結果を変えない():
+    assert is_deterministic("SELECT 'RAND()' -- CURRENT_DATE\nFROM t")
+    assert not is_deterministic("SELECT x FROM t WHERE d < CURRENT_DATE()")
@@ -0,0 +1,94 @@
+"""pandasを使わずにテストデータを列ごとのリストで持つ"""
+import csv
+import math
+
+
+def _to_python(value: str, typ: str):
+    """CSVから読んだ文字列を型に合わせて変換する。空文字列はNone"""
+    if value == "":
+        return None
+    if typ == "int64":
+        return int(value)
+    if typ == "float64":
+        return float(value)
+    if typ == "bool":
+        return value.lower() == "true"
+    return value
+
+
+def _is_null(value):
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+class ColumnStore:
+    """列ごとのリストで表したテーブル
+
+    数行しかないテストデータを大量に作るときに、 ``pd.DataFrame`` よりも軽い。
+    値はPythonのオブジェクトのまま持ち、欠損値はNoneにする
+
+    Args:
+        names (list): 列名のリスト
+        columns (list): 列ごとの値のリストのリスト
+    """
+
+    __slots__ = ("_names", "_columns", "_length")
+
+    def __init__(self, names: list, columns: list):
+        assert len(names) == len(columns)
+        self._names = list(names)
+        self._columns = [
+            [None if _is_null(v) else v for v in column] for column in columns
+        ]
+        self._length = len(self._columns[0]) if self._columns else 0
+        assert all(len(column) == self._length for column in self._columns)
+
+    @classmethod
+    def from_records(cls, records: list, names: list):
+        """レコードのリストから作る
+
+        Args:
+            records (list): 列の順番のリストか、列名をキーにした辞書のリスト。
+                辞書にない列はNoneになる
+            names (list): 列名のリスト
+        """
+        records = [
+            [record.get(name) for name in names]
+            if isinstance(record, dict)
+            else record
+            for record in records
+        ]
+        assert all(len(record) == len(names) for record in records), "列の数が一致しません"
+        if not records:
+            return cls(names, [[] for _ in names])
+        return cls(names, [list(column) for column in zip(*records)])
+
+    @classmethod
+    def read_csv(cls, filename: str, names: list, types: list):
+        """ヘッダーのないCSVファイルを読む。値はスキーマの型に合わせて変換する"""
+        with open(filename, newline="") as f:
+            records = [
+                [_to_python(value, typ) for value, typ in zip(row, types)]
+                for row in csv.reader(f)
+                if row
+            ]
+        return cls.from_records(records, names)
+
+    def __len__(self):
+        return self._length
+
+    def names(self):
+        return list(self._names)
+
+    def column(self, name: str):
+        return self._columns[self._names.index(name)]
+
+    def slice(self, start: int, stop: int):
+        return ColumnStore(self._names, [c[start:stop] for c in self._columns])
+
+    def rows(self):
+        return zip(*self._columns)
+
+    def to_dataframe(self):
+        import pandas as pd
+
+        return pd.DataFrame(dict(zip(self._names, self._columns)), columns=self._names)
@@ -0,0 +1,32 @@
+from pathlib import Path
+
+import pytest
+
+from .columns import ColumnStore
+
+
+def test_レコードから列ごとのリストを作る():
+    store = ColumnStore.from_records([["a", 1], ["b", float("nan")]], ["name", "value"])
+    assert len(store) == 2
+    assert store.column("name") == ["a", "b"]
+    assert store.column("value") == [1, None]
+    assert list(store.slice(1, 2).rows()) == [("b", None)]
+
+
+def test_CSVの値はスキーマの型に変換する():
+    p = Path(__file__).parent / "testdata/test1.csv"
+    store = ColumnStore.read_csv(
+        str(p), ["name", "category", "value"], ["string", "string", "int64"]
+    )
+    assert list(store.rows()) == [("abc", "bdc", 200), ("ほげほげ", "ふがふが", 300000)]
+
+
+def test_列の数が違うレコードはAssertionError():
+    with pytest.raises(AssertionError):
+        ColumnStore.from_records([["a"]], ["name", "value"])
+
+
+def test_空のテーブル():
+    store = ColumnStore.from_records([], ["name", "value"])
+    assert len(store) == 0
+    assert list(store.to_dataframe().columns) == ["name", "value"]
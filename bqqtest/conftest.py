@@ -0,0 +1,34 @@
+import pytest
+
+from .table import QueryTest
+
+schema = [
+    {"name": "name", "type": "STRING", "mode": "NULLABLE"},
+    {"name": "value", "type": "INT64", "mode": "NULLABLE"},
+]
+
+
+@pytest.fixture
+def query_test():
+    """``name`` と ``value`` の2列の ``test.table`` をテストデータにした ``QueryTest`` を作る関数
+
+    ``query_test(client, datum, expected, query, params, **kwargs)`` 。
+    datum の省略時は ``[["abc", 1]]`` 。expected を省略すると datum と同じ行を期待する。
+    kwargs は ``QueryTest`` に渡す
+    """
+
+    def make(
+        client,
+        datum: list = None,
+        expected: list = None,
+        query: str = "SELECT * FROM test.table",
+        params: list = None,
+        **kwargs,
+    ):
+        datum = [["abc", 1]] if datum is None else datum
+        tables = {"test.table": {"schema": schema, "datum": datum}}
+        expected = {"schema": schema, "datum": datum if expected is None else expected}
+        query = {"query": query, "params": params or []}
+        return QueryTest(client, expected, tables, query, **kwargs)
+
+    return make
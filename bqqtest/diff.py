@@ -0,0 +1,165 @@
+"""クエリの結果と期待するテーブルとの差分をPython側で取る"""
+import decimal
+import functools
+import json
+
+import numpy as np
+import pandas as pd
+from google.cloud import bigquery
+
+from .encoders import json_value_encoder
+from .types import ArrayType, PrimitiveType, parse_type
+
+# 比較する前に列をそろえる型。ここにない型は値をそろえた文字列にしてから比べる
+# FLOAT64 は欠損値をNaNにして比べる
+_comparable_dtypes = {
+    "INT64": "Int64",
+    "FLOAT64": "float64",
+    "BOOL": "boolean",
+    "STRING": "string",
+}
+
+
+def _timestamp(v):
+    # BigQueryはタイムゾーン付きで返すので、UTCにそろえる。タイムゾーンがなければUTC
+    v = pd.Timestamp(v)
+    if v.tzinfo is not None:
+        v = v.tz_convert("UTC").tz_localize(None)
+    return v.isoformat()
+
+
+# 同じ値をいろいろな表記で書ける型の値をそろえる。ほかの型はロードジョブと同じ値にする
+_primitive_normalizers = {
+    "DATE": lambda v: pd.Timestamp(v).date().isoformat(),
+    "DATETIME": lambda v: pd.Timestamp(v).isoformat(),
+    "TIMESTAMP": _timestamp,
+    "NUMERIC": lambda v: str(decimal.Decimal(str(v)).normalize()),
+}
+
+
+def _nested(v):
+    return json.loads(v) if isinstance(v, str) else v
+
+
+@functools.lru_cache(maxsize=None)
+def _normalizer(parsed):
+    """欠損値ではない値ひとつを、比べられるJSONの値にする関数"""
+    if isinstance(parsed, PrimitiveType):
+        return _primitive_normalizers.get(parsed.name, json_value_encoder(parsed))
+    if isinstance(parsed, ArrayType):
+        element = _normalizer(parsed.element)
+        return lambda v: [None if e is None else element(e) for e in _nested(v)]
+
+    names = [name for name, _ in parsed.fields]
+    normalizers = [_normalizer(typ) for _, typ in parsed.fields]
+
+    def normalize(v):
+        v = _nested(v)
+        if isinstance(v, dict):
+            v = [v.get(name) for name in names]
+        return [None if x is None else n(x) for n, x in zip(normalizers, v)]
+
+    return normalize
+
+
+def _normalized_text(parsed):
+    normalize = _normalizer(parsed)
+    return lambda v: json.dumps(normalize(v), ensure_ascii=False)
+
+
+def hash_rows(df: "pd.DataFrame", types: list):
+    """行ごとのハッシュ値を返す
+
+    列名ではなく列の位置で比べる。EXCEPT DISTINCT と同じ
+
+    DATE、DATETIME、TIMESTAMP、NUMERICなどは、表記やタイムゾーンの違いをそろえてから比べる
+
+    Args:
+        df (pd.DataFrame): テーブル
+        types (list): 列の型。 ``parse_type`` の構文木か、型名の文字列
+
+    Returns:
+        np.ndarray: 行ごとのハッシュ値(uint64)
+    """
+    assert len(df.columns) == len(types), "列の数が一致しません"
+
+    columns = {}
+    for i, typ in enumerate(types):
+        parsed = parse_type(typ.upper()) if isinstance(typ, str) else typ
+        column = df.iloc[:, i]
+        if isinstance(parsed, PrimitiveType) and parsed.name in _comparable_dtypes:
+            column = column.astype(_comparable_dtypes[parsed.name])
+        else:
+            to_text = _normalized_text(parsed)
+            values = column.astype(object)
+            column = values.where(values.notna(), None).map(
+                lambda v: None if v is None else to_text(v)
+            )
+            column = column.astype("string")
+        columns[i] = column.reset_index(drop=True)
+    return pd.util.hash_pandas_object(pd.DataFrame(columns), index=False).to_numpy()
+
+
+def _unmatched(hashes: np.ndarray, others: np.ndarray):
+    """``others`` に対応する行がない行の位置を返す
+
+    同じ行が複数あるときは、出現回数の多い方の余った行を返す
+    """
+    keys = pd.DataFrame(
+        {"h": hashes, "k": pd.Series(hashes).groupby(hashes).cumcount()}
+    )
+    other_keys = pd.DataFrame(
+        {"h": others, "k": pd.Series(others).groupby(others).cumcount()}
+    )
+    matched = pd.MultiIndex.from_frame(keys).isin(pd.MultiIndex.from_frame(other_keys))
+    return np.flatnonzero(~matched)
+
+
+def _records(mark: str, df: "pd.DataFrame", positions: np.ndarray):
+    rows = df.iloc[positions].astype(object)
+    rows = rows.where(rows.notna(), None)
+    return [
+        (int(position) + 1, mark, list(values))
+        for position, values in zip(positions, rows.itertuples(index=False))
+    ]
+
+
+def diff_dataframes(
+    actual: "pd.DataFrame", expected: "pd.DataFrame", types: list, ordered: bool = False
+):
+    """ACTUAL と EXPECTED の差分を取る
+
+    ``QueryLogicTest.diff_query()`` と同じ形のレコードを返す。
+    ACTUAL にだけある行は ``+`` 、 EXPECTED にだけある行は ``-`` になり、
+    ``n`` は各テーブルでの行番号(1始まり)
+
+    Args:
+        actual (pd.DataFrame): クエリの結果
+        expected (pd.DataFrame): 期待するテーブル
+        types (list): 列の型。 ``hash_rows`` を参照
+        ordered (bool): Trueなら行の順番も比べる。Falseなら多重集合として比べる
+
+    Returns:
+        list: ``bigquery.Row`` のリスト。 ``n`` の昇順
+    """
+    actual_hashes = hash_rows(actual, types)
+    expected_hashes = hash_rows(expected, types)
+
+    if ordered:
+        length = min(len(actual_hashes), len(expected_hashes))
+        different = np.flatnonzero(actual_hashes[:length] != expected_hashes[:length])
+        plus = np.concatenate([different, np.arange(length, len(actual_hashes))])
+        minus = np.concatenate([different, np.arange(length, len(expected_hashes))])
+    else:
+        plus = _unmatched(actual_hashes, expected_hashes)
+        minus = _unmatched(expected_hashes, actual_hashes)
+
+    records = _records("+", actual, plus) + _records("-", expected, minus)
+    records.sort(key=lambda record: record[0])
+
+    names = ["mark"] + list(actual.columns) + ["n"]
+    field_to_index = {name: i for i, name in enumerate(names)}
+    return [
+        bigquery.Row(tuple([mark] + values + [n]), field_to_index)
+        for n, mark, values in records
+    ]
@@ -0,0 +1,103 @@
+import pandas as pd
+from google.cloud import bigquery
+
+from .diff import diff_dataframes, hash_rows
+
+types = ["string", "int64"]
+field_to_index = {"mark": 0, "name": 1, "value": 2, "n": 3}
+
+
+def frame(records):
+    return pd.DataFrame.from_records(records, columns=["name", "value"])
+
+
+def test_同じ行なら順番が違っても差分はない():
+    actual = frame([["a", 1], ["b", 2]])
+    expected = frame([["b", 2], ["a", 1]])
+    assert diff_dataframes(actual, expected, types) == []
+
+
+def test_重複した行は回数も比べる():
+    actual = frame([["a", 1], ["a", 1], ["b", 2]])
+    expected = frame([["a", 1], ["b", 2], ["c", 3]])
+    assert diff_dataframes(actual, expected, types) == [
+        bigquery.Row(("+", "a", 1, 2), field_to_index),
+        bigquery.Row(("-", "c", 3, 3), field_to_index),
+    ]
+
+
+def test_orderedなら行の順番も比べる():
+    actual = frame([["b", 2], ["a", 1], ["c", 3]])
+    expected = frame([["a", 1], ["b", 2]])
+    assert diff_dataframes(actual, expected, types, ordered=True) == [
+        bigquery.Row(("+", "b", 2, 1), field_to_index),
+        bigquery.Row(("-", "a", 1, 1), field_to_index),
+        bigquery.Row(("+", "a", 1, 2), field_to_index),
+        bigquery.Row(("-", "b", 2, 2), field_to_index),
+        bigquery.Row(("+", "c", 3, 3), field_to_index),
+    ]
+
+
+def test_欠損値と型の違いをそろえて比べる():
+    actual = pd.DataFrame(
+        {
+            "name": pd.Series(["a", None], dtype=object),
+            "value": pd.array([1, None], "Int64"),
+        }
+    )
+    expected = frame([["a", 1.0], [None, None]])
+    assert list(hash_rows(actual, types)) == list(hash_rows(expected, types))
+    assert diff_dataframes(actual, expected, types) == []
+
+
+def test_差分の欠損値はNoneになる():
+    actual = frame([["a", None]])
+    expected = frame([])
+    assert diff_dataframes(actual, expected, types) == [
+        bigquery.Row(("+", "a", None, 1), field_to_index),
+    ]
+
+
+def test_日時と数値は表記とタイムゾーンをそろえて比べる():
+    import datetime
+    import decimal
+
+    from .types import parse_type
+
+    types = [
+        parse_type(t)
+        for t in ["TIMESTAMP", "DATETIME", "DATE", "NUMERIC", "STRUCT<t TIMESTAMP>"]
+    ]
+    utc = datetime.timezone.utc
+    jst = datetime.timezone(datetime.timedelta(hours=9))
+    actual = pd.DataFrame(
+        {
+            "ts": [datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=utc)],
+            "dt": [datetime.datetime(2020, 1, 2, 3, 4, 5)],
+            "d": [datetime.date(2020, 1, 2)],
+            "n": [decimal.Decimal("1.10")],
+            "s": [{"t": datetime.datetime(2020, 1, 2, 12, 0, tzinfo=jst)}],
+        }
+    )
+    expected = pd.DataFrame(
+        {
+            "ts": ["2020-01-02 03:04:05"],
+            "dt": ["2020-01-02T03:04:05"],
+            "d": ["2020-01-02"],
+            "n": ["1.1"],
+            "s": [["2020-01-02 03:00:00+00:00"]],
+        }
+    )
+    assert diff_dataframes(actual, expected, types) == []
+
+    expected.loc[0, "ts"] = "2020-01-02 03:04:06"
+    assert len(diff_dataframes(actual, expected, types)) == 2
+
+
+def test_FLOAT64の欠損値をそろえて比べる():
+    types = ["string", "float64"]
+    actual = frame([["a", None], ["b", 0.5]])
+    expected = pd.DataFrame(
+        {"name": ["a", "b"], "value": pd.Series([float("nan"), 0.5], dtype=object)}
+    )
+    assert diff_dataframes(actual, expected, types) == []
@@ -0,0 +1,283 @@
+"""スキーマの型に合わせて値をSQLのリテラルにする
+
+型の構文木ごとに、値ひとつをリテラルにする関数を一度だけ組み立てる。
+列の値は同じ関数で変換するので、値ごとに型で分岐しない。欠損値(None)は ``null`` にする。
+ロードジョブのために、値をJSONにできる値にする関数も同じように組み立てる。
+``TO_JSON_STRING`` で文字列にした値を元の型に戻す関数もある
+"""
+import base64
+import datetime
+import decimal
+import functools
+import json
+import math
+import re
+
+from .types import ArrayType, PrimitiveType, StructType
+
+
+def escape(s: str, quote: str = '"'):
+    """文字列リテラルの中身としてエスケープする"""
+    if "\\" not in s and quote not in s and "\n" not in s and "\r" not in s:
+        return s
+    return (
+        s.replace("\\", "\\\\")
+        .replace(quote, "\\" + quote)
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def _string(v):
+    return f'"{escape(v)}"' if type(v) is str else str(v)
+
+
+def _bytes(v):
+    if isinstance(v, str):
+        v = v.encode("utf-8")
+    body = "".join(
+        chr(b) if 0x20 <= b < 0x7F and b not in b'"\\' else f"\\x{b:02x}" for b in v
+    )
+    return f'b"{body}"'
+
+
+def _float(v):
+    if math.isinf(v) or math.isnan(v):
+        return f"CAST('{v}' AS FLOAT64)"
+    return str(v)
+
+
+def _typed(keyword: str, to_text):
+    def encode(v):
+        text = escape(to_text(v), quote="'")
+        return f"{keyword} '{text}'"
+
+    return encode
+
+
+def _date_text(v):
+    if isinstance(v, datetime.datetime):
+        v = v.date()
+    return v.isoformat() if isinstance(v, datetime.date) else str(v)
+
+
+def _datetime_text(v):
+    if isinstance(v, datetime.datetime):
+        return v.isoformat(sep=" ")
+    return v.isoformat() if isinstance(v, (datetime.date, datetime.time)) else str(v)
+
+
+_primitive_encoders = {
+    "INT64": lambda v: str(int(v)),
+    "FLOAT64": _float,
+    "BOOL": str,
+    "STRING": _string,
+    "BYTES": _bytes,
+    "NUMERIC": _typed("NUMERIC", str),
+    "DATE": _typed("DATE", _date_text),
+    "DATETIME": _typed("DATETIME", _datetime_text),
+    "TIME": _typed("TIME", _datetime_text),
+    "TIMESTAMP": _typed("TIMESTAMP", _datetime_text),
+    "GEOGRAPHY": lambda v: "ST_GEOGFROMTEXT('" + escape(str(v), quote="'") + "')",
+}
+
+
+def _nested(v):
+    # CSVなどから読んだ ARRAY や STRUCT の値はJSONの文字列で書く
+    return json.loads(v) if isinstance(v, str) else v
+
+
+def _array(element):
+    def encode(v):
+        return (
+            "["
+            + ",".join(["null" if e is None else element(e) for e in _nested(v)])
+            + "]"
+        )
+
+    return encode
+
+
+def _struct(fields):
+    names = [name for name, _ in fields]
+    encoders = [value_encoder(typ) for _, typ in fields]
+
+    def encode(v):
+        v = _nested(v)
+        if isinstance(v, dict):
+            v = [v.get(name) for name in names]
+        assert len(v) == len(encoders), f"STRUCTのフィールドの数が違います: {v}"
+        literals = ["null" if x is None else e(x) for e, x in zip(encoders, v)]
+        return "STRUCT(" + ",".join(literals) + ")"
+
+    return encode
+
+
+@functools.lru_cache(maxsize=None)
+def value_encoder(parsed):
+    """欠損値ではない値ひとつをリテラルにする関数
+
+    Args:
+        parsed: ``bqqtest.types.parse_type`` の構文木
+
+    Returns:
+        function: 値を受け取ってリテラルの文字列を返す関数
+    """
+    if isinstance(parsed, PrimitiveType):
+        return _primitive_encoders[parsed.name]
+    if isinstance(parsed, ArrayType):
+        return _array(value_encoder(parsed.element))
+    assert isinstance(parsed, StructType)
+    return _struct(parsed.fields)
+
+
+def encode_values(values: list, parsed):
+    """値のリストをリテラルのリストにする。欠損値はNoneで表す"""
+    encode = value_encoder(parsed)
+    return ["null" if v is None else encode(v) for v in values]
+
+
+def _json_float(v):
+    # JSONには非有限の値がないので、BigQueryが読める文字列にする
+    v = float(v)
+    if math.isnan(v):
+        return "NaN"
+    if math.isinf(v):
+        return "Infinity" if v > 0 else "-Infinity"
+    return v
+
+
+def _json_bytes(v):
+    if isinstance(v, str):
+        v = v.encode("utf-8")
+    return base64.b64encode(v).decode("ascii")
+
+
+_primitive_json_encoders = {
+    "INT64": int,
+    "FLOAT64": _json_float,
+    "BOOL": bool,
+    "STRING": lambda v: v if type(v) is str else str(v),
+    "BYTES": _json_bytes,
+    "NUMERIC": str,
+    "DATE": _date_text,
+    "DATETIME": _datetime_text,
+    "TIME": _datetime_text,
+    "TIMESTAMP": _datetime_text,
+    "GEOGRAPHY": str,
+}
+
+
+def _json_array(element):
+    def encode(v):
+        return [None if e is None else element(e) for e in _nested(v)]
+
+    return encode
+
+
+def _json_struct(fields):
+    names = [name for name, _ in fields]
+    encoders = [json_value_encoder(typ) for _, typ in fields]
+
+    def encode(v):
+        v = _nested(v)
+        if isinstance(v, dict):
+            v = [v.get(name) for name in names]
+        assert len(v) == len(encoders), f"STRUCTのフィールドの数が違います: {v}"
+        return {
+            name: None if x is None else e(x) for name, e, x in zip(names, encoders, v)
+        }
+
+    return encode
+
+
+@functools.lru_cache(maxsize=None)
+def json_value_encoder(parsed):
+    """欠損値ではない値ひとつを、ロードジョブのJSONにできる値にする関数
+
+    DATE、DATETIME、TIME、TIMESTAMPはISO 8601の文字列、NUMERICは文字列、
+    BYTESはBase64の文字列にする
+
+    Args:
+        parsed: ``bqqtest.types.parse_type`` の構文木
+
+    Returns:
+        function: 値を受け取ってJSONにできる値を返す関数
+    """
+    if isinstance(parsed, PrimitiveType):
+        return _primitive_json_encoders[parsed.name]
+    if isinstance(parsed, ArrayType):
+        return _json_array(json_value_encoder(parsed.element))
+    assert isinstance(parsed, StructType)
+    return _json_struct(parsed.fields)
+
+
+_fraction = re.compile(r"\.(\d+)")
+
+
+def _padded(text: str):
+    # Python 3.7 の fromisoformat は小数点以下が3桁か6桁のときだけ読める
+    return _fraction.sub(lambda m: "." + m.group(1)[:6].ljust(6, "0"), text, count=1)
+
+
+def _from_json_timestamp(v):
+    parsed = datetime.datetime.fromisoformat(_padded(v).replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        return parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed.astimezone(datetime.timezone.utc)
+
+
+_primitive_json_decoders = {
+    "INT64": int,
+    "FLOAT64": float,
+    "BOOL": bool,
+    "STRING": str,
+    "BYTES": base64.b64decode,
+    "NUMERIC": lambda v: decimal.Decimal(str(v)),
+    "DATE": datetime.date.fromisoformat,
+    "DATETIME": lambda v: datetime.datetime.fromisoformat(_padded(v)),
+    "TIME": lambda v: datetime.time.fromisoformat(_padded(v)),
+    "TIMESTAMP": _from_json_timestamp,
+    "GEOGRAPHY": str,
+}
+
+
+def _from_json_array(element):
+    def decode(v):
+        return [None if e is None else element(e) for e in v]
+
+    return decode
+
+
+def _from_json_struct(fields):
+    decoders = [json_value_decoder(typ) for _, typ in fields]
+
+    def decode(v):
+        # 名前のないフィールドもあるので、キーはJSONのものを使い、型は順番で対応させる
+        return {
+            name: None if x is None else d(x)
+            for (name, x), d in zip(v.items(), decoders)
+        }
+
+    return decode
+
+
+@functools.lru_cache(maxsize=None)
+def json_value_decoder(parsed):
+    """``TO_JSON_STRING`` の値ひとつを、BigQueryのクライアントが返す型の値に戻す関数
+
+    JSONの数値は ``json.loads(..., parse_float=decimal.Decimal)`` で読んでおくと、
+    NUMERICの桁が落ちない。FLOAT64の非有限の値は "NaN" などの文字列でも読める
+
+    Args:
+        parsed: ``bqqtest.types.parse_type`` の構文木
+
+    Returns:
+        function: JSONから読んだ欠損値ではない値を受け取って、元の型の値を返す関数
+    """
+    if isinstance(parsed, PrimitiveType):
+        return _primitive_json_decoders[parsed.name]
+    if isinstance(parsed, ArrayType):
+        return _from_json_array(json_value_decoder(parsed.element))
+    assert isinstance(parsed, StructType)
+    return _from_json_struct(parsed.fields)
@@ -0,0 +1,120 @@
+import datetime
+import decimal
+
+import pytest
+
+from .encoders import encode_values, escape, json_value_decoder
+from .types import parse_type
+
+golden_params = {
+    "INT64": ("INT64", [1, 2.0, None], ["1", "2", "null"]),
+    "FLOAT64": (
+        "FLOAT64",
+        [0.5, 1e16, None, float("inf"), float("nan")],
+        ["0.5", "1e+16", "null", "CAST('inf' AS FLOAT64)", "CAST('nan' AS FLOAT64)"],
+    ),
+    "BOOL": ("BOOL", [True, False], ["True", "False"]),
+    "STRING": (
+        "STRING",
+        ['a"b', "c\\d", "改\n行\r", 3],
+        [r'"a\"b"', r'"c\\d"', r'"改\n行\r"', "3"],
+    ),
+    "BYTES": (
+        "BYTES",
+        [b"ab\x00\xff", 'q"\\'],
+        [r'b"ab\x00\xff"', r'b"q\x22\x5c"'],
+    ),
+    "NUMERIC": (
+        "NUMERIC",
+        [decimal.Decimal("1.10"), "2", 3],
+        ["NUMERIC '1.10'", "NUMERIC '2'", "NUMERIC '3'"],
+    ),
+    "DATE": (
+        "DATE",
+        [datetime.date(2020, 1, 2), datetime.datetime(2020, 1, 2, 3), "2020-01-02"],
+        ["DATE '2020-01-02'"] * 3,
+    ),
+    "DATETIME": (
+        "DATETIME",
+        [datetime.datetime(2020, 1, 2, 3, 4, 5, 6), "2020-01-02 03:04:05"],
+        ["DATETIME '2020-01-02 03:04:05.000006'", "DATETIME '2020-01-02 03:04:05'"],
+    ),
+    "TIME": ("TIME", [datetime.time(12, 34)], ["TIME '12:34:00'"]),
+    "TIMESTAMP": (
+        "TIMESTAMP",
+        [
+            datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc),
+            "2020-01-02 03:04:05 Asia/Tokyo",
+        ],
+        [
+            "TIMESTAMP '2020-01-02 03:04:05+00:00'",
+            "TIMESTAMP '2020-01-02 03:04:05 Asia/Tokyo'",
+        ],
+    ),
+    "GEOGRAPHY": (
+        "GEOGRAPHY",
+        ["POINT(1 2)"],
+        ["ST_GEOGFROMTEXT('POINT(1 2)')"],
+    ),
+    "ARRAY": (
+        "ARRAY<DATE>",
+        [[datetime.date(2020, 1, 2), None], [], "[\"2020-01-03\"]"],
+        ["[DATE '2020-01-02',null]", "[]", "[DATE '2020-01-03']"],
+    ),
+    "STRUCT": (
+        "STRUCT<a INT64, b ARRAY<STRING>>",
+        [{"a": 1, "b": ["x", 'y"']}, [None, None], '{"a": 2}'],
+        [
+            r'STRUCT(1,["x","y\""])',
+            "STRUCT(null,null)",
+            "STRUCT(2,null)",
+        ],
+    ),
+    "ARRAYの中のSTRUCT": (
+        "ARRAY<STRUCT<t TIMESTAMP, n NUMERIC>>",
+        [[{"t": "2020-01-02 00:00:00", "n": "1.5"}]],
+        ["[STRUCT(TIMESTAMP '2020-01-02 00:00:00',NUMERIC '1.5')]"],
+    ),
+}
+
+
+@pytest.mark.parametrize(
+    "t, values, want",
+    list(golden_params.values()),
+    ids=list(golden_params.keys()),
+)
+def test_型に合わせたリテラルを作る(t, values, want):
+    assert encode_values(values, parse_type(t)) == want
+
+
+def test_エスケープ():
+    assert escape("it's \"x\"\\", quote="'") == "it\\'s \"x\"\\\\"
+
+
+def test_STRUCTのフィールドの数が違うとAssertionError():
+    with pytest.raises(AssertionError):
+        encode_values([[1]], parse_type("STRUCT<a INT64, b INT64>"))
+
+
+@pytest.mark.parametrize(
+    "t, value, want",
+    **{
+        "argvalues": [
+            (
+                "DATETIME",
+                "2020-01-02T03:04:05.25",
+                datetime.datetime(2020, 1, 2, 3, 4, 5, 250000),
+            ),
+            ("TIME", "03:04:05", datetime.time(3, 4, 5)),
+            ("FLOAT64", "-Infinity", float("-inf")),
+            (
+                "ARRAY<STRUCT<d DATE, BYTES>>",
+                [{"d": "2020-01-02", "": "YQ=="}, None],
+                [{"d": datetime.date(2020, 1, 2), "": b"a"}, None],
+            ),
+        ],
+        "ids": ["DATETIME", "TIME", "FLOAT64", "ARRAYの中のSTRUCT"],
+    },
+)
+def test_TO_JSON_STRINGの値を型に合わせて戻す(t, value, want):
+    assert json_value_decoder(parse_type(t))(value) == want
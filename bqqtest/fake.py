@@ -0,0 +1,200 @@
+"""BigQueryに接続せずにテストするためのフェイククライアント"""
+import json
+import re
+import threading
+import time
+
+from .loaders import import_pyarrow
+
+
+class FakeRowIterator:
+    """``bigquery.table.RowIterator`` の代わり
+
+    Args:
+        rows (list): 返す行
+        total_rows (int): 取得を打ち切る前の行数。省略時は ``rows`` の行数
+    """
+
+    def __init__(self, rows: list, total_rows: int = None):
+        self._rows = list(rows)
+        self.total_rows = len(self._rows) if total_rows is None else total_rows
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def to_dataframe(self, **kwargs):
+        import pandas as pd
+
+        columns = list(self._rows[0].keys()) if self._rows else None
+        return pd.DataFrame.from_records(
+            [tuple(row) for row in self._rows], columns=columns
+        )
+
+    def to_arrow(self, **kwargs):
+        pyarrow = import_pyarrow()
+        return pyarrow.Table.from_pandas(self.to_dataframe(), preserve_index=False)
+
+
+# クエリの中でバッククォートで囲んだ ``project.dataset.table``
+_table_id = re.compile(r"`([\w-]+\.\w+\.\w+)`")
+
+
+class FakeQueryJob:
+    """``bigquery.QueryJob`` の代わり
+
+    クエリの中でバッククォートで囲んだ ``project.dataset.table`` を、
+    ``referenced_tables`` の参照したテーブルにする
+    """
+
+    def __init__(
+        self, client, job_id: str, query: str, job_config, rows: list, total_bytes
+    ):
+        from google.cloud import bigquery
+
+        self.job_id = job_id
+        self.query = query
+        self.job_config = job_config
+        self.total_bytes_processed = total_bytes
+        self.referenced_tables = [
+            bigquery.TableReference.from_string(table_id)
+            for table_id in sorted(set(_table_id.findall(query)))
+        ]
+        self.total_bytes_billed = 0
+        self.slot_millis = 0
+        self.cache_hit = False
+        self._client = client
+        self._rows = rows
+        self._done = False
+        self._started = time.monotonic()
+        self.result_called = 0
+        self.done_called = 0
+        self.cancelled = False
+
+    def _complete(self):
+        if not self._done:
+            self._done = True
+            self._client._finish()
+
+    def done(self):
+        """ジョブを作ってから ``latency`` 秒たっていればTrue。待たずにすぐ返る"""
+        self.done_called += 1
+        if time.monotonic() - self._started >= self._client.latency:
+            self._complete()
+        return self._done
+
+    def result(self, max_results: int = None):
+        self.result_called += 1
+        if self.cancelled:
+            raise RuntimeError(f"{self.job_id} はキャンセルされました")
+        if not self._done:
+            time.sleep(
+                max(0.0, self._started + self._client.latency - time.monotonic())
+            )
+            self._complete()
+        return FakeRowIterator(self._rows[:max_results], total_rows=len(self._rows))
+
+    def cancel(self):
+        if not self._done:
+            self.cancelled = True
+            self._complete()
+        return True
+
+
+class FakeLoadJob:
+    """``bigquery.LoadJob`` の代わり"""
+
+    def __init__(self, job_id: str, rows: list, destination: str, job_config):
+        self.job_id = job_id
+        self.rows = rows
+        self.destination = destination
+        self.job_config = job_config
+        self.output_bytes = len(json.dumps(rows))
+
+    def result(self):
+        return self
+
+
+class FakeClient:
+    """発行されたジョブを記録するフェイククライアント
+
+    ``use_query_cache`` を指定したジョブは、以前と同じクエリならキャッシュから返す。
+    そのジョブは ``cache_hit`` がTrueになり、 ``latency`` を待たずに完了する
+
+    Args:
+        handler (callable): ``handler(query, job_config)`` が
+            ``(rows, total_bytes_processed)`` を返す。省略時は結果なし、走査量ゼロ
+        latency (float): クエリジョブの完了までにかかる秒数
+        project (str): プロジェクト名
+    """
+
+    _job_class = FakeQueryJob
+
+    def __init__(self, handler=None, latency: float = 0.0, project="fake-project"):
+        self._handler = handler or (lambda query, job_config: ([], 0))
+        self._lock = threading.Lock()
+        self.latency = latency
+        self.project = project
+        self.jobs = []
+        self.load_jobs = []
+        self.deleted_tables = []
+        self.running_jobs = 0
+        self.max_running_jobs = 0
+        self._cached_queries = set()
+
+    def query(self, query: str, job_config=None):
+        rows, total_bytes = self._handler(query, job_config)
+        with self._lock:
+            job = self._job_class(
+                self, f"fake_job_{len(self.jobs)}", query, job_config, rows, total_bytes
+            )
+            self.jobs.append(job)
+            dry_run = job_config is not None and job_config.dry_run
+            use_cache = job_config is not None and job_config.use_query_cache
+            if use_cache and not dry_run:
+                key = (query, repr(job_config.query_parameters))
+                job.cache_hit = key in self._cached_queries
+                self._cached_queries.add(key)
+            if dry_run or job.cache_hit:
+                # ドライランとキャッシュから返すジョブはすぐに完了する
+                job._done = True
+            else:
+                self.running_jobs += 1
+                self.max_running_jobs = max(self.max_running_jobs, self.running_jobs)
+        return job
+
+    def _finish(self):
+        with self._lock:
+            self.running_jobs -= 1
+
+    def load_table_from_json(self, json_rows, destination: str, job_config=None):
+        job = FakeLoadJob(
+            f"fake_load_job_{len(self.load_jobs)}",
+            list(json_rows),
+            destination,
+            job_config,
+        )
+        self.load_jobs.append(job)
+        return job
+
+    def delete_table(self, table, not_found_ok: bool = False):
+        self.deleted_tables.append(table)
+
+
+class FakeAsyncQueryJob(FakeQueryJob):
+    """``done`` がコルーチン関数のジョブ。 ``result`` は完了後に呼ぶので同期のまま"""
+
+    async def done(self):
+        return super().done()
+
+
+class FakeAsyncClient(FakeClient):
+    """``query`` がコルーチン関数のフェイククライアント
+
+    ``arun`` がスレッドプールを使わずにジョブを発行して待つことを確かめる。
+    引数と記録する内容は ``FakeClient`` と同じ
+    """
+
+    _job_class = FakeAsyncQueryJob
+
+    async def query(self, query: str, job_config=None):
+        return super().query(query, job_config)
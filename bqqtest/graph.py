@@ -0,0 +1,61 @@
+"""WITH句に並べるテーブルどうしの参照関係"""
+
+
+class DependencyGraph:
+    """テーブル名から、そのテーブルが参照するテーブル名のリストへの辞書で表すグラフ
+
+    ``root`` から辿れないテーブルはクエリの結果に影響しないので、WITH句から省ける
+
+    Args:
+        edges (dict): テーブル名から参照するテーブル名のリストへの辞書。
+            辞書の順番がWITH句に並べる順番になる
+        root (str): 結果を返すテーブルの名前。ふつうは ``ACTUAL``
+    """
+
+    _edges = {}
+    _root = ""
+
+    def __init__(self, edges: dict, root: str):
+        assert root in edges, f"{root} がグラフにありません"
+        self._edges = {name: list(references) for name, references in edges.items()}
+        self._root = root
+
+    def nodes(self):
+        return list(self._edges)
+
+    def root(self):
+        return self._root
+
+    def references(self, name: str):
+        """``name`` が直接参照するテーブル名のリスト"""
+        return list(self._edges[name])
+
+    def reachable(self):
+        """``root`` から辿れるテーブル名の集合。 ``root`` 自身を含む"""
+        reached = {self._root}
+        stack = [self._root]
+        while stack:
+            for reference in self._edges[stack.pop()]:
+                if reference in self._edges and reference not in reached:
+                    reached.add(reference)
+                    stack.append(reference)
+        return reached
+
+    def unreachable(self):
+        """``root`` から辿れないテーブル名のリスト"""
+        reached = self.reachable()
+        return [name for name in self._edges if name not in reached]
+
+    def pruned(self):
+        """``root`` から辿れるテーブルだけを残したグラフ"""
+        reached = self.reachable()
+        return DependencyGraph(
+            {name: refs for name, refs in self._edges.items() if name in reached},
+            self._root,
+        )
+
+    def to_dict(self):
+        return {name: list(references) for name, references in self._edges.items()}
+
+    def __repr__(self):
+        return f"DependencyGraph({self.to_dict()!r}, root={self._root!r})"
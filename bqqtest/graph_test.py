@@ -0,0 +1,34 @@
+import pytest
+
+from .graph import DependencyGraph
+
+edges = {
+    "t1": [],
+    "t2": [],
+    "a": ["t1"],
+    "b": ["a"],
+    "dead": ["t2"],
+    "ACTUAL": ["b"],
+}
+
+
+def test_rootから辿れるテーブルを返す():
+    graph = DependencyGraph(edges, "ACTUAL")
+    assert graph.reachable() == {"ACTUAL", "b", "a", "t1"}
+    assert graph.unreachable() == ["t2", "dead"]
+
+
+def test_prunedは辿れるテーブルだけを順番を保って残す():
+    graph = DependencyGraph(edges, "ACTUAL").pruned()
+    assert graph.nodes() == ["t1", "a", "b", "ACTUAL"]
+    assert graph.references("ACTUAL") == ["b"]
+
+
+def test_循環や自己参照があっても止まる():
+    graph = DependencyGraph({"a": ["a", "b"], "b": ["a"], "ACTUAL": ["a"]}, "ACTUAL")
+    assert graph.reachable() == {"ACTUAL", "a", "b"}
+
+
+def test_rootがなければAssertionError():
+    with pytest.raises(AssertionError):
+        DependencyGraph({"a": []}, "ACTUAL")
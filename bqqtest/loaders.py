@@ -0,0 +1,263 @@
+"""テストデータのファイルを少しずつ読み込む
+
+CSV、JSON(レコードの配列)、改行区切りのJSON、それぞれのgzip圧縮とParquetに対応する。
+どの形式も ``chunk_size`` 行ずつ読むので、ファイル全体をメモリに載せない
+"""
+import csv
+import gzip
+import importlib
+import json
+from pathlib import Path
+
+from .columns import _to_python
+
+# 拡張子からファイル形式への対応。 .gz は圧縮を表し、その前の拡張子で形式を決める
+FORMATS = {
+    ".csv": "csv",
+    ".json": "json",
+    ".ndjson": "ndjson",
+    ".jsonl": "ndjson",
+    ".parquet": "parquet",
+}
+
+# pyarrow がないときのエラーメッセージ
+PYARROW_REQUIRED = "pyarrow が必要です。 pip install bqqtest[pyarrow] でインストールしてください"
+
+# JSONの配列を読むときに一度に読む文字数
+_read_size = 1024 * 1024
+
+
+def file_format(filename: str):
+    """ファイル形式と、gzipで圧縮されているかを返す
+
+    Raises:
+        ValueError: 未対応のファイル形式
+    """
+    suffixes = [s.lower() for s in Path(filename).suffixes]
+    compressed = bool(suffixes) and suffixes[-1] == ".gz"
+    if compressed:
+        suffixes = suffixes[:-1]
+    if not suffixes or suffixes[-1] not in FORMATS:
+        raise ValueError(f"{filename} は未対応のファイル形式")
+    if compressed and FORMATS[suffixes[-1]] == "parquet":
+        raise ValueError(f"{filename} は未対応のファイル形式。Parquetは内部で圧縮する")
+    return FORMATS[suffixes[-1]], compressed
+
+
+def _open(filename: str, compressed: bool):
+    if compressed:
+        return gzip.open(filename, "rt", encoding="utf-8", newline="")
+    return open(filename, "r", encoding="utf-8", newline="")
+
+
+def _iter_json_array(f):
+    """JSONの配列の要素をひとつずつ返す。配列全体は読み込まない"""
+    decoder = json.JSONDecoder()
+    buffer, position, eof = "", 0, False
+
+    def fill():
+        nonlocal buffer, position, eof
+        more = f.read(_read_size)
+        eof = more == ""
+        buffer, position = buffer[position:] + more, 0
+
+    def skip(characters):
+        nonlocal position
+        while True:
+            while position < len(buffer) and buffer[position] in characters:
+                position += 1
+            if position < len(buffer) or eof:
+                return
+            fill()
+
+    fill()
+    skip(" \t\r\n")
+    if buffer[position : position + 1] != "[":
+        raise ValueError("JSONファイルはレコードの配列にしてください")
+    position += 1
+
+    while True:
+        skip(" \t\r\n,")
+        if position >= len(buffer):
+            raise ValueError("JSONの配列が閉じていません")
+        if buffer[position] == "]":
+            return
+        try:
+            value, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            fill()
+            continue
+        if end == len(buffer) and not eof:
+            # 数値がバッファの末尾で切れているかもしれないので読み直す
+            fill()
+            continue
+        position = end
+        yield value
+
+
+class RecordValidator:
+    """レコードを列の順番のリストにそろえ、スキーマと照らし合わせる
+
+    Args:
+        names (list): 列名
+        types (list): 列の型名(小文字)
+        source (str): エラーメッセージに使うファイル名
+    """
+
+    # Pythonの値として受け付ける型
+    _python_types = {
+        "int64": (int,),
+        "float64": (int, float),
+        "bool": (bool,),
+        "string": (str,),
+    }
+
+    def __init__(self, names: list, types: list, source: str = ""):
+        self._names = list(names)
+        self._types = list(types)
+        self._index = {name: i for i, name in enumerate(names)}
+        self._source = source
+
+    def __call__(self, record, n: int):
+        """``n`` 行目のレコードを検証して、列の順番のリストにする"""
+        if isinstance(record, dict):
+            unknown = [key for key in record if key not in self._index]
+            if unknown:
+                self._error(n, f"スキーマにない列 {unknown} があります")
+            record = [record.get(name) for name in self._names]
+        elif isinstance(record, (list, tuple)):
+            if len(record) != len(self._names):
+                self._error(
+                    n, f"列の数が {len(record)} で、スキーマの {len(self._names)} と違います"
+                )
+            record = list(record)
+        else:
+            self._error(n, "レコードはリストか辞書にしてください")
+
+        for name, typ, value in zip(self._names, self._types, record):
+            expected = self._python_types.get(typ)
+            if value is None or expected is None:
+                continue
+            if not isinstance(value, expected) or (
+                typ != "bool" and isinstance(value, bool)
+            ):
+                self._error(n, f"{name} の値 {value!r} は {typ.upper()} ではありません")
+        return record
+
+    def _error(self, n: int, message: str):
+        raise ValueError(f"{self._source} の {n} 行目: {message}")
+
+
+def _chunked(records, chunk_size: int):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _iter_csv(filename: str, compressed: bool, names: list, types: list):
+    with _open(filename, compressed) as f:
+        for n, row in enumerate(csv.reader(f), 1):
+            if not row:
+                continue
+            if len(row) != len(names):
+                raise ValueError(
+                    f"{filename} の {n} 行目: 列の数が {len(row)} で、"
+                    f"スキーマの {len(names)} と違います"
+                )
+            try:
+                yield n, [_to_python(value, typ) for value, typ in zip(row, types)]
+            except ValueError as e:
+                raise ValueError(f"{filename} の {n} 行目: {e}") from e
+
+
+def _iter_json(filename: str, compressed: bool):
+    with _open(filename, compressed) as f:
+        yield from enumerate(_iter_json_array(f), 1)
+
+
+def _iter_ndjson(filename: str, compressed: bool):
+    with _open(filename, compressed) as f:
+        for n, line in enumerate(f, 1):
+            if line.strip():
+                yield n, json.loads(line)
+
+
+def import_pyarrow(name: str = "pyarrow"):
+    """pyarrow のモジュールを読み込む。入っていなければ入れ方を書いた ImportError にする"""
+    try:
+        return importlib.import_module(name)
+    except ImportError as e:
+        raise ImportError(PYARROW_REQUIRED) from e
+
+
+def _iter_parquet(filename: str, names: list, chunk_size: int):
+    pq = import_pyarrow("pyarrow.parquet")
+
+    parquet = pq.ParquetFile(filename)
+    missing = [name for name in names if name not in parquet.schema_arrow.names]
+    if missing:
+        raise ValueError(f"{filename} にスキーマの列 {missing} がありません")
+
+    n = 0
+    for batch in parquet.iter_batches(batch_size=chunk_size, columns=names):
+        for row in zip(*[column.to_pylist() for column in batch.columns]):
+            n += 1
+            yield n, list(row)
+
+
+def iter_record_chunks(
+    filename: str, names: list, types: list, chunk_size: int = 10000
+):
+    """ファイルから ``chunk_size`` 行ずつレコードを読む
+
+    Args:
+        filename (str): ファイルパス
+        names (list): スキーマの列名
+        types (list): スキーマの列の型名(小文字)
+        chunk_size (int): 一度に返す行数
+
+    Yields:
+        list: 列の順番にそろえたレコードのリスト。空のリストは返さない
+
+    Raises:
+        ValueError: 未対応のファイル形式か、スキーマと合わないレコードがある
+    """
+    assert chunk_size > 0
+    fmt, compressed = file_format(filename)
+    if fmt == "csv":
+        numbered = _iter_csv(filename, compressed, names, types)
+    elif fmt == "json":
+        numbered = _iter_json(filename, compressed)
+    elif fmt == "ndjson":
+        numbered = _iter_ndjson(filename, compressed)
+    else:
+        numbered = _iter_parquet(filename, names, chunk_size)
+
+    validate = RecordValidator(names, types, filename)
+    yield from _chunked((validate(record, n) for n, record in numbered), chunk_size)
+
+
+def read_records(filename: str, names: list, types: list):
+    """ファイルのすべてのレコードを読む"""
+    return [
+        record
+        for chunk in iter_record_chunks(filename, names, types)
+        for record in chunk
+    ]
+
+
+def write_records(filename: str, records):
+    """レコード(辞書かリスト)を改行区切りのJSONで書き出す。拡張子が .gz ならgzipで圧縮する"""
+    opener = gzip.open if filename.endswith(".gz") else open
+    with opener(filename, "wt", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False))
+            f.write("\n")
+
@@ -0,0 +1,138 @@
+import gzip
+import json
+import sys
+
+import pytest
+
+from . import loaders
+from .loaders import file_format, iter_record_chunks, read_records, write_records
+
+names = ["name", "value"]
+types = ["string", "int64"]
+
+
+file_format_params = {
+    "CSV": ("a.csv", ("csv", False)),
+    "gzipしたCSV": ("a.csv.gz", ("csv", True)),
+    "JSON": ("a.json", ("json", False)),
+    "NDJSON": ("a.ndjson", ("ndjson", False)),
+    "gzipしたJSONL": ("dir.v1/a.JSONL.gz", ("ndjson", True)),
+    "Parquet": ("a.parquet", ("parquet", False)),
+}
+
+
+@pytest.mark.parametrize(
+    "filename, want",
+    list(file_format_params.values()),
+    ids=list(file_format_params.keys()),
+)
+def test_拡張子からファイル形式を決める(filename, want):
+    assert file_format(filename) == want
+
+
+@pytest.mark.parametrize("filename", ["a.txt", "a.gz", "a.parquet.gz"])
+def test_未対応のファイル形式はValueError(filename):
+    with pytest.raises(ValueError):
+        file_format(filename)
+
+
+def write_text(path, text):
+    opener = gzip.open if str(path).endswith(".gz") else open
+    with opener(path, "wt", encoding="utf-8") as f:
+        f.write(text)
+
+
+records = [["田中", 78], ["小林", None], ['"a,b"', 3]]
+text_params = {
+    "CSV": ("t.csv", '田中,78\n小林,\n"""a,b""",3\n'),
+    "gzipしたCSV": ("t.csv.gz", '田中,78\n小林,\n"""a,b""",3\n'),
+    "JSON": ("t.json", json.dumps(records, ensure_ascii=False, indent=2)),
+    "辞書のJSON": (
+        "t.json",
+        '[{"name": "田中", "value": 78}, {"name": "小林"}, {"name": "\\"a,b\\"", "value": 3}]',
+    ),
+    "NDJSON": (
+        "t.ndjson",
+        '{"name": "田中", "value": 78}\n\n["小林", null]\n{"name": "\\"a,b\\"", "value": 3}\n',
+    ),
+    "gzipしたJSONL": (
+        "t.jsonl.gz",
+        '["田中", 78]\n["小林", null]\n["\\"a,b\\"", 3]\n',
+    ),
+}
+
+
+@pytest.mark.parametrize(
+    "filename, text",
+    list(text_params.values()),
+    ids=list(text_params.keys()),
+)
+def test_どの形式も同じレコードを読む(tmp_path, filename, text):
+    path = str(tmp_path / filename)
+    write_text(path, text)
+
+    assert read_records(path, names, types) == records
+    assert list(iter_record_chunks(path, names, types, chunk_size=2)) == [
+        records[:2],
+        records[2:],
+    ]
+
+
+def test_JSONの配列は少しずつ読む(tmp_path, monkeypatch):
+    path = str(tmp_path / "t.json")
+    many = [[f"名前{i}", i * 1000] for i in range(200)]
+    write_text(path, json.dumps(many, ensure_ascii=False))
+    # 値がバッファの境目で切れても読めること
+    monkeypatch.setattr(loaders, "_read_size", 7)
+
+    assert read_records(path, names, types) == many
+
+
+def test_write_recordsで書いたファイルを読める(tmp_path):
+    path = str(tmp_path / "t.ndjson.gz")
+    write_records(path, [{"name": "a", "value": 1}, {"name": None, "value": 2}])
+
+    assert read_records(path, names, types) == [["a", 1], [None, 2]]
+
+
+invalid_params = {
+    "CSVの列の数が違う": ("t.csv", "a,1\nb\n", "2 行目"),
+    "CSVの値が型と違う": ("t.csv", "a,1\nb,x\n", "2 行目"),
+    "JSONの列の数が違う": ("t.json", '[["a", 1], ["b", 2, 3]]', "2 行目"),
+    "NDJSONにスキーマにない列がある": ("t.ndjson", '{"name": "a", "age": 1}\n', "age"),
+    "NDJSONの値が型と違う": ("t.ndjson", '["a", 1]\n["b", "2"]\n', "2 行目"),
+    "BOOLはINT64ではない": ("t.ndjson", '["a", true]\n', "INT64"),
+    "JSONが配列ではない": ("t.json", '{"name": "a"}', "配列"),
+    "JSONの配列が閉じていない": ("t.json", '[["a", 1]', "閉じて"),
+}
+
+
+@pytest.mark.parametrize(
+    "filename, text, message",
+    list(invalid_params.values()),
+    ids=list(invalid_params.keys()),
+)
+def test_スキーマと合わないファイルはValueError(tmp_path, filename, text, message):
+    path = str(tmp_path / filename)
+    write_text(path, text)
+
+    with pytest.raises(ValueError, match=message):
+        read_records(path, names, types)
+
+
+def test_Parquetを読む(tmp_path):
+    pa = pytest.importorskip("pyarrow")
+    pq = pytest.importorskip("pyarrow.parquet")
+    path = str(tmp_path / "t.parquet")
+    columns = {"value": [78, None, 3], "name": ["田中", "小林", '"a,b"'], "x": [1, 2, 3]}
+    pq.write_table(pa.table(columns), path)
+
+    assert read_records(path, names, types) == records
+    with pytest.raises(ValueError, match="missing"):
+        read_records(path, ["missing"], ["string"])
+
+
+def test_pyarrowがなければextrasを案内する(tmp_path, monkeypatch):
+    monkeypatch.setitem(sys.modules, "pyarrow.parquet", None)
+    with pytest.raises(ImportError, match=r"bqqtest\[pyarrow\]"):
+        read_records(str(tmp_path / "t.parquet"), names, types)
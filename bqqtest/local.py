@@ -0,0 +1,913 @@
+"""QueryLogicTest をBigQueryに接続せずSQLiteで実行する
+
+クエリはBigQueryとSQLiteで結果が同じになる関数、予約語、演算子だけを許して変換する。
+それ以外を含むクエリは ``UnsupportedQueryError`` にして、BigQueryで実行する
+"""
+import operator
+import sqlite3
+
+from google.cloud import bigquery
+
+from .util import tokenize
+
+# BigQueryとSQLiteで結果が同じになる関数。 IF はSQLiteの IIF にする
+SUPPORTED_FUNCTIONS = {
+    "ABS",
+    "AVG",
+    "COALESCE",
+    "COUNT",
+    "IF",
+    "IFNULL",
+    "LENGTH",
+    "MAX",
+    "MIN",
+    "NULLIF",
+    "SUM",
+}
+
+# 集計関数。集計するクエリで、GROUP BY にない列を見つけるのに使う
+AGGREGATE_FUNCTIONS = {"AVG", "COUNT", "MAX", "MIN", "SUM"}
+
+# SQLiteでも同じ意味になるBigQueryの予約語
+SUPPORTED_KEYWORDS = {
+    "ALL",
+    "AND",
+    "AS",
+    "ASC",
+    "BETWEEN",
+    "BY",
+    "CASE",
+    "CROSS",
+    "DESC",
+    "DISTINCT",
+    "ELSE",
+    "END",
+    "EXCEPT",
+    "EXISTS",
+    "FALSE",
+    "FROM",
+    "FULL",
+    "GROUP",
+    "HAVING",
+    "IN",
+    "INNER",
+    "INTERSECT",
+    "IS",
+    "JOIN",
+    "LEFT",
+    "LIKE",
+    "LIMIT",
+    "NOT",
+    "NULL",
+    "NULLS",
+    "ON",
+    "OR",
+    "ORDER",
+    "OUTER",
+    "RIGHT",
+    "SELECT",
+    "THEN",
+    "TRUE",
+    "UNION",
+    "USING",
+    "WHEN",
+    "WHERE",
+    "WITH",
+}
+
+# BigQueryの予約語
+# see: https://cloud.google.com/bigquery/docs/reference/standard-sql/lexical
+RESERVED_KEYWORDS = SUPPORTED_KEYWORDS | {
+    "ANY",
+    "ARRAY",
+    "ASSERT_ROWS_MODIFIED",
+    "AT",
+    "CAST",
+    "COLLATE",
+    "CONTAINS",
+    "CREATE",
+    "CUBE",
+    "CURRENT",
+    "DEFAULT",
+    "DEFINE",
+    "ENUM",
+    "ESCAPE",
+    "EXCLUDE",
+    "EXTRACT",
+    "FETCH",
+    "FOLLOWING",
+    "FOR",
+    "GROUPING",
+    "GROUPS",
+    "HASH",
+    "IF",
+    "IGNORE",
+    "INTERVAL",
+    "INTO",
+    "LATERAL",
+    "LOOKUP",
+    "MERGE",
+    "NATURAL",
+    "NEW",
+    "NO",
+    "OF",
+    "OVER",
+    "PARTITION",
+    "PRECEDING",
+    "PROTO",
+    "QUALIFY",
+    "RANGE",
+    "RECURSIVE",
+    "RESPECT",
+    "ROLLUP",
+    "ROWS",
+    "SET",
+    "SOME",
+    "STRUCT",
+    "TABLESAMPLE",
+    "TO",
+    "TREAT",
+    "UNBOUNDED",
+    "UNNEST",
+    "WINDOW",
+    "WITHIN",
+}
+
+# 関数の呼び出しでなければ書けない語。 SUPPORTED_KEYWORDS にない予約語と、
+# 括弧なしで呼べるBigQueryの関数、SQLiteだけの演算子と隠し列
+UNSUPPORTED_WORDS = (RESERVED_KEYWORDS - SUPPORTED_KEYWORDS) | {
+    "CURRENT_DATE",
+    "CURRENT_DATETIME",
+    "CURRENT_TIME",
+    "CURRENT_TIMESTAMP",
+    "GLOB",
+    "ISNULL",
+    "MATCH",
+    "NOTNULL",
+    "OID",
+    "REGEXP",
+    "ROWID",
+    "_ROWID_",
+}
+
+# SQLiteでも同じ意味になる演算子と記号。
+# INT64同士の除算の結果がBigQueryはFLOAT64、SQLiteは整数になるので / は含めない
+SUPPORTED_SYMBOLS = {
+    "(",
+    ")",
+    ",",
+    ".",
+    ";",
+    "*",
+    "+",
+    "-",
+    "||",
+    "=",
+    "!=",
+    "<>",
+    "<",
+    ">",
+    "<=",
+    ">=",
+}
+
+# SQLiteで扱える列の型
+SUPPORTED_TYPES = {"int64", "float64", "bool", "string"}
+
+# 続けて書くとひとつの演算子になる記号
+_two_char_operators = {"!=", "<>", "<=", ">=", "||", "<<", ">>"}
+
+# SQLiteでは整数の桁あふれが浮動小数点数になるので、BigQueryと同じくエラーにする
+# 関数の呼び出しに置き換える
+_arithmetic_functions = {
+    "+": ("bqqtest_add", operator.add),
+    "-": ("bqqtest_sub", operator.sub),
+    "*": ("bqqtest_mul", operator.mul),
+}
+
+# 予約語ではないが、句の一部で値にならない語
+_clause_words = {"FIRST", "LAST", "OFFSET"}
+
+# SELECT の句の始まりの予約語
+_clause_keywords = {"FROM", "WHERE", "GROUP", "HAVING", "ORDER", "LIMIT"}
+
+_int64 = range(-(2 ** 63), 2 ** 63)
+
+_escapes = {
+    "\\": "\\",
+    "'": "'",
+    '"': '"',
+    "`": "`",
+    "n": "\n",
+    "t": "\t",
+    "r": "\r",
+}
+
+
+# 値の比較で、両辺の型がそろっているかを調べる演算子
+_comparison_operators = {"=", "!=", "<>", "<", ">", "<=", ">="}
+
+# 比較の両辺の型の分類。クエリパラメータの型は別名でも書ける
+_operand_kinds = {
+    "int64": "number",
+    "integer": "number",
+    "float64": "number",
+    "float": "number",
+    "bool": "bool",
+    "boolean": "bool",
+    "string": "string",
+}
+
+
+class UnsupportedQueryError(Exception):
+    """SQLiteでは実行できないクエリ"""
+
+
+def to_sqlite_string(literal: str):
+    """BigQueryの文字列リテラルをSQLiteの文字列リテラルに変換する"""
+    if literal[0] not in "'\"":
+        raise UnsupportedQueryError(f"プレフィックス付きの文字列リテラルは未対応: {literal}")
+    if literal[:3] in ("'''", '"""'):
+        raise UnsupportedQueryError("三重引用符の文字列リテラルは未対応")
+    if len(literal) < 2 or literal[-1] != literal[0]:
+        raise UnsupportedQueryError(f"閉じていない文字列リテラル: {literal}")
+
+    value = []
+    chars = iter(literal[1:-1])
+    for c in chars:
+        if c == "\\":
+            escaped = next(chars, "")
+            if escaped not in _escapes:
+                raise UnsupportedQueryError(f"未対応のエスケープシーケンス: \\{escaped}")
+            c = _escapes[escaped]
+        value.append(c)
+    return "'" + "".join(value).replace("'", "''") + "'"
+
+
+def _checked_arithmetic(operation):
+    """SQLiteに登録する算術演算の関数
+
+    BigQueryと同じく、INT64の桁あふれと文字列の算術演算はエラーにする。
+    SQLiteの関数が送出した例外は ``sqlite3.Error`` になる
+    """
+
+    def apply(left, right):
+        if left is None or right is None:
+            return None
+        if isinstance(left, str) or isinstance(right, str):
+            raise TypeError("文字列の算術演算は未対応")
+        value = operation(left, right)
+        if isinstance(value, int) and value not in _int64:
+            raise OverflowError("INT64の桁あふれ")
+        return value
+
+    return apply
+
+
+def _word(token):
+    """予約語や識別子の字句なら大文字にした語。それ以外はNone"""
+    return token[1].upper() if token is not None and token[0] == "word" else None
+
+
+def _is_keyword(token):
+    word = _word(token)
+    return word in RESERVED_KEYWORDS or word in _clause_words
+
+
+def _ends_value(token):
+    """値の最後の字句か。直後の ``+`` や ``-`` は二項演算子、識別子は別名になる"""
+    if token is None:
+        return False
+    kind, text = token
+    if kind in ("number", "string", "quoted", "param"):
+        return True
+    if kind == "word":
+        literal = text.upper() in ("NULL", "TRUE", "FALSE", "END")
+        return literal or not _is_keyword(token)
+    return text == ")"
+
+
+def _lex(sql: str):
+    """空白とコメントを除いた字句の ``(kind, text)`` のリスト、それぞれの直前の空白と
+    末尾の空白
+
+    コメントは空白にする。 ``@`` とその直後の名前はクエリパラメータの字句、
+    続けて書いた ``<=`` などの記号はひとつの演算子の字句にする
+    """
+    tokens = []
+    spaces = []
+    space = []
+    last = None
+    for token in tokenize(sql):
+        kind, text = token.kind, token.text
+        adjacent, last = last, token
+        if kind in ("comment", "space"):
+            space.append(" " if kind == "comment" else text)
+            continue
+        if adjacent is not None and adjacent.kind == "symbol":
+            if kind == "word" and tokens[-1] == ("symbol", "@"):
+                # クエリパラメータはSQLiteでも同じ書き方で渡せる
+                tokens[-1] = ("param", "@" + text)
+                continue
+            if kind == "symbol" and tokens[-1][1] + text in _two_char_operators:
+                tokens[-1] = ("symbol", tokens[-1][1] + text)
+                continue
+        tokens.append((kind, text))
+        spaces.append("".join(space))
+        space = []
+    return tokens, spaces, "".join(space)
+
+
+def _match_parens(tokens: list):
+    """開き括弧の位置から、対応する閉じ括弧の位置への辞書"""
+    parens = {}
+    opened = []
+    for i, token in enumerate(tokens):
+        if token == ("symbol", "("):
+            opened.append(i)
+        elif token == ("symbol", ")"):
+            if not opened:
+                raise UnsupportedQueryError("対応する開き括弧がない")
+            parens[opened.pop()] = i
+    if opened:
+        raise UnsupportedQueryError("閉じていない括弧")
+    return parens
+
+
+def _check_tokens(tokens: list):
+    """SQLiteで同じ意味にならない関数、予約語、演算子を見つけたら例外を送出する"""
+
+    def at(i):
+        return tokens[i] if 0 <= i < len(tokens) else None
+
+    for i, (kind, text) in enumerate(tokens):
+        if kind == "symbol" and text not in SUPPORTED_SYMBOLS:
+            raise UnsupportedQueryError(f"{text} は未対応の演算子")
+        if kind == "number" and text.isdigit() and int(text) not in _int64:
+            raise UnsupportedQueryError(f"INT64の範囲を超える整数: {text}")
+        word = _word((kind, text))
+        if word is None:
+            continue
+
+        called = at(i + 1) == ("symbol", "(")
+        if at(i - 1) == ("symbol", "."):
+            # ドット区切りのパスの続き。 SAFE. などの付いた関数は未対応
+            if called:
+                raise UnsupportedQueryError(f"{text} は未対応の関数")
+            continue
+        if word in ("EXCEPT", "INTERSECT") and _word(at(i + 1)) != "DISTINCT":
+            raise UnsupportedQueryError(f"{text} は DISTINCT 付きの集合演算のみ対応")
+        if word in SUPPORTED_KEYWORDS:
+            continue
+        if called:
+            if word not in SUPPORTED_FUNCTIONS:
+                raise UnsupportedQueryError(f"{text} は未対応の関数")
+        elif word in UNSUPPORTED_WORDS:
+            raise UnsupportedQueryError(f"{text} は未対応")
+        elif at(i + 1) is not None and at(i + 1)[0] == "string":
+            raise UnsupportedQueryError(f"型付きのリテラルは未対応: {text}")
+
+
+def _operand_kind(token, types: dict):
+    """比較の片方の辺の型の分類。わからなければNone"""
+    if token is None:
+        return None
+    kind, text = token
+    if kind == "string":
+        return "string"
+    if kind == "number":
+        return "number"
+    if kind == "word" and text.upper() in ("TRUE", "FALSE"):
+        return "bool"
+    if kind in ("word", "quoted", "param"):
+        return _operand_kinds.get(types.get(text.strip("`").lower()))
+    return None
+
+
+def _check_comparisons(tokens: list, types: dict):
+    """型の異なる値の比較と、文字列でない値の LIKE を見つけたら例外を送出する
+
+    BigQueryではエラーになるが、SQLiteでは型を変換したり型の順序で比べたりして、
+    エラーにならずに結果を返してしまう
+    """
+
+    def at(i):
+        return tokens[i] if 0 <= i < len(tokens) else None
+
+    for i, (kind, text) in enumerate(tokens):
+        if kind == "symbol" and text in _comparison_operators:
+            operator = text
+        elif _word((kind, text)) == "LIKE":
+            operator = "LIKE"
+        else:
+            continue
+
+        # 左辺は演算子の直前、右辺は符号とドット区切りのパスを読み飛ばした最後の部分
+        left = i - 1
+        if operator == "LIKE" and _word(at(left)) == "NOT":
+            left -= 1
+        right = i + 1
+        if at(right) in (("symbol", "+"), ("symbol", "-")):
+            right += 1
+        while at(right + 1) == ("symbol", "."):
+            right += 2
+        kinds = {_operand_kind(at(left), types), _operand_kind(at(right), types)}
+
+        if operator == "LIKE" and kinds & {"number", "bool"}:
+            raise UnsupportedQueryError("文字列でない値の LIKE は未対応")
+        if None not in kinds and len(kinds) > 1:
+            raise UnsupportedQueryError(f"型の異なる値の比較は未対応: {operator}")
+
+
+class _SelectBlock:
+    """ひとつの SELECT で、集計していない列が GROUP BY にあるかを調べる
+
+    集計関数か GROUP BY か HAVING を含む SELECT では、SELECT の列と HAVING 、
+    ORDER BY に書いた列は GROUP BY にあるか、集計関数の引数でなければならない。
+    BigQueryではエラーになるが、SQLiteはいずれかの行の値を返してしまう。
+    式で GROUP BY したときは、SELECT に同じ式を書いたときだけ許す
+
+    Args:
+        tokens (list): クエリの字句
+        parens (dict): 開き括弧の位置から閉じ括弧の位置への辞書
+        start (int): SELECT の位置
+    """
+
+    def __init__(self, tokens: list, parens: dict, start: int):
+        self._tokens = tokens
+        self._parens = parens
+        self._start = start
+
+    def _at(self, i):
+        return self._tokens[i] if 0 <= i < len(self._tokens) else None
+
+    def clauses(self):
+        """句の名前から ``(開始位置, 終了位置)`` への辞書。SELECT の列は ``SELECT``"""
+        marks = [("SELECT", self._start, self._start + 1)]
+        i = self._start + 1
+        while i < len(self._tokens):
+            token = self._tokens[i]
+            if token == ("symbol", "("):
+                i = self._parens[i] + 1
+                continue
+            word = _word(token)
+            if token == ("symbol", ")") or word in ("UNION", "EXCEPT", "INTERSECT"):
+                break
+            if word in _clause_keywords:
+                # GROUP BY と ORDER BY は BY の次から
+                marks.append((word, i, i + (2 if word in ("GROUP", "ORDER") else 1)))
+            i += 1
+        ends = [at for _, at, _ in marks[1:]] + [i]
+        return {name: (start, end) for (name, _, start), end in zip(marks, ends)}
+
+    def items(self, start: int, end: int):
+        """カンマで区切った項目の ``(開始位置, 終了位置)`` のリスト"""
+        items = []
+        i = start
+        while i < end:
+            if self._tokens[i] == ("symbol", "("):
+                i = self._parens[i] + 1
+                continue
+            if self._tokens[i] == ("symbol", ","):
+                items.append((start, i))
+                start = i + 1
+            i += 1
+        if start < end:
+            items.append((start, end))
+        return items
+
+    def _is_alias(self, i: int):
+        return _word(self._at(i - 1)) == "AS" or _ends_value(self._at(i - 1))
+
+    def alias(self, start: int, end: int):
+        """項目の別名(小文字)と、別名を除いた終了位置。別名がなければNone"""
+        last = self._tokens[end - 1]
+        if end - 1 > start and self._is_alias(end - 1) and not _is_keyword(last):
+            if last[0] in ("word", "quoted"):
+                skip = 2 if _word(self._at(end - 2)) == "AS" else 1
+                return last[1].strip("`").lower(), end - skip
+        return None, end
+
+    def references(self, start: int, end: int):
+        """集計関数の引数と副問合せの外にある列の参照
+
+        Returns:
+            tuple: 列のパス(小文字)のリスト、 ``*`` を含むか、集計関数を含むか
+        """
+        columns = []
+        star = False
+        aggregated = False
+        i = start
+        while i < end:
+            token = self._tokens[i]
+            kind, text = token
+            if token == ("symbol", "("):
+                if _word(self._at(i + 1)) in ("SELECT", "WITH"):
+                    i = self._parens[i] + 1
+                    continue
+            elif self._at(i + 1) == ("symbol", "(") and kind == "word":
+                if text.upper() in AGGREGATE_FUNCTIONS:
+                    aggregated = True
+                    i = self._parens[i + 1] + 1
+                    continue
+            elif token == ("symbol", "*"):
+                star = star or not _ends_value(self._at(i - 1))
+            elif kind == "quoted" or (kind == "word" and not _is_keyword(token)):
+                if not self._is_alias(i):
+                    path = [text.strip("`").lower()]
+                    while self._at(i + 1) == ("symbol", ".") and i + 2 < end:
+                        i += 2
+                        path.append(self._tokens[i][1].strip("`").lower())
+                    if path[-1] == "*":
+                        star = True
+                    else:
+                        columns.append(".".join(path))
+            i += 1
+        return columns, star, aggregated
+
+    def text(self, start: int, end: int):
+        return " ".join(text.lower() for _, text in self._tokens[start:end])
+
+    def check(self):
+        clauses = self.clauses()
+        select = self.items(*clauses["SELECT"])
+        if select and _word(self._tokens[select[0][0]]) in ("DISTINCT", "ALL"):
+            select[0] = (select[0][0] + 1, select[0][1])
+        aliases = [self.alias(*item) for item in select]
+        select = [(start, end) for (start, _), (_, end) in zip(select, aliases)]
+        names = [name for name, _ in aliases]
+        others = [
+            item
+            for name in ("HAVING", "ORDER")
+            if name in clauses
+            for item in self.items(*clauses[name])
+        ]
+        if not (
+            "GROUP" in clauses
+            or "HAVING" in clauses
+            or any(self.references(*item)[2] for item in select + others)
+        ):
+            return
+
+        grouped_items = set()
+        grouped_columns = set()
+        grouped_texts = set()
+        for start, end in self.items(*clauses.get("GROUP", (0, 0))):
+            text = self.text(start, end)
+            if text.isdigit():
+                grouped_items.add(int(text) - 1)
+                continue
+            grouped_texts.add(text)
+            columns = self.references(start, end)[0]
+            if len(columns) == 1 and text.replace(" ", "").strip("`") == columns[0]:
+                grouped_columns.add(columns[0])
+                if columns[0] in names:
+                    grouped_items.add(names.index(columns[0]))
+
+        def is_grouped(column: str):
+            return any(
+                column == c or column.endswith("." + c) or c.endswith("." + column)
+                for c in grouped_columns
+            )
+
+        for n, (start, end) in enumerate(select):
+            if n in grouped_items or self.text(start, end) in grouped_texts:
+                continue
+            columns, star, _ = self.references(start, end)
+            if star:
+                raise UnsupportedQueryError("集計するクエリの * は未対応")
+            ungrouped = [column for column in columns if not is_grouped(column)]
+            if ungrouped:
+                raise UnsupportedQueryError(f"{ungrouped} は GROUP BY にも集計関数にもない")
+        for start, end in others:
+            text = self.text(start, end)
+            if text.isdigit() or text in grouped_texts:
+                continue
+            ungrouped = [
+                column
+                for column in self.references(start, end)[0]
+                if column not in names and not is_grouped(column)
+            ]
+            if ungrouped:
+                raise UnsupportedQueryError(f"{ungrouped} は GROUP BY にも集計関数にもない")
+
+
+def _check_grouping(tokens: list, parens: dict):
+    for i, token in enumerate(tokens):
+        if _word(token) == "SELECT":
+            _SelectBlock(tokens, parens, i).check()
+
+
+def _translate(tokens: list):
+    """字句ごとにSQLiteの書き方にした文字列のリスト"""
+    texts = []
+    for i, (kind, text) in enumerate(tokens):
+        word = _word((kind, text))
+        if kind == "string":
+            text = to_sqlite_string(text)
+        elif kind == "quoted":
+            if len(text) < 2 or not text.endswith("`"):
+                raise UnsupportedQueryError(f"閉じていないバッククォート: {text}")
+            text = '"' + text[1:-1].replace('"', '""') + '"'
+        elif word == "DISTINCT" and i > 0:
+            if _word(tokens[i - 1]) in ("UNION", "EXCEPT", "INTERSECT"):
+                # SQLiteの UNION/EXCEPT/INTERSECT は DISTINCT 付きと同じ
+                text = ""
+        elif word == "IF" and tokens[i + 1 : i + 2] == [("symbol", "(")]:
+            text = "IIF"
+        texts.append(text)
+    return texts
+
+
+class _ArithmeticRewriter:
+    """BigQueryの演算子の優先順位で、算術演算子を桁あふれを調べる関数の呼び出しにする
+
+    ``*`` と ``||`` は ``+`` と ``-`` より先に結合する。SQLiteでは ``||`` が ``*``
+    より先に結合するので、 ``||`` の式は括弧で囲む。 LIKE のパターンが
+    バックスラッシュを含みうるときは、BigQueryと同じくエスケープ文字にする
+    """
+
+    def __init__(self, tokens: list, spaces: list, texts: list, parens: dict):
+        self._tokens = tokens
+        self._spaces = spaces
+        self._texts = texts
+        self._parens = parens
+
+    def rewrite(self, start: int, end: int):
+        pieces = []
+        like = False
+        i = start
+        while i < end:
+            chain = self._chain(i, end)
+            if chain is None:
+                pieces.append(self._spaces[i] + self._texts[i])
+                like = _word(self._tokens[i]) == "LIKE"
+                i += 1
+                continue
+            after, text = chain
+            if like and not (
+                after == i + 1
+                and self._tokens[i][0] == "string"
+                and "\\" not in self._texts[i]
+            ):
+                text += " ESCAPE '\\'"
+            like = False
+            pieces.append(text)
+            i = after
+        return "".join(pieces)
+
+    def _chain(self, i: int, end: int):
+        """``i`` から始まる、算術演算子でつないだ値。値でなければNone"""
+        atom = self._atom(i, end)
+        if atom is None:
+            return None
+        after, space, first = atom
+        operands = [first]
+        operators = []
+        while after < end and self._tokens[after][0] == "symbol":
+            op = self._tokens[after][1]
+            if op not in _arithmetic_functions and op != "||":
+                break
+            atom = self._atom(after + 1, end)
+            if atom is None:
+                break
+            operators.append(op)
+            after, _, operand = atom
+            operands.append(operand)
+        if not operators:
+            return after, space + first
+
+        # 先に * と || を、次に + と - を左から結合する
+        terms = [operands[0]]
+        additions = []
+        for op, operand in zip(operators, operands[1:]):
+            if op in ("+", "-"):
+                additions.append(op)
+                terms.append(operand)
+            else:
+                terms[-1] = self._apply(op, terms[-1], operand)
+        text = terms[0]
+        for op, term in zip(additions, terms[1:]):
+            text = self._apply(op, text, term)
+        return after, space + text
+
+    @staticmethod
+    def _apply(op: str, left: str, right: str):
+        if op == "||":
+            return f"({left} || {right})"
+        return f"{_arithmetic_functions[op][0]}({left}, {right})"
+
+    def _atom(self, i: int, end: int):
+        """``i`` から始まる値の ``(終了位置, 直前の空白, SQL)`` 。値でなければNone"""
+        if i >= end:
+            return None
+        token = self._tokens[i]
+        kind, text = token
+        space = self._spaces[i]
+        word = _word(token)
+        if token in (("symbol", "+"), ("symbol", "-")):
+            atom = self._atom(i + 1, end)
+            if atom is None:
+                return None
+            after, inner_space, operand = atom
+            if text == "-" and self._tokens[i + 1][0] != "number":
+                return after, space, f"bqqtest_sub(0, {operand})"
+            return after, space, text + inner_space + operand
+        if token == ("symbol", "("):
+            close = self._parens[i]
+            return close + 1, space, self._group(i, close)
+        if word == "CASE":
+            close = self._case_end(i, end)
+            inner = self.rewrite(i + 1, close)
+            text = self._texts[i] + inner + self._spaces[close] + self._texts[close]
+            return close + 1, space, text
+        if kind in ("number", "string", "param") or word in ("NULL", "TRUE", "FALSE"):
+            return i + 1, space, self._texts[i]
+        called = self._tokens[i + 1 : i + 2] == [("symbol", "(")]
+        if word is not None and called and word not in SUPPORTED_KEYWORDS:
+            close = self._parens[i + 1]
+            text = self._texts[i] + self._spaces[i + 1] + self._group(i + 1, close)
+            return close + 1, space, text
+        if kind == "quoted" or (word is not None and not _is_keyword(token)):
+            after = i + 1
+            text = self._texts[i]
+            while after + 1 < end and self._tokens[after] == ("symbol", "."):
+                text += "".join(
+                    self._spaces[k] + self._texts[k] for k in (after, after + 1)
+                )
+                after += 2
+            return after, space, text
+        return None
+
+    def _group(self, open_: int, close: int):
+        """括弧で囲んだ部分。開き括弧の前の空白は含めない"""
+        return "(" + self.rewrite(open_ + 1, close) + self._spaces[close] + ")"
+
+    def _case_end(self, i: int, end: int):
+        depth = 0
+        while i < end:
+            if self._tokens[i] == ("symbol", "("):
+                i = self._parens[i] + 1
+                continue
+            word = _word(self._tokens[i])
+            if word == "CASE":
+                depth += 1
+            elif word == "END":
+                depth -= 1
+                if depth == 0:
+                    return i
+            i += 1
+        raise UnsupportedQueryError("CASE に対応する END がない")
+
+
+def to_sqlite(sql: str, types: dict = None, strict: bool = True):
+    """BigQueryのSQLをSQLiteのSQLに変換する
+
+    Args:
+        sql (str): BigQueryのSQL
+        types (dict): 列名と ``@`` 付きのクエリパラメータ名(小文字)から型名(小文字)への辞書。
+            型の異なる値の比較を見つけるのに使う
+        strict (bool): Falseなら関数や予約語を調べず、リテラルと識別子だけを変換する。
+            bqqtest が作る差分のクエリに使う
+
+    Raises:
+        UnsupportedQueryError: SQLiteでは同じ結果にならない構文を含む
+    """
+    tokens, spaces, trailing = _lex(sql)
+    parens = _match_parens(tokens)
+    if strict:
+        _check_tokens(tokens)
+        _check_comparisons(tokens, types or {})
+        _check_grouping(tokens, parens)
+    texts = _translate(tokens)
+    if not strict:
+        return "".join(map(str.__add__, spaces, texts)) + trailing
+    rewriter = _ArithmeticRewriter(tokens, spaces, texts, parens)
+    return rewriter.rewrite(0, len(tokens)) + trailing
+
+
+def to_sqlite_parameters(query_parameters: list):
+    parameters = {}
+    for parameter in query_parameters:
+        if (
+            not isinstance(parameter, bigquery.ScalarQueryParameter)
+            or not parameter.name
+        ):
+            raise UnsupportedQueryError("名前付きのスカラーパラメータのみ対応")
+        parameters[parameter.name] = parameter.value
+    return parameters
+
+
+class SQLiteBackend:
+    """QueryLogicTest をインメモリのSQLiteで実行する
+
+    テストデータはSQLiteのテーブルにロードし、WITH句のクエリはBigQueryの構文から変換する。
+    変換できないクエリや、SQLiteで実行できなかったクエリはBigQueryで実行する。
+    LIKE はBigQueryと同じく大文字と小文字を区別し、INT64の桁あふれはエラーになる
+
+    Args:
+        fallback (bool): Falseなら、SQLiteで実行できないときにBigQueryで実行せず
+            ``UnsupportedQueryError`` を送出する
+    """
+
+    _fallback = True
+
+    def __init__(self, fallback: bool = True):
+        self._fallback = fallback
+
+    def run(
+        self,
+        qlt,
+        single_job: bool = False,
+        dry_run: bool = False,
+        client_diff: bool = False,
+        ordered: bool = False,
+        output: str = "rows",
+        max_rows: int = None,
+    ):
+        """テストを実行する
+
+        BigQueryで実行するときは ``qlt.run()`` を呼び直さずに同じ処理をするので、
+        実行の記録は呼び出し元の ``run()`` のものにまとまる
+
+        Args:
+            qlt (QueryLogicTest): テスト
+            single_job, dry_run, client_diff, ordered, output, max_rows:
+                ``QueryLogicTest.run()`` と同じ
+
+        Returns:
+            tuple: 成功か失敗を示すBoolと差分
+        """
+        try:
+            _, records = self.run_local(qlt)
+        except (UnsupportedQueryError, sqlite3.Error):
+            if not self._fallback:
+                raise
+            return qlt._run_with_options(
+                single_job, dry_run, None, client_diff, ordered, None, output, max_rows
+            )
+        return qlt._records_outcome(records, output, max_rows)
+
+    def run_local(self, qlt):
+        # 循環importを避ける
+        from .table import Table
+
+        with_tables = []
+        connection = sqlite3.connect(":memory:")
+        try:
+            connection.execute("PRAGMA case_sensitive_like = ON")
+            for name, operation in _arithmetic_functions.values():
+                connection.create_function(name, 2, _checked_arithmetic(operation))
+            for table in qlt.tables():
+                if isinstance(table, Table):
+                    self.load(connection, table)
+                else:
+                    with_tables.append(table)
+
+            types = self.types(qlt)
+            fragments = []
+            for table in with_tables + [qlt.query()]:
+                fragments.append(to_sqlite(table.to_sql(), types))
+            fragments.append(to_sqlite(qlt.diff_query().to_sql(), strict=False))
+            sql = "WITH " + ",".join(fragments) + " SELECT * FROM diff"
+            parameters = to_sqlite_parameters(qlt.query().query_parameters())
+
+            cursor = connection.execute(sql, parameters)
+            names = [column[0] for column in cursor.description]
+            field_to_index = {name: i for i, name in enumerate(names)}
+            records = [bigquery.Row(row, field_to_index) for row in cursor]
+        finally:
+            connection.close()
+        return (records == [], records)
+
+    @staticmethod
+    def types(qlt):
+        """テストデータの列とクエリパラメータの型。別の型の同じ名前の列は含めない"""
+        from .table import Table
+
+        types = {}
+        conflicts = set()
+        for table in qlt.tables(include_expected=False):
+            if not isinstance(table, Table):
+                continue
+            for name, typ in zip(table.schema().names(), table.schema().types()):
+                name = name.lower()
+                if types.setdefault(name, typ) != typ:
+                    conflicts.add(name)
+        for parameter in qlt.query().query_parameters():
+            if isinstance(parameter, bigquery.ScalarQueryParameter) and parameter.name:
+                types["@" + parameter.name.lower()] = parameter.type_.lower()
+        return {name: typ for name, typ in types.items() if name not in conflicts}
+
+    @staticmethod
+    def load(connection, table):
+        if any(typ not in SUPPORTED_TYPES for typ in table.schema().types()):
+            raise UnsupportedQueryError(f"{table.name()} に未対応の型の列がある")
+
+        names = ", ".join('"' + name + '"' for name in table.schema().names())
+        placeholders = ", ".join("?" for _ in table.schema().names())
+        connection.execute(f'CREATE TABLE "{table.name()}" ({names})')
+        connection.executemany(
+            f'INSERT INTO "{table.name()}" VALUES ({placeholders})',
+            (tuple(record.values()) for record in table.records()),
+        )
@@ -0,0 +1,265 @@
+import sqlite3
+
+import pytest
+from google.cloud import bigquery
+
+from . import metrics as metrics_module
+from .fake import FakeClient
+from .local import SQLiteBackend, UnsupportedQueryError, to_sqlite
+
+params = {
+    "文字列リテラルはシングルクォートにする": (
+        """SELECT "a\\"b", 'c' FROM t""",
+        """SELECT 'a"b', 'c' FROM t""",
+    ),
+    "バッククォートはダブルクォートにする": ("SELECT * FROM `a.b`", 'SELECT * FROM "a.b"'),
+    "EXCEPT DISTINCTはEXCEPTにする": (
+        "SELECT 1 EXCEPT DISTINCT SELECT 2",
+        "SELECT 1 EXCEPT  SELECT 2",
+    ),
+    "コメントは取り除く": ("SELECT 1 -- comment\n# comment\n", "SELECT 1  \n \n"),
+    "算術演算子は桁あふれを調べる関数にする": (
+        "SELECT -a, a - -1, a || b * c + d FROM t",
+        "SELECT bqqtest_sub(0, a), bqqtest_sub(a, -1), "
+        "bqqtest_add(bqqtest_mul((a || b), c), d) FROM t",
+    ),
+    "IFはIIFにする": ("SELECT IF(a, 'x', 'y') FROM t", "SELECT IIF(a, 'x', 'y') FROM t"),
+    "LIKEはバックスラッシュをエスケープ文字にする": (
+        "SELECT * FROM t WHERE a LIKE 'x\\\\_%' OR a LIKE @p",
+        "SELECT * FROM t WHERE a LIKE 'x\\_%' ESCAPE '\\' OR a LIKE @p ESCAPE '\\'",
+    ),
+}
+
+
+@pytest.mark.parametrize(
+    ["sql", "want"], list(params.values()), ids=list(params.keys())
+)
+def test_to_sqlite(sql, want):
+    assert to_sqlite(sql) == want
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        "SELECT * FROM UNNEST([1, 2])",
+        "SELECT CAST(x AS STRING) FROM t",
+        "SELECT x / 2 FROM t",
+        "SELECT b'abc'",
+        "SELECT '''abc'''",
+        "SELECT 'abc",
+        "SELECT * FROM `t",
+        "SELECT CONCAT(name, 'x') FROM t",
+        "SELECT SUBSTR(name, 0, 2) FROM t",
+        "SELECT UPPER(name) FROM t",
+        "SELECT SAFE.ABS(value) FROM t",
+        "SELECT DATE '2020-01-02'",
+        "SELECT * EXCEPT (value) FROM t",
+        "SELECT value % 2 FROM t",
+        "SELECT 9223372036854775808",
+        "SELECT name, SUM(value) FROM t",
+        "SELECT name, SUM(value) FROM t GROUP BY value",
+        "SELECT *, COUNT(*) FROM t GROUP BY name",
+        "SELECT name FROM t GROUP BY name ORDER BY value",
+    ],
+)
+def test_未対応の構文はUnsupportedQueryError(sql):
+    with pytest.raises(UnsupportedQueryError):
+        to_sqlite(sql)
+
+
+types = {"item": "string", "value": "int64", "@min": "int64"}
+
+
+@pytest.mark.parametrize(
+    "sql",
+    **{
+        "argvalues": [
+            "SELECT * FROM t WHERE value = '1'",
+            "SELECT * FROM t WHERE '1' <> t.value",
+            "SELECT * FROM t WHERE `item` >= 1",
+            "SELECT * FROM t WHERE item = @min",
+            "SELECT * FROM t WHERE value = TRUE",
+            "SELECT * FROM t WHERE value LIKE '1%'",
+            "SELECT * FROM t WHERE item NOT LIKE 1",
+        ],
+        "ids": [
+            "整数と文字列",
+            "<>",
+            ">=",
+            "クエリパラメータ",
+            "整数と真偽値",
+            "整数のLIKE",
+            "NOT LIKE",
+        ],
+    },
+)
+def test_型の異なる値の比較はUnsupportedQueryError(sql):
+    with pytest.raises(UnsupportedQueryError):
+        to_sqlite(sql, types)
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        "SELECT * FROM t WHERE value = 1 AND t.item != 'a' AND value <= -1.5",
+        "SELECT * FROM t WHERE item LIKE 'a%' AND value > @min",
+        "SELECT * FROM t WHERE unknown = '1'",
+    ],
+)
+def test_同じ型の値の比較は変換できる(sql):
+    assert to_sqlite(sql, types) == sql
+
+
+@pytest.mark.parametrize(
+    "sql",
+    **{
+        "argvalues": [
+            "SELECT name, SUM(value) AS s FROM t GROUP BY name HAVING s > 1",
+            "SELECT t.name n, COUNT(*) FROM t GROUP BY 1 ORDER BY n DESC NULLS LAST",
+            "SELECT name, MAX(value) FROM t GROUP BY t.name",
+            "SELECT value + 1 AS v, COUNT(*) FROM t GROUP BY value + 1",
+            "SELECT COUNT(DISTINCT name) FROM t WHERE value > 0",
+            "SELECT name FROM t WHERE value IN (SELECT MAX(value) FROM t)",
+        ],
+        "ids": ["HAVING", "番号と別名", "テーブル名付き", "式", "集計だけ", "副問合せ"],
+    },
+)
+def test_集計していない列がGROUP_BYにあれば変換できる(sql):
+    to_sqlite(sql, types)
+
+
+# 集計のテストで使う test.table のテストデータ
+datum = [["abc", 100], ["bbb", 333], ["abc", 200]]
+
+
+class TestSQLiteBackend:
+    def test_BigQueryに接続せずに実行できる(self, query_test):
+        client = FakeClient()
+        qt = query_test(
+            client,
+            datum,
+            [["abc", 300], ["bbb", 333]],
+            "SELECT name, SUM(value) AS value FROM test.table GROUP BY name",
+        )
+        assert qt.run(backend=SQLiteBackend()) == (True, [])
+        assert client.jobs == []
+
+    def test_差分はBigQueryと同じ形で返ってくる(self, query_test):
+        qt = query_test(
+            FakeClient(),
+            datum,
+            [["bbb", 333], ["ccc", 1]],
+            "SELECT * FROM `test.table` WHERE name = 'bbb'",
+        )
+        success, diff = qt.run(backend=SQLiteBackend())
+        assert not success
+        assert diff == [
+            bigquery.Row(
+                ("-", "ccc", 1, 2),
+                {"mark": 0, "name": 1, "value": 2, "n": 3},
+            )
+        ]
+
+    def test_LIKEは大文字と小文字を区別する(self, query_test):
+        qt = query_test(
+            FakeClient(), datum, [], "SELECT * FROM test.table WHERE name LIKE 'A%'"
+        )
+        assert qt.run(backend=SQLiteBackend(fallback=False)) == (True, [])
+
+    def test_型の異なる値の比較はBigQueryで実行する(self, query_test):
+        client = FakeClient()
+        qt = query_test(
+            client, datum, [], "SELECT * FROM test.table WHERE value = '100'"
+        )
+        qt.run(backend=SQLiteBackend())
+        assert len(client.jobs) == 2
+
+    def test_クエリパラメータを使える(self, query_test):
+        qt = query_test(
+            FakeClient(),
+            datum,
+            [["bbb", 333]],
+            "SELECT * FROM test.table WHERE value > @min",
+            [bigquery.ScalarQueryParameter("min", "INT64", 200)],
+        )
+        assert qt.run(backend=SQLiteBackend()) == (True, [])
+
+    @pytest.mark.parametrize(
+        "query",
+        **{
+            "argvalues": [
+                "SELECT name, SUM(value) AS value FROM test.table, UNNEST([1]) "
+                "GROUP BY name",
+                "SELECT name, COUNTIF(value > 0) AS value FROM test.table "
+                "GROUP BY name",
+            ],
+            "ids": ["変換できない", "SQLiteで実行できない"],
+        },
+    )
+    def test_未対応のクエリはBigQueryで実行する(self, query_test, query):
+        client = FakeClient()
+        qt = query_test(client, datum, [["abc", 300], ["bbb", 333]], query)
+        assert qt.run(single_job=True, backend=SQLiteBackend()) == (True, [])
+        assert len(client.jobs) == 1
+
+    def test_算術演算ができる(self, query_test):
+        qt = query_test(
+            FakeClient(),
+            datum,
+            [["abc", 201], ["bbb", 667], ["abc", 401]],
+            "SELECT name, value * 2 + 1 AS value FROM test.table",
+        )
+        assert qt.run(backend=SQLiteBackend(fallback=False)) == (True, [])
+
+    def test_INT64の桁あふれは浮動小数点数にせずエラーにする(self, query_test):
+        qt = query_test(
+            FakeClient(),
+            datum,
+            [],
+            "SELECT name, value * 9223372036854775807 AS value FROM test.table",
+        )
+        with pytest.raises(sqlite3.Error):
+            qt.run(backend=SQLiteBackend(fallback=False))
+
+    @pytest.mark.parametrize(
+        "query, expected",
+        **{
+            "argvalues": [
+                ("SELECT CONCAT(name, NULL) AS name, value FROM test.table", []),
+                ("SELECT name, SUM(value) AS value FROM test.table", []),
+            ],
+            "ids": ["CONCAT", "GROUP BYにない列"],
+        },
+    )
+    def test_BigQueryと結果が変わるクエリはBigQueryで実行する(
+        self, query_test, query, expected
+    ):
+        client = FakeClient()
+        qt = query_test(client, datum, expected, query)
+        assert qt.run(single_job=True, backend=SQLiteBackend()) == (True, [])
+        assert len(client.jobs) == 1
+
+    def test_BigQueryで実行するときも引数と計測値を引き継ぐ(self, query_test):
+        received = []
+        metrics_module.add_hook(received.append)
+        try:
+            fields = {"name": 0, "value": 1}
+            rows = [bigquery.Row(("xxx", i), fields) for i in range(3)]
+            client = FakeClient(lambda query, job_config: (rows, 0))
+            qt = query_test(client, datum, [], "SELECT name, value / 2 FROM test.table")
+            success, diff = qt.run(
+                single_job=True, backend=SQLiteBackend(), client_diff=True, max_rows=1
+            )
+        finally:
+            metrics_module.remove_hook(received.append)
+
+        assert not client.jobs[0].query.endswith("SELECT * FROM diff")
+        assert not success and [tuple(r.values()) for r in diff] == [("+", "xxx", 0, 1)]
+        assert qt.diff_total_rows() == 3
+        assert received == [qt.metrics()]
+        assert {"backend", "wait", "fetch"} <= set(received[0].phases)
+
+    def test_fallbackしないときは例外を送出する(self, query_test):
+        qt = query_test(FakeClient(), datum, [], "SELECT 1 / 2")
+        with pytest.raises(UnsupportedQueryError):
+            qt.run(backend=SQLiteBackend(fallback=False))
@@ -0,0 +1,183 @@
+"""テストの実行時間やデータ走査量を記録して、フックに渡す
+
+``QueryLogicTest.run()`` と ``arun()`` は実行のたびに ``RunMetrics`` を作り、
+終わったら成功しても失敗しても ``add_hook()`` で登録したフックを呼ぶ::
+
+    from bqqtest.metrics import JsonLinesExporter, add_hook
+
+    add_hook(JsonLinesExporter("bqqtest_metrics.jsonl"))
+"""
+import contextlib
+import json
+import threading
+import time
+
+_hooks = []
+_hooks_lock = threading.Lock()
+
+
+def add_hook(hook):
+    """テストが終わるたびに ``hook(metrics)`` を呼ぶ
+
+    フックはテストを実行したスレッドから呼ばれる。フックで起きた例外はテストに伝わる
+    """
+    with _hooks_lock:
+        _hooks.append(hook)
+
+
+def remove_hook(hook):
+    with _hooks_lock:
+        _hooks.remove(hook)
+
+
+def emit(metrics: "RunMetrics"):
+    """登録したすべてのフックに ``metrics`` を渡す"""
+    with _hooks_lock:
+        hooks = list(_hooks)
+    for hook in hooks:
+        hook(metrics)
+
+
+def _seconds_between(start, end):
+    if start is None or end is None:
+        return None
+    return (end - start).total_seconds()
+
+
+def job_stats(kind: str, job):
+    """ジョブの統計情報の辞書
+
+    フェイクのジョブのように、持っていない属性の値はNoneにする
+
+    Args:
+        kind (str): ``dry_run`` 、 ``check`` (走査量を確かめるジョブ)か ``query``
+        job: ``bigquery.QueryJob``
+    """
+    created = getattr(job, "created", None)
+    started = getattr(job, "started", None)
+    ended = getattr(job, "ended", None)
+    return {
+        "kind": kind,
+        "job_id": getattr(job, "job_id", None),
+        "total_bytes_processed": getattr(job, "total_bytes_processed", None),
+        "total_bytes_billed": getattr(job, "total_bytes_billed", None),
+        "slot_millis": getattr(job, "slot_millis", None),
+        "cache_hit": getattr(job, "cache_hit", None),
+        # キューで待った時間と、BigQueryで実行していた時間
+        "queue_seconds": _seconds_between(created, started),
+        "execute_seconds": _seconds_between(started, ended),
+    }
+
+
+class RunMetrics:
+    """テストを1回実行したときの計測値
+
+    Attributes:
+        name (str): テストの名前。 ``QueryLogicTest`` の ``name``
+        started_at (float): 実行を始めたUNIX時刻
+        phases (dict): 段階の名前から秒数への辞書。段階は実行した分だけ入る。
+            ``total`` (全体)、 ``result_cache`` 、 ``backend`` 、 ``spill`` (ロードジョブ)、
+            ``build`` (クエリの生成)、 ``check`` (走査量の確認)、 ``submit`` (ジョブの発行)、
+            ``wait`` (ジョブの完了待ち)、 ``fetch`` (結果の取得と差分の作成)。
+            ``load`` (テストデータの読み込みと変換)はテストを作ったときに一度だけ計り、
+            ``total`` には含まない
+        sql_bytes (int): 実行したクエリのUTF-8でのバイト数
+        table_lengths (dict): テーブル名から、WITH句でのそのテーブルのSQLの文字数への辞書。
+            テーブル名はWITH句で付けた名前ではなく元の名前
+        jobs (list): ``job_stats()`` の辞書のリスト。発行した順
+        result_cache_hit (bool): ``ResultCache`` から結果を返したか。使わなければNone
+        success (bool): テストの結果。例外で終わったときはNone
+        diff_rows (int): 差分の行数
+        error (str): 例外で終わったときの例外の ``repr``
+    """
+
+    def __init__(self, name: str = ""):
+        self.name = name
+        self.started_at = time.time()
+        self.phases = {}
+        self.sql_bytes = None
+        self.table_lengths = {}
+        self.jobs = []
+        self.result_cache_hit = None
+        self.success = None
+        self.diff_rows = None
+        self.error = None
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """``with`` の中にかかった秒数を ``phases[name]`` に足す"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def add_job(self, kind: str, job):
+        self.jobs.append(job_stats(kind, job))
+
+    def total_bytes_processed(self):
+        """発行したジョブのデータ走査量の合計"""
+        return sum(job["total_bytes_processed"] or 0 for job in self.jobs)
+
+    def slot_millis(self):
+        """発行したジョブのスロット時間の合計"""
+        return sum(job["slot_millis"] or 0 for job in self.jobs)
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "started_at": self.started_at,
+            "phases": dict(self.phases),
+            "sql_bytes": self.sql_bytes,
+            "table_lengths": dict(self.table_lengths),
+            "jobs": [dict(job) for job in self.jobs],
+            "result_cache_hit": self.result_cache_hit,
+            "success": self.success,
+            "diff_rows": self.diff_rows,
+            "error": self.error,
+        }
+
+    def __repr__(self):
+        return f"RunMetrics({self.to_dict()!r})"
+
+
+@contextlib.contextmanager
+def recording(metrics: "RunMetrics"):
+    """``with`` の中を ``total`` として計り、終わったらフックを呼ぶ"""
+    try:
+        with metrics.phase("total"):
+            yield metrics
+    except BaseException as e:
+        metrics.error = repr(e)
+        raise
+    finally:
+        emit(metrics)
+
+
+class JsonLinesExporter:
+    """``RunMetrics`` を1行1件のJSONでファイルに追記するフック
+
+    複数のスレッドから呼ばれても行が混ざらない
+
+    Args:
+        path (str): 書き出すファイルのパス
+    """
+
+    _path = ""
+
+    def __init__(self, path: str):
+        self._path = path
+        self._lock = threading.Lock()
+
+    def __call__(self, metrics: "RunMetrics"):
+        line = json.dumps(metrics.to_dict(), ensure_ascii=False, default=str)
+        with self._lock:
+            with open(self._path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+
+def read_json_lines(path: str):
+    """``JsonLinesExporter`` で書き出したファイルを辞書のリストとして読む"""
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
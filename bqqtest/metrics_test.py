@@ -0,0 +1,123 @@
+import asyncio
+
+import pytest
+
+from . import metrics as metrics_module
+from .cache import ResultCache
+from .fake import FakeClient
+from .metrics import JsonLinesExporter, RunMetrics, read_json_lines
+from .suite import run_many
+
+
+@pytest.fixture
+def emitted():
+    received = []
+    metrics_module.add_hook(received.append)
+    yield received
+    metrics_module.remove_hook(received.append)
+
+
+def test_実行のたびにフックに計測値を渡す(query_test, emitted):
+    client = FakeClient()
+    test = query_test(client, name="テスト")
+    success, _ = test.run()
+
+    assert emitted == [test.metrics()]
+    metrics = emitted[0]
+    assert metrics.name == "テスト" and metrics.success and metrics.diff_rows == 0
+    assert set(metrics.phases) == {
+        "load",
+        "total",
+        "spill",
+        "build",
+        "check",
+        "submit",
+        "wait",
+        "fetch",
+    }
+    assert metrics.phases["total"] >= metrics.phases["build"]
+    assert metrics.sql_bytes == len(client.jobs[-1].query.encode("utf-8"))
+    assert [job["kind"] for job in metrics.jobs] == ["check", "query"]
+    assert [job["job_id"] for job in metrics.jobs] == [j.job_id for j in client.jobs]
+    assert metrics.total_bytes_processed() == 0 and metrics.slot_millis() == 0
+
+
+def test_テーブルのSQLの長さは元のテーブル名で記録する(query_test, emitted):
+    test = query_test(FakeClient())
+    test.run(dry_run=True)
+
+    lengths = emitted[0].table_lengths
+    assert set(lengths) == {"test.table", "EXPECTED", "ACTUAL", "diff"}
+    table_sql = test.query_logic_test().tables()[0].to_sql()
+    assert lengths["test.table"] == len(table_sql)
+    assert [job["kind"] for job in emitted[0].jobs] == ["dry_run", "query"]
+
+
+def test_テストデータの読み込みは作ったときに一度だけ計る(query_test, emitted):
+    test = query_test(FakeClient())
+    test.run()
+    test.run()
+
+    first, second = emitted
+    assert first.phases["load"] == second.phases["load"] >= 0.0
+
+
+def test_例外で終わってもフックを呼ぶ(query_test, emitted):
+    test = query_test(FakeClient(lambda query, job_config: ([], 100)))
+    with pytest.raises(AssertionError):
+        test.run(single_job=True)
+
+    assert emitted[0].success is None
+    assert "AssertionError" in emitted[0].error
+    assert emitted[0].jobs[0]["total_bytes_processed"] == 100
+
+
+def test_キャッシュから返したかを記録する(query_test, emitted, tmp_path):
+    cache = ResultCache(str(tmp_path))
+    client = FakeClient()
+    query_test(client).run(cache=cache)
+    query_test(client).run(cache=cache)
+
+    assert [m.result_cache_hit for m in emitted] == [False, True]
+    assert "wait" in emitted[0].phases and "wait" not in emitted[1].phases
+    assert len(emitted[1].jobs) == 0
+
+
+def test_arunも計測値を渡す(query_test, emitted):
+    test = query_test(FakeClient())
+    success, _ = asyncio.run(test.arun(poll_interval=0.001))
+
+    assert success
+    assert emitted == [test.metrics()]
+    assert {"build", "check", "submit", "wait", "fetch"} <= set(emitted[0].phases)
+
+
+def test_run_manyの結果に計測値が入る(query_test):
+    results = run_many([query_test(FakeClient(), name=f"t{i}") for i in range(3)])
+    assert [r.metrics.name for r in results] == ["t0", "t1", "t2"]
+
+
+def test_JSON_Linesで書き出す(query_test, tmp_path):
+    path = str(tmp_path / "metrics.jsonl")
+    exporter = JsonLinesExporter(path)
+    metrics_module.add_hook(exporter)
+    try:
+        query_test(FakeClient(), name="a").run()
+        query_test(FakeClient(), name="b").run(single_job=True)
+    finally:
+        metrics_module.remove_hook(exporter)
+
+    records = read_json_lines(path)
+    assert [r["name"] for r in records] == ["a", "b"]
+    assert records[1]["jobs"][0]["kind"] == "query"
+    assert records[1]["phases"]["total"] > 0
+
+
+def test_phaseは同じ段階の時間を足す():
+    metrics = RunMetrics()
+    with metrics.phase("x"):
+        pass
+    first = metrics.phases["x"]
+    with metrics.phase("x"):
+        pass
+    assert metrics.phases["x"] >= first
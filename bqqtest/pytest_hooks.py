@@ -0,0 +1,14 @@
+"""bqqtest の pytest プラグインが呼ぶフック"""
+import pytest
+
+
+@pytest.hookspec(firstresult=True)
+def pytest_bqqtest_make_client(config):
+    """``bqqtest_client`` と、テストケースのファイルのテストで使うクライアントを作る
+
+    conftest.py で実装すると、プロジェクトや認証情報を変えたり、
+    ``FakeClient`` に差し替えたりできる。Noneを返すと既定のクライアントを作る
+
+    Args:
+        config: pytest の ``Config``
+    """
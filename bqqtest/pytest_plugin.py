@@ -0,0 +1,442 @@
+"""bqqtest の pytest プラグイン
+
+bqqtest をインストールすると pytest が自動で読み込む。
+
+* ``bqqtest_client`` フィクスチャ: セッションで1つだけ作り、HTTPの接続を使い回すクライアント
+* ``bqqtest_*.json`` 、 ``bqqtest_*.yaml`` 、 ``bqqtest_*.yml`` のテストケースを集めてテストにする
+* 同じファイルのテストケースは ``--bqqtest-group-size`` 件ずつ ``run_many`` で並行に実行する
+* pytest-xdist の ``--dist loadgroup`` では、前回までの実行時間で偏らないように
+  テストケースのまとまりをワーカーに振り分ける
+
+テストケースのファイルを集めるには pytest 7 以上が必要。それより古い pytest では
+``bqqtest_client`` フィクスチャだけが使える
+"""
+import heapq
+import json
+import os
+import threading
+from pathlib import Path
+
+import pytest
+
+from . import pytest_hooks
+from .suite import QueryTestResult, run_many
+from .table import CompiledQueryTest
+
+PLUGIN_NAME = "bqqtest-session"
+# テストケースごとの実行時間を保存する pytest のキャッシュのキー
+DURATIONS_KEY = "bqqtest/durations"
+# xdist_group に付けるグループの名前の接頭辞
+GROUP_PREFIX = "bqqtest_group"
+# テストケースのファイルを集めるには pytest 7 以上が必要
+# (pytest_collect_file の file_path と Node.path)
+PYTEST_MAJOR = int(pytest.__version__.split(".")[0])
+DEFAULT_POOL_SIZE = 32
+DEFAULT_GROUP_SIZE = 16
+DEFAULT_MAX_WORKERS = 8
+SCOPES = (
+    "https://www.googleapis.com/auth/bigquery",
+    "https://www.googleapis.com/auth/cloud-platform",
+)
+SPEC_SUFFIXES = (".json", ".yaml", ".yml")
+
+
+def make_client(project: str = None, pool_size: int = DEFAULT_POOL_SIZE):
+    """HTTPの接続を ``pool_size`` 本まで使い回す ``bigquery.Client`` を作る
+
+    認証情報の取得と接続の準備は一度だけになるので、テストごとにクライアントを作るより速い
+
+    Args:
+        project (str): プロジェクト。省略すると認証情報のプロジェクト
+        pool_size (int): 同時に開いておく接続の数
+    """
+    import google.auth
+    from google.auth.transport.requests import AuthorizedSession
+    from google.cloud import bigquery
+    from requests.adapters import HTTPAdapter
+
+    credentials, default_project = google.auth.default(scopes=SCOPES)
+    session = AuthorizedSession(credentials)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    return bigquery.Client(
+        project=project or default_project, credentials=credentials, _http=session
+    )
+
+
+def query_parameters(params: list):
+    """``{"name", "type", "value"}`` の辞書のリストをクエリパラメータにする
+
+    ``ARRAY<INT64>`` のような型は ``ArrayQueryParameter`` にする
+    """
+    from google.cloud import bigquery
+
+    parameters = []
+    for param in params:
+        typ = param["type"]
+        if typ.startswith("ARRAY<") and typ.endswith(">"):
+            parameters.append(
+                bigquery.ArrayQueryParameter(param["name"], typ[6:-1], param["value"])
+            )
+        else:
+            parameters.append(
+                bigquery.ScalarQueryParameter(param["name"], typ, param["value"])
+            )
+    return parameters
+
+
+def load_spec(path: str):
+    """テストケースのファイルを読む
+
+    ファイルには次のキーを書く。テストデータのファイルパスはこのファイルからの相対パス
+
+    * ``query`` か ``query_file`` : テストするクエリか、クエリのファイルパス
+    * ``params`` : クエリパラメータ。 ``{"name", "type", "value"}`` のリスト
+    * ``options`` : ``run()`` に渡す引数。 ``{"single_job": true}`` など
+    * ``cases`` : ``name`` 、 ``expected`` 、 ``tables`` を持つテストケースのリスト。
+      ``params`` と ``target`` も書ける
+
+    Returns:
+        (dict): ``query`` 、 ``params`` 、 ``options`` 、 ``cases`` を持つ辞書
+
+    Raises:
+        ValueError: 読めないファイルか、必要なキーがないとき
+    """
+    with open(path, encoding="utf-8") as f:
+        if Path(path).suffix == ".json":
+            spec = json.load(f)
+        else:
+            try:
+                import yaml
+            except ImportError as e:
+                raise ValueError(f"{path}: YAMLを読むには PyYAML が必要です") from e
+            spec = yaml.safe_load(f)
+
+    if not isinstance(spec, dict) or not isinstance(spec.get("cases"), list):
+        raise ValueError(f"{path}: cases がありません")
+    if ("query" in spec) == ("query_file" in spec):
+        raise ValueError(f"{path}: query か query_file のどちらかひとつを書いてください")
+
+    base = Path(path).parent
+    query = spec.get("query")
+    if query is None:
+        query = (base / spec["query_file"]).read_text(encoding="utf-8")
+
+    cases = []
+    names = set()
+    for i, case in enumerate(spec["cases"]):
+        if not isinstance(case, dict) or "name" not in case or "expected" not in case:
+            raise ValueError(f"{path}: {i} 番目のケースに name か expected がありません")
+        if case["name"] in names:
+            raise ValueError(f"{path}: ケースの名前 {case['name']} が重複しています")
+        names.add(case["name"])
+
+        case = dict(case, tables=dict(case.get("tables", {})))
+        for table in [case["expected"], *case["tables"].values()]:
+            if isinstance(table.get("datum"), str):
+                table["datum"] = str(base / table["datum"])
+        cases.append(case)
+
+    return {
+        "query": query,
+        "params": spec.get("params", []),
+        "options": spec.get("options", {}),
+        "cases": cases,
+    }
+
+
+def balance_groups(weights: dict, bins: int):
+    """重さの合計が偏らないように、まとまりを ``bins`` 個に振り分ける
+
+    重いものから順に、その時点で合計が最も軽いところへ入れる
+
+    Args:
+        weights (dict): まとまりの名前から重さ(秒)への辞書
+        bins (int): 振り分ける先の数
+
+    Returns:
+        (dict): まとまりの名前から、振り分けた先の番号への辞書
+    """
+    heap = [(0.0, i) for i in range(bins)]
+    assigned = {}
+    for name in sorted(weights, key=lambda name: (-weights[name], name)):
+        total, i = heapq.heappop(heap)
+        assigned[name] = i
+        heapq.heappush(heap, (total + weights[name], i))
+    return assigned
+
+
+class SpecCaseFailure(Exception):
+    """テストケースの結果が期待と違う"""
+
+    def __init__(self, diff: list):
+        super().__init__(f"{len(diff)} 行の差分があります")
+        self.diff = diff
+
+
+class SpecFile(pytest.File):
+    """テストケースのファイル。クエリの解析はファイルごとに一度だけ行う"""
+
+    _spec = None
+    _compiled = None
+
+    def spec(self):
+        if self._spec is None:
+            self._spec = load_spec(str(self.path))
+        return self._spec
+
+    def collect(self):
+        for case in self.spec()["cases"]:
+            yield SpecItem.from_parent(self, name=str(case["name"]), case=case)
+
+    def compiled(self, client):
+        if self._compiled is None:
+            spec = self.spec()
+            self._compiled = CompiledQueryTest(
+                client,
+                {"query": spec["query"], "params": query_parameters(spec["params"])},
+            )
+        return self._compiled
+
+    def options(self):
+        return self.spec()["options"]
+
+
+class SpecItem(pytest.Item):
+    """テストケースひとつ分のテスト"""
+
+    def __init__(self, *, case: dict, **kwargs):
+        super().__init__(**kwargs)
+        self._case = case
+
+    def history_key(self):
+        """実行時間の記録のキー。xdist がテストのIDを変えても変わらない"""
+        return f"{self.parent.nodeid}::{self.name}"
+
+    def query_test(self, client):
+        case = self._case
+        params = case.get("params")
+        return self.parent.compiled(client).case(
+            case["expected"],
+            case["tables"],
+            None if params is None else query_parameters(params),
+            case.get("target"),
+            name=self.history_key(),
+        )
+
+    def runtest(self):
+        result = self.config.pluginmanager.get_plugin(PLUGIN_NAME).result(self)
+        self.user_properties.append(("bqqtest_latency", result.latency))
+        if result.error is not None:
+            raise result.error
+        if not result.success:
+            raise SpecCaseFailure(result.diff)
+
+    def repr_failure(self, excinfo):
+        if isinstance(excinfo.value, SpecCaseFailure):
+            rows = [str(row) for row in excinfo.value.diff]
+            return "\n".join([f"{self.name}: {excinfo.value}"] + rows)
+        return super().repr_failure(excinfo)
+
+    def reportinfo(self):
+        return self.path, None, f"bqqtest: {self.name}"
+
+
+class BqqtestSession:
+    """セッションで共有するクライアントと、まとめて実行したテストの結果を持つ"""
+
+    def __init__(self, config):
+        self._config = config
+        self._client = None
+        self._lock = threading.Lock()
+        self._groups = {}
+        self._results = {}
+        self._finished = set()
+        self._durations = {}
+
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                config = self._config
+                client = config.hook.pytest_bqqtest_make_client(config=config)
+                if client is None:
+                    client = make_client(
+                        config.getoption("bqqtest_project"),
+                        config.getoption("bqqtest_pool_size"),
+                    )
+                self._client = client
+            return self._client
+
+    def close(self):
+        if self._client is not None and hasattr(self._client, "close"):
+            self._client.close()
+        self._client = None
+
+    def _worker_count(self):
+        return int(os.environ.get("PYTEST_XDIST_WORKER_COUNT", "1"))
+
+    def _loadgroup(self):
+        """pytest-xdist の ``--dist loadgroup`` で実行しているか
+
+        ワーカーでは ``dist`` が "no" に書き換わり、代わりに ``loadgroup`` が入る
+        """
+        option = self._config.option
+        return getattr(option, "loadgroup", False) or (
+            getattr(option, "dist", "no") == "loadgroup"
+        )
+
+    def history(self):
+        """前回までのテストケースごとの実行時間(秒)"""
+        cache = getattr(self._config, "cache", None)
+        return {} if cache is None else cache.get(DURATIONS_KEY, {})
+
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_collection_modifyitems(self, session, config, items):
+        # xdist がグループの名前をテストのIDに付けるより前に振り分ける
+        group_size = config.getoption("bqqtest_group_size")
+        loadgroup = self._loadgroup()
+        if self._worker_count() > 1 and not loadgroup:
+            # 同じまとまりのテストが別のワーカーで実行されるので、まとめない
+            group_size = 1
+
+        files = {}
+        for item in items:
+            if isinstance(item, SpecItem):
+                files.setdefault(item.parent, []).append(item)
+        groups = []
+        for file_items in files.values():
+            for start in range(0, len(file_items), group_size):
+                groups.append(file_items[start : start + group_size])
+        for group in groups:
+            for item in group:
+                self._groups[id(item)] = group
+
+        if not loadgroup or not groups:
+            return
+        history = self.history()
+        default = max(history.values()) if history else 1.0
+        # まとまりの中は並行に実行するので、最も遅いテストの時間をまとまりの重さにする
+        weights = {
+            i: max(history.get(item.history_key(), default) for item in group)
+            for i, group in enumerate(groups)
+        }
+        assigned = balance_groups(weights, self._worker_count())
+        for i, group in enumerate(groups):
+            for item in group:
+                group_name = f"{GROUP_PREFIX}{assigned[i]}"
+                item.add_marker(pytest.mark.xdist_group(group_name))
+
+    def result(self, item: "SpecItem"):
+        """テストケースの結果。まだなければ、同じまとまりのテストと一緒に実行する"""
+        if id(item) not in self._results:
+            group = [item]
+            if id(item) not in self._finished:
+                selected = {id(i) for i in item.session.items}
+                group = [
+                    i
+                    for i in self._groups.get(id(item), [item])
+                    if id(i) in selected
+                    and id(i) not in self._finished
+                    and id(i) not in self._results
+                ]
+            self._run(group)
+        self._finished.add(id(item))
+        return self._results.pop(id(item))
+
+    def _run(self, items: list):
+        client = self.client()
+        tests, runnable = [], []
+        for item in items:
+            try:
+                tests.append(item.query_test(client))
+                runnable.append(item)
+            except Exception as e:
+                self._results[id(item)] = QueryTestResult(False, [], 0.0, e)
+        if not tests:
+            return
+        results = run_many(
+            tests,
+            max_workers=self._config.getoption("bqqtest_max_workers"),
+            **items[0].parent.options(),
+        )
+        for item, result in zip(runnable, results):
+            self._results[id(item)] = result
+
+    def pytest_runtest_logreport(self, report):
+        if report.when != "call":
+            return
+        for name, value in report.user_properties:
+            if name == "bqqtest_latency":
+                # xdist がテストのIDに付けたグループの名前を除く
+                nodeid = report.nodeid
+                if GROUP_PREFIX in nodeid:
+                    nodeid = nodeid.rsplit("@" + GROUP_PREFIX, 1)[0]
+                self._durations[nodeid] = value
+
+    def pytest_sessionfinish(self, session):
+        cache = getattr(self._config, "cache", None)
+        # xdist のワーカーの結果はコントローラーが受け取って保存する
+        if cache is None or hasattr(self._config, "workerinput"):
+            return
+        if self._durations:
+            durations = self.history()
+            durations.update(self._durations)
+            cache.set(DURATIONS_KEY, durations)
+
+
+def pytest_addhooks(pluginmanager):
+    pluginmanager.add_hookspecs(pytest_hooks)
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("bqqtest")
+    group.addoption(
+        "--bqqtest-project", default=None, help="bqqtest_client のプロジェクト"
+    )
+    group.addoption(
+        "--bqqtest-pool-size",
+        type=int,
+        default=DEFAULT_POOL_SIZE,
+        help="bqqtest_client が使い回すHTTPの接続の数",
+    )
+    group.addoption(
+        "--bqqtest-group-size",
+        type=int,
+        default=DEFAULT_GROUP_SIZE,
+        help="テストケースのファイルから、まとめて並行に実行するテストの数",
+    )
+    group.addoption(
+        "--bqqtest-max-workers",
+        type=int,
+        default=DEFAULT_MAX_WORKERS,
+        help="まとめたテストを同時に実行するスレッドの数",
+    )
+
+
+def pytest_configure(config):
+    assert config.getoption("bqqtest_group_size") > 0
+    config.addinivalue_line(
+        "markers", "xdist_group(name): pytest-xdist の loadgroup で同じワーカーに送る"
+    )
+    config.pluginmanager.register(BqqtestSession(config), PLUGIN_NAME)
+
+
+def pytest_unconfigure(config):
+    session = config.pluginmanager.get_plugin(PLUGIN_NAME)
+    if session is not None:
+        session.close()
+        config.pluginmanager.unregister(session, PLUGIN_NAME)
+
+
+if PYTEST_MAJOR >= 7:
+
+    def pytest_collect_file(parent, file_path):
+        name, suffix = file_path.name, file_path.suffix
+        if name.startswith("bqqtest_") and suffix in SPEC_SUFFIXES:
+            return SpecFile.from_parent(parent, path=file_path)
+
+
+@pytest.fixture(scope="session")
+def bqqtest_client(pytestconfig):
+    """セッションで共有するクライアント。テストケースのファイルのテストも同じものを使う"""
+    return pytestconfig.pluginmanager.get_plugin(PLUGIN_NAME).client()
@@ -0,0 +1,243 @@
+import json
+import re
+from pathlib import Path
+
+import pytest
+
+from .pytest_plugin import DURATIONS_KEY, balance_groups, load_spec
+
+pytest_plugins = ["pytester"]
+
+schema = [
+    {"name": "name", "type": "STRING", "mode": "NULLABLE"},
+    {"name": "value", "type": "INT64", "mode": "NULLABLE"},
+]
+
+# すべてのジョブを記録するフェイククライアントを使う。
+# クエリに "fail" を含むテストだけ差分を返す
+conftest = """
+import os
+
+from google.cloud import bigquery
+
+from bqqtest.fake import FakeClient
+
+clients = []
+
+
+def handler(query, job_config):
+    if "fail" not in query or job_config.dry_run:
+        return [], 0
+    return [bigquery.Row(("+", "fail", 1), {"mark": 0, "name": 1, "value": 2})], 0
+
+
+def pytest_bqqtest_make_client(config):
+    clients.append(FakeClient(handler, latency=float(os.environ["FAKE_LATENCY"])))
+    return clients[-1]
+"""
+
+def spec(names, query="SELECT * FROM t", **kwargs):
+    return {
+        "query": query,
+        "cases": [
+            {
+                "name": name,
+                "tables": {"t": {"schema": schema, "datum": [[name, 1]]}},
+                "expected": {"schema": schema, "datum": [[name, 1]]},
+            }
+            for name in names
+        ],
+        **kwargs,
+    }
+
+
+@pytest.fixture
+def run(pytester, monkeypatch):
+    pytester.makeconftest(conftest)
+    # pandas は同じプロセスで読み込み直せないので、別のプロセスで実行する
+    monkeypatch.setenv("PYTHONPATH", str(Path(__file__).resolve().parent.parent))
+    monkeypatch.setenv("FAKE_LATENCY", "0")
+
+    def run(*args):
+        return pytester.runpytest_subprocess("-p", "bqqtest.pytest_plugin", *args)
+
+    return run
+
+
+def test_ファイルのテストケースを集めて実行する(pytester, run):
+    pytester.makefile(".json", bqqtest_items=json.dumps(spec(["a", "fail", "c"])))
+    pytester.makefile(".json", other=json.dumps(spec(["x"])))
+
+    result = run("-v")
+    result.assert_outcomes(passed=2, failed=1)
+    result.stdout.fnmatch_lines(["*bqqtest_items.json::fail FAILED*"])
+    result.stdout.fnmatch_lines(["*fail: 1 行の差分があります*"])
+
+
+def test_同じファイルのテストケースはまとめて並行に実行する(pytester, run, monkeypatch):
+    monkeypatch.setenv("FAKE_LATENCY", "0.2")
+    pytester.makefile(".json", bqqtest_items=json.dumps(spec("abcde")))
+    pytester.makepyfile(
+        test_jobs="""
+import conftest
+
+
+def test_jobs(bqqtest_client):
+    assert conftest.clients == [bqqtest_client]
+    assert len(bqqtest_client.jobs) == 10
+    # 3件と2件のまとまりごとに、テストのジョブを同時に発行している
+    assert bqqtest_client.max_running_jobs == 3
+"""
+    )
+    result = run("--bqqtest-group-size", "3")
+    result.assert_outcomes(passed=6)
+
+
+def workers(result):
+    """``-v`` の出力から、テストケースの名前から実行したワーカーへの辞書を作る"""
+    assigned = {}
+    for line in result.stdout.lines:
+        m = re.match(r"\[(gw\d+)\] .*PASSED bqqtest_items\.json::(\w+)@", line)
+        if m:
+            assigned[m.group(2)] = m.group(1)
+    return assigned
+
+
+def test_xdistのloadgroupではまとまりを同じワーカーで実行する(pytester, run):
+    pytest.importorskip("xdist")
+    pytester.makefile(".json", bqqtest_items=json.dumps(spec("abcdef")))
+
+    result = run("-n", "2", "--dist", "loadgroup", "--bqqtest-group-size", "2", "-v")
+    result.assert_outcomes(passed=6)
+    assigned = workers(result)
+    assert assigned["a"] == assigned["b"]
+    assert assigned["c"] == assigned["d"]
+    assert assigned["e"] == assigned["f"]
+    assert len(set(assigned.values())) == 2
+
+
+def test_xdistのloadgroupでは実行時間でワーカーに振り分ける(pytester, run):
+    pytest.importorskip("xdist")
+    pytester.makefile(".json", bqqtest_items=json.dumps(spec("abcd")))
+    cache = pytester.path / ".pytest_cache" / "v" / DURATIONS_KEY
+    cache.parent.mkdir(parents=True)
+    history = {"a": 4.0, "b": 3.0, "c": 2.0, "d": 1.0}
+    cache.write_text(
+        json.dumps({f"bqqtest_items.json::{k}": v for k, v in history.items()})
+    )
+
+    result = run("-n", "2", "--dist", "loadgroup", "--bqqtest-group-size", "1", "-v")
+    result.assert_outcomes(passed=4)
+    assigned = workers(result)
+    # 4+1 と 3+2 に分かれる
+    assert assigned["a"] == assigned["d"] != assigned["b"] == assigned["c"]
+    # ワーカーの実行時間は、xdist が付けたグループの名前を除いたIDで保存する
+    assert sorted(json.loads(cache.read_text())) == [
+        f"bqqtest_items.json::{k}" for k in "abcd"
+    ]
+
+
+def test_実行しないテストケースは発行しない(pytester, run):
+    pytester.makefile(
+        ".json", bqqtest_items=json.dumps(spec(["alpha", "beta", "gamma"]))
+    )
+    pytester.makepyfile(
+        test_jobs="""
+def test_jobs(bqqtest_client):
+    assert len(bqqtest_client.jobs) == 2
+"""
+    )
+    result = run("-k", "beta or jobs")
+    result.assert_outcomes(passed=2)
+
+
+def test_runの引数とクエリパラメータを渡す(pytester, run):
+    options = {
+        "options": {"single_job": True},
+        "params": [{"name": "v", "type": "INT64", "value": 0}],
+    }
+    pytester.makefile(
+        ".json",
+        bqqtest_items=json.dumps(
+            spec(["a"], "SELECT * FROM t WHERE value > @v", **options)
+        ),
+    )
+    pytester.makepyfile(
+        test_jobs="""
+def test_jobs(bqqtest_client):
+    (job,) = bqqtest_client.jobs
+    assert [p.value for p in job.job_config.query_parameters] == [0]
+"""
+    )
+    run().assert_outcomes(passed=2)
+
+
+def test_実行時間を記録する(pytester, run):
+    pytester.makefile(".json", bqqtest_items=json.dumps(spec(["a"])))
+    run().assert_outcomes(passed=1)
+
+    cache = pytester.path / ".pytest_cache" / "v" / DURATIONS_KEY
+    assert list(json.loads(cache.read_text())) == ["bqqtest_items.json::a"]
+
+
+def test_テストデータのファイルはテストケースのファイルからの相対パス(tmp_path):
+    (tmp_path / "data").mkdir()
+    (tmp_path / "data" / "t.json").write_text(json.dumps([["a", 1]]))
+    (tmp_path / "q.sql").write_text("SELECT * FROM t")
+    path = tmp_path / "bqqtest_items.json"
+    path.write_text(
+        json.dumps(
+            {
+                "query_file": "q.sql",
+                "cases": [
+                    {
+                        "name": "a",
+                        "tables": {"t": {"schema": schema, "datum": "data/t.json"}},
+                        "expected": {"schema": schema, "datum": [["a", 1]]},
+                    }
+                ],
+            }
+        )
+    )
+    loaded = load_spec(str(path))
+    assert loaded["query"] == "SELECT * FROM t"
+    assert loaded["cases"][0]["tables"]["t"]["datum"] == str(tmp_path / "data/t.json")
+
+
+@pytest.mark.parametrize(
+    "content, message",
+    **{
+        "argvalues": [
+            ({"query": "SELECT 1"}, "cases がありません"),
+            ({"cases": []}, "query か query_file"),
+            ({"query": "SELECT 1", "cases": [{"name": "a"}]}, "name か expected"),
+            (
+                {"query": "SELECT 1", "cases": [{"name": "a", "expected": {}}] * 2},
+                "重複",
+            ),
+        ],
+        "ids": ["ケースがない", "クエリがない", "期待する結果がない", "名前の重複"],
+    },
+)
+def test_テストケースのファイルの誤りはValueError(tmp_path, content, message):
+    path = tmp_path / "bqqtest_items.json"
+    path.write_text(json.dumps(content))
+    with pytest.raises(ValueError, match=message):
+        load_spec(str(path))
+
+
+def test_YAMLのテストケース(tmp_path):
+    yaml = pytest.importorskip("yaml")
+    path = tmp_path / "bqqtest_items.yaml"
+    path.write_text(yaml.safe_dump(spec(["a"])))
+    assert load_spec(str(path))["cases"][0]["name"] == "a"
+
+
+def test_実行時間が偏らないように振り分ける():
+    weights = {"a": 5.0, "b": 4.0, "c": 3.0, "d": 3.0, "e": 1.0}
+    assigned = balance_groups(weights, 2)
+    totals = [0.0, 0.0]
+    for name, i in assigned.items():
+        totals[i] += weights[name]
+    assert sorted(totals) == [8.0, 8.0]
+    assert balance_groups(weights, 2) == assigned
@@ -0,0 +1,178 @@
+"""テストをまたいでテストデータを共有するためのレジストリ
+
+たくさんのテストが同じマスタテーブルのテストデータを使うとき、
+テストごとにファイルを読み直してSQLに変換するのは無駄になる。
+テストデータとスキーマの内容のハッシュ値をキーにして、読み込みと変換を一度だけにする
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+
+# 既定で保持するテストデータのSQLの大きさの合計(バイト)
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+# 既定で中身のハッシュ値を覚えておくファイルの数
+DEFAULT_MAX_FILES = 4096
+
+_non_identifier = re.compile(r"[^A-Za-z0-9_]+")
+
+
+def _json_default(value):
+    # JSONにできない値は型名を付けて文字列にし、同じ表記の文字列と区別する
+    return {"__type__": type(value).__name__, "value": str(value)}
+
+
+class FixtureRegistry:
+    """内容のハッシュ値から、作ったテーブルへの辞書
+
+    エントリの大きさの合計が ``max_bytes`` を超えると、最近使われていないものから捨てる。
+    複数のスレッドから使える
+
+    Args:
+        max_bytes (int): 保持するエントリの大きさの合計の上限(バイト)
+        max_files (int): 中身のハッシュ値を覚えておくファイルの数の上限。
+            超えると最近使われていないものから忘れる
+    """
+
+    _max_bytes = DEFAULT_MAX_BYTES
+    _max_files = DEFAULT_MAX_FILES
+
+    def __init__(
+        self, max_bytes: int = DEFAULT_MAX_BYTES, max_files: int = DEFAULT_MAX_FILES
+    ):
+        assert max_bytes >= 0
+        assert max_files >= 0
+        self._max_bytes = max_bytes
+        self._max_files = max_files
+        self._entries = OrderedDict()
+        self._file_digests = OrderedDict()
+        self._size = 0
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+    def _file_digest(self, filename: str):
+        """ファイルの中身のハッシュ値。更新日時と大きさが同じなら読み直さない"""
+        stat = os.stat(filename)
+        signature = (os.path.abspath(filename), stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            if signature in self._file_digests:
+                self._file_digests.move_to_end(signature)
+                return self._file_digests[signature]
+
+        sha = hashlib.sha256()
+        with open(filename, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                sha.update(block)
+        digest = sha.hexdigest()
+        with self._lock:
+            self._file_digests[signature] = digest
+            while len(self._file_digests) > self._max_files:
+                self._file_digests.popitem(last=False)
+        return digest
+
+    def key(self, datum, schema):
+        """テストデータとスキーマの内容から作るキー
+
+        Args:
+            datum: レコードのリストか、データのファイルパス
+            schema: ``Schema`` 。 ``str()`` が列名と型を表す
+
+        Returns:
+            (str): SHA-256のハッシュ値
+        """
+        if isinstance(datum, str):
+            content = ["file", self._file_digest(datum), os.path.splitext(datum)[1]]
+        else:
+            content = ["records", datum]
+        payload = json.dumps(
+            [str(schema), content], default=_json_default, ensure_ascii=False
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def alias(key: str, source: str = None):
+        """キーと元のテーブル名から決まるテーブル名
+
+        元のテーブル名は読めるように英数字とアンダースコアにして残し、
+        元のテーブル名と内容のハッシュ値で衝突を防ぐ。同じ入力からはいつも同じ名前になる
+
+        Args:
+            key (str): ``key()`` で作ったキー
+            source (str): クエリの中の元のテーブル名
+        """
+        if source is None:
+            return f"fixture_{key[:16]}"
+        digest = hashlib.sha256(f"{source}\0{key}".encode("utf-8")).hexdigest()
+        readable = _non_identifier.sub("_", source).strip("_")[:32]
+        if readable == "":
+            return f"fixture_{digest[:16]}"
+        return f"fixture_{readable}_{digest[:16]}"
+
+    def get(self, key: str, build):
+        """キーのエントリを返す。なければ ``build()`` で作って保持する
+
+        Args:
+            key (str): ``key()`` で作ったキー
+            build (callable): ``(エントリ, 大きさ)`` を返す関数
+
+        Returns:
+            エントリ
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return self._entries[key][0]
+            self._misses += 1
+
+        # 作るのに時間がかかるので、ロックの外で作る
+        entry, size = build()
+        with self._lock:
+            if key not in self._entries and size <= self._max_bytes:
+                self._entries[key] = (entry, size)
+                self._size += size
+                self._evict()
+        return entry
+
+    def _evict(self):
+        while self._size > self._max_bytes:
+            _, (_, size) = self._entries.popitem(last=False)
+            self._size -= size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._file_digests.clear()
+            self._size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def size(self):
+        """保持しているエントリの大きさの合計(バイト)"""
+        return self._size
+
+    def stats(self):
+        """``{"entries", "bytes", "hits", "misses", "files"}`` の辞書
+
+        ``files`` は中身のハッシュ値を覚えているファイルの数
+        """
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "hits": self._hits,
+                "misses": self._misses,
+                "files": len(self._file_digests),
+            }
+
+
+_default_registry = FixtureRegistry()
+
+
+def default_registry():
+    """プロセス全体で共有するレジストリ"""
+    return _default_registry
@@ -0,0 +1,178 @@
+import datetime
+import json
+import os
+import sys
+
+import pytest
+
+from .registry import FixtureRegistry, default_registry
+from .table import PooledTable, Schema
+
+schema = Schema(
+    [
+        {"name": "name", "type": "STRING", "mode": "NULLABLE"},
+        {"name": "value", "type": "INT64", "mode": "NULLABLE"},
+    ]
+)
+
+
+def entry(size):
+    calls = []
+
+    def build():
+        calls.append(size)
+        return f"entry{len(calls)}", size
+
+    return build, calls
+
+
+@pytest.mark.parametrize(
+    "a, b",
+    **{
+        "argvalues": [
+            ([["a", 1]], [["a", 1.0]]),
+            ([["1", 1]], [[1, 1]]),
+            ([[True, 1]], [[1, 1]]),
+            ([["2020-01-01", 1]], [[datetime.date(2020, 1, 1), 1]]),
+            ([["a", None]], [["a", 0]]),
+        ],
+        "ids": ["intとfloat", "文字列と整数", "boolと整数", "文字列と日付", "nullと0"],
+    },
+)
+def test_表記の似た値は別のキーになる(a, b):
+    registry = FixtureRegistry()
+    assert registry.key(a, schema) != registry.key(b, schema)
+
+
+def test_キーは内容とスキーマから決まる():
+    registry = FixtureRegistry()
+    other = Schema([{"name": "name", "type": "STRING", "mode": "NULLABLE"}])
+    key = registry.key([["a", 1]], schema)
+    assert key == FixtureRegistry().key([["a", 1]], schema)
+    assert key != registry.key([["a", 2]], schema)
+    assert key != registry.key([["a", 1]], other)
+    assert registry.alias(key) == f"fixture_{key[:16]}"
+
+
+@pytest.mark.parametrize(
+    "source, prefix",
+    **{
+        "argvalues": [
+            ("t", "fixture_t_"),
+            ("project.dataset.table", "fixture_project_dataset_table_"),
+            ("`project.dataset.table`", "fixture_project_dataset_table_"),
+            ("テーブル", "fixture_"),
+        ],
+        "ids": ["名前だけ", "データセット付き", "バッククォート", "英数字がない"],
+    },
+)
+def test_テーブル名は元の名前を残す(source, prefix):
+    key = FixtureRegistry().key([["a", 1]], schema)
+    alias = FixtureRegistry.alias(key, source)
+    assert alias.startswith(prefix)
+    assert len(alias) == len(prefix) + 16
+    assert alias == FixtureRegistry.alias(key, source)
+
+
+def test_テーブル名は元の名前と内容で変わる():
+    registry = FixtureRegistry()
+    key1 = registry.key([["a", 1]], schema)
+    key2 = registry.key([["a", 2]], schema)
+    # 英数字にすると同じになる名前でも衝突しない
+    aliases = {
+        registry.alias(key1, "a.b"),
+        registry.alias(key1, "a_b"),
+        registry.alias(key2, "a.b"),
+    }
+    assert len(aliases) == 3
+
+
+def test_ファイルは中身が同じなら同じキーになる(tmp_path):
+    registry = FixtureRegistry()
+    a, b = tmp_path / "a.json", tmp_path / "b.json"
+    a.write_text(json.dumps([["a", 1]]))
+    b.write_text(json.dumps([["a", 1]]))
+    assert registry.key(str(a), schema) == registry.key(str(b), schema)
+
+    key = registry.key(str(a), schema)
+    a.write_text(json.dumps([["a", 2]]))
+    os.utime(a, ns=(0, 0))
+    assert registry.key(str(a), schema) != key
+
+
+def test_ハッシュ値を覚えておくファイルの数には上限がある(tmp_path):
+    registry = FixtureRegistry(max_files=2)
+    for i in range(3):
+        path = tmp_path / f"{i}.json"
+        path.write_text(json.dumps([["a", i]]))
+        registry.key(str(path), schema)
+    assert registry.stats()["files"] == 2
+
+
+def test_同じキーは一度だけ作る():
+    registry = FixtureRegistry()
+    build, calls = entry(10)
+    assert registry.get("k", build) == "entry1"
+    assert registry.get("k", build) == "entry1"
+    assert calls == [10]
+    assert registry.stats() == {
+        "entries": 1,
+        "bytes": 10,
+        "hits": 1,
+        "misses": 1,
+        "files": 0,
+    }
+
+
+def test_大きさの上限を超えると最近使っていないものから捨てる():
+    registry = FixtureRegistry(max_bytes=25)
+    registry.get("a", entry(10)[0])
+    registry.get("b", entry(10)[0])
+    registry.get("a", entry(10)[0])
+    registry.get("c", entry(10)[0])
+
+    assert len(registry) == 2 and registry.size() == 20
+    build, calls = entry(10)
+    registry.get("a", build)
+    assert calls == []
+    registry.get("b", build)
+    assert calls == [10]
+
+
+def test_上限より大きいエントリは保持しない():
+    registry = FixtureRegistry(max_bytes=5)
+    registry.get("small", entry(5)[0])
+    assert registry.get("large", entry(10)[0]) == "entry1"
+    assert len(registry) == 1 and registry.size() == 5
+
+
+def test_テーブルはデータ部分のSQLを共有する():
+    registry = FixtureRegistry()
+    t1 = PooledTable.load(registry, [["a", 1]], schema)
+    t2 = PooledTable.load(registry, [["a", 1]], schema, "EXPECTED")
+
+    assert t1.name() == registry.alias(registry.key([["a", 1]], schema))
+    assert t2.name() == "EXPECTED"
+    assert t1.rows_sql() is t2.rows_sql()
+    assert t2.to_sql() == (
+        "EXPECTED AS (\n"
+        "SELECT * FROM UNNEST(ARRAY<STRUCT<name STRING, value INT64>>\n"
+        '[("a",1)]\n)\n)'
+    )
+    assert t1.records() == [{"name": "a", "value": 1}]
+    assert len(registry) == 1
+
+
+def test_読み込んだデータはレジストリに入れない(tmp_path):
+    path = tmp_path / "t.json"
+    path.write_text(json.dumps([["a", 1], ["b", 2]]))
+    registry = FixtureRegistry()
+    table = PooledTable.load(registry, str(path), schema)
+
+    # レジストリの大きさはデータ部分のSQLだけで決まる
+    assert registry.size() == sys.getsizeof(table.rows_sql())
+    assert table.records() == [{"name": "a", "value": 1}, {"name": "b", "value": 2}]
+
+
+def test_既定のレジストリはプロセスで1つ():
+    assert default_registry() is default_registry()
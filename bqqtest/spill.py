@@ -0,0 +1,107 @@
+"""クエリに埋め込めない大きなテストデータをロードジョブでBigQueryへ書き出す"""
+import contextlib
+import uuid
+
+# BigQueryのクエリ文字列の長さの上限
+# see: https://cloud.google.com/bigquery/quotas#query_jobs
+MAX_QUERY_LENGTH = 1024 * 1024
+
+
+class SpilledTable:
+    """ロードジョブで書き出したテーブルを参照するWITH句のテーブル"""
+
+    _name = ""
+    _table_id = ""
+    _original = None
+    _num_bytes = 0
+
+    def __init__(self, name: str, table_id: str, original, num_bytes: int):
+        self._name = name
+        self._table_id = table_id
+        self._original = original
+        self._num_bytes = num_bytes
+
+    def iter_sql(self):
+        yield f"{self._name} AS (\nSELECT * FROM `{self._table_id}`\n)"
+
+    def to_sql(self):
+        return "".join(self.iter_sql())
+
+    def name(self):
+        return self._name
+
+    def table_id(self):
+        return self._table_id
+
+    def original(self):
+        return self._original
+
+    def num_bytes(self):
+        return self._num_bytes
+
+
+class FixtureSpiller:
+    """テストデータをデータセットへまとめてロードする
+
+    ロードしたテーブルは ``delete`` で削除する。削除し損ねたときのために、
+    データセットにはテーブルの有効期限を設定しておくことをおすすめする
+
+    Args:
+        client (bigquery.Client): クライアント
+        dataset (str): 書き出し先のデータセット。 ``project.dataset`` の形式
+    """
+
+    _client = None
+    _dataset = ""
+
+    def __init__(self, client, dataset: str):
+        assert isinstance(dataset, str) and dataset != ""
+        self._client = client
+        self._dataset = dataset
+
+    def load(self, tables: list, spilled: list = None):
+        """テーブルをロードする
+
+        すべてのロードジョブを発行してから完了を待つので、ロードは並行して進む。
+        どれかのロードが失敗したときは、発行済みのジョブがすべて終わるのを待ってから
+        例外を送出するので、 ``spilled`` のテーブルを ``delete`` すれば後に残らない
+
+        Args:
+            tables (list): ロードする ``Table`` のリスト
+            spilled (list): 指定すると、ロードジョブを発行するたびに
+                ``SpilledTable`` を追加する
+
+        Returns:
+            list: ``SpilledTable`` のリスト。 ``tables`` と同じ順
+        """
+        from google.cloud import bigquery
+
+        spilled = [] if spilled is None else spilled
+        jobs = []
+        try:
+            for table in tables:
+                name = table.name()
+                table_id = f"{self._dataset}.bqqtest_{name}_{uuid.uuid4().hex[:8]}"
+                job_config = bigquery.LoadJobConfig(
+                    schema=table.schema_fields(),
+                    write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+                )
+                job = self._client.load_table_from_json(
+                    table.records(), table_id, job_config=job_config
+                )
+                jobs.append((SpilledTable(name, table_id, table, 0), job))
+                spilled.append(jobs[-1][0])
+
+            for spilled_table, job in jobs:
+                job.result()
+                spilled_table._num_bytes = job.output_bytes or 0
+        except Exception:
+            for _, job in jobs:
+                with contextlib.suppress(Exception):
+                    job.result()
+            raise
+        return [spilled_table for spilled_table, _ in jobs]
+
+    def delete(self, spilled: list):
+        for table in spilled:
+            self._client.delete_table(table.table_id(), not_found_ok=True)
@@ -0,0 +1,106 @@
+"""たくさんのクエリのテストを並行して実行する"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# プロジェクトごとに同時に実行するテストの数の初期値
+# BigQueryのインタラクティブクエリの同時実行数の上限より小さくしておく
+# see: https://cloud.google.com/bigquery/quotas#query_jobs
+DEFAULT_MAX_JOBS_PER_PROJECT = 50
+
+
+class QueryTestResult:
+    """テストひとつ分の結果
+
+    Attributes:
+        success (bool): 差分がなければTrue。例外が起きたときはFalse
+        diff (list): 差分のレコード
+        latency (float): テストの実行にかかった秒数。同時実行数の空き待ちは含まない
+        error (Exception): テスト中に起きた例外。起きなければNone
+        metrics (RunMetrics): テストの ``metrics()`` 。まとめて実行したテストなどはNone
+    """
+
+    def __init__(
+        self, success: bool, diff: list, latency: float, error=None, metrics=None
+    ):
+        self.success = success
+        self.diff = diff
+        self.latency = latency
+        self.error = error
+        self.metrics = metrics
+
+    def __iter__(self):
+        # success, diff = result と書けるようにする
+        return iter((self.success, self.diff))
+
+    def __repr__(self):
+        return (
+            f"QueryTestResult(success={self.success}, diff={self.diff}, "
+            f"latency={self.latency:.3f}, error={self.error!r})"
+        )
+
+
+class QueryTestSuite:
+    """``QueryTest`` や ``QueryLogicTest`` をスレッドプールで並行して実行する
+
+    Args:
+        tests (list): ``run()`` と ``client()`` を持つテストのリスト
+        max_workers (int): 同時に実行するテストの数
+        max_jobs_per_project (int): プロジェクトごとに同時に実行するテストの数
+    """
+
+    _tests = []
+    _max_workers = 8
+    _max_jobs_per_project = DEFAULT_MAX_JOBS_PER_PROJECT
+
+    def __init__(
+        self,
+        tests: list,
+        max_workers: int = 8,
+        max_jobs_per_project: int = DEFAULT_MAX_JOBS_PER_PROJECT,
+    ):
+        assert isinstance(tests, list)
+        assert max_workers > 0 and max_jobs_per_project > 0
+
+        self._tests = tests
+        self._max_workers = max_workers
+        self._max_jobs_per_project = max_jobs_per_project
+
+    def run(self, **run_kwargs):
+        """すべてのテストを実行する
+
+        Args:
+            run_kwargs: 各テストの ``run()`` にそのまま渡す
+
+        Returns:
+            list: ``QueryTestResult`` のリスト。 ``tests`` と同じ順
+        """
+        semaphores = {
+            project: threading.BoundedSemaphore(self._max_jobs_per_project)
+            for project in {test.client().project for test in self._tests}
+        }
+
+        def run_one(test):
+            with semaphores[test.client().project]:
+                started = time.perf_counter()
+                try:
+                    success, diff = test.run(**run_kwargs)
+                    error = None
+                except Exception as e:
+                    success, diff, error = False, [], e
+                latency = time.perf_counter() - started
+                metrics = test.metrics() if hasattr(test, "metrics") else None
+                return QueryTestResult(success, diff, latency, error, metrics)
+
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            return list(executor.map(run_one, self._tests))
+
+
+def run_many(
+    tests: list,
+    max_workers: int = 8,
+    max_jobs_per_project: int = DEFAULT_MAX_JOBS_PER_PROJECT,
+    **run_kwargs,
+):
+    """``QueryTestSuite(tests, ...).run(**run_kwargs)`` の省略形"""
+    return QueryTestSuite(tests, max_workers, max_jobs_per_project).run(**run_kwargs)
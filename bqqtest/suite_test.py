@@ -0,0 +1,56 @@
+import time
+
+import pytest
+
+from .fake import FakeClient
+from .suite import QueryTestSuite, run_many
+
+
+def test_結果はテストと同じ順に返ってくる(query_test):
+    client = FakeClient(
+        lambda query, job_config: ([("+", "abc", 2)] if ",2)" in query else [], 0)
+    )
+    results = run_many(
+        [query_test(client, [["abc", i]]) for i in range(5)], max_workers=3
+    )
+
+    assert [r.success for r in results] == [True, True, False, True, True]
+    success, diff = results[2]
+    assert not success and diff == [("+", "abc", 2)]
+    assert all(r.latency >= 0 and r.error is None for r in results)
+
+
+def test_テストは並行して実行される(query_test):
+    client = FakeClient(latency=0.1)
+    tests = [query_test(client, [["abc", i]]) for i in range(10)]
+
+    started = time.perf_counter()
+    QueryTestSuite(tests, max_workers=10).run(single_job=True)
+
+    assert time.perf_counter() - started < 0.5
+    assert client.max_running_jobs > 1
+
+
+def test_プロジェクトごとの同時実行数を超えない(query_test):
+    client1 = FakeClient(latency=0.05, project="p1")
+    client2 = FakeClient(latency=0.05, project="p2")
+    tests = [query_test(client1, [["abc", i]]) for i in range(6)]
+    tests += [query_test(client2, [["abc", i]]) for i in range(6)]
+
+    QueryTestSuite(tests, max_workers=12, max_jobs_per_project=2).run(single_job=True)
+
+    assert client1.max_running_jobs == 2
+    assert client2.max_running_jobs == 2
+
+
+def test_例外が起きたテストは失敗として記録する(query_test):
+    client = FakeClient(lambda query, job_config: ([], 100))
+    results = run_many([query_test(client, [["abc", 1]])])
+
+    assert not results[0].success
+    assert isinstance(results[0].error, AssertionError)
+
+
+def test_同時実行数はゼロにできない():
+    with pytest.raises(AssertionError):
+        QueryTestSuite([], max_workers=0)
@@ -1,54 +1,98 @@
 import csv
+import functools
+import inspect
 import json
-import random
 import re
-import string
+import sys
+import time
 from pathlib import Path
 
-import pandas as pd
-import regex
-from google.cloud import bigquery
+from .cache import ResultCache, is_deterministic
+from .columns import ColumnStore
+from .encoders import encode_values, escape, json_value_encoder, value_encoder
+from .graph import DependencyGraph
+from .loaders import file_format, import_pyarrow, iter_record_chunks, read_records
+from .metrics import RunMetrics, recording
+from .registry import FixtureRegistry, default_registry
+from .spill import MAX_QUERY_LENGTH, FixtureSpiller
+from .types import (
+    PRIMITIVE_TYPES,
+    ArrayType,
+    PrimitiveType,
+    is_valid_type,
+    parse_type,
+)
+from .util import (
+    TableRewriter,
+    quote_identifier,
+    split_table_name,
+    split_with_clause,
+)
+
+# データ走査量がゼロでないクエリをセーフティネットで止めるときのメッセージ
+ZERO_SCAN_MESSAGE = "クエリのデータ走査量がゼロではありません。クエリを再確認してください"
+
+
+def is_bytes_processed_allowed(query_job, spilled: list = ()):
+    """データ走査量がゼロか、走査したのがロードジョブで書き出したテーブルだけならTrue
 
-from .util import get_query_from_with_clause
+    Args:
+        query_job: ``bigquery.QueryJob``
+        spilled (list): ロードジョブで書き出した ``SpilledTable`` のリスト
+    """
+    if query_job.total_bytes_processed == 0:
+        return True
+    tables = {split_table_name(table.table_id())[-2:] for table in spilled}
+    referenced = [
+        (table.dataset_id, table.table_id)
+        for table in query_job.referenced_tables or []
+    ]
+    return referenced != [] and all(table in tables for table in referenced)
 
 
-def randomname(n):
-    """ランダムな文字列を返す
+def write_sql(fragments):
+    """SQLの断片をつなげて1つの文字列にする
+
+    断片は受け取った順に末尾へ追記してすぐに手放すので、
+    すべての断片と連結後の文字列を同時に保持しない。
+    CPythonでは参照がひとつだけの文字列への ``+=`` はその場で拡張されるため、
+    ピークメモリは最終的なクエリの大きさに近くなる
 
     Args:
-        n (int): 文字列長
+        fragments (iterable): SQLの断片
 
     Returns:
-        (str): ランダムな文字列(n文字)
+        (str): SQL
     """
-    return "".join(random.choices(string.ascii_letters, k=n))
+    sql = ""
+    for fragment in fragments:
+        sql += fragment
+    return sql
+
+
+@functools.lru_cache(maxsize=None)
+def _column_type(_name, _type):
+    """列名を検証し、型を構文木にする。同じ列はスキーマをいくつ作っても一度だけ検証する"""
+    assert (
+        type(_name) is str
+        and _name != ""
+        and "\n" not in _name
+        and " " not in _name
+        and "," not in _name
+    )
+    assert type(_type) is str and _type != ""
+    try:
+        return parse_type(_type)
+    except ValueError as e:
+        raise AssertionError(str(e)) from e
 
 
 class ColumnMeta:
-    usable_primitive_types = [
-        "INT64",
-        "NUMERIC",
-        "FLOAT64",
-        "BOOL",
-        "STRING",
-        "BYTES",
-        "DATE",
-        "DATETIME",
-        "GEOGRAPHY",
-        "TIME",
-        "TIMESTAMP",
-    ]
+    usable_primitive_types = list(PRIMITIVE_TYPES)
 
     def __init__(self, _name, _type):
-        assert (
-            type(_name) is str
-            and _name != ""
-            and "\n" not in _name
-            and " " not in _name
-            and "," not in _name
-        )
-        assert type(_type) is str and _type != "" and self.is_usable_type(_type)
-
+        assert type(_name) is str and type(_type) is str
+        self._parsed = _column_type(_name, _type)
         self._name = _name
         self._type = _type
 
@@ -60,20 +104,8 @@ class ColumnMeta:
 
         Returns:
             bool: Trueなら使える型、Falseなら使えない型
-
-        Note:
-            ARRAY<ARRAY<STRING>> を許してしまうバグがある。このような記述は本来できない。
-            see: https://cloud.google.com/bigquery/docs/reference/standard-sql/data-types?hl=ja#examples_2
         """
-        if t in self.usable_primitive_types:
-            return True
-
-        if re.match(r"^(ARRAY|STRUCT)<.*>$", t):
-            new_t = re.sub(r"^(ARRAY|STRUCT)<", "", t)
-            new_t = re.sub(r">$", "", new_t)
-            return self.is_usable_type(new_t)
-
-        return False
+        return is_valid_type(t)
 
     def __str__(self):
         return f"{self._name} {self._type}"
@@ -84,39 +116,106 @@ class ColumnMeta:
     def typ(self):  # avoid reserved word
         return self._type
 
+    def parsed_type(self):
+        """型の構文木。 ``bqqtest.types`` を参照"""
+        return self._parsed
+
+    def schema_field(self):
+        """ロードジョブ用のスキーマに変換する
+
+        Returns:
+            bigquery.SchemaField: 名前のないフィールドを持つSTRUCTなど、変換できない型ならNone
+        """
+        return self._schema_field(self._name, self._parsed)
+
+    @staticmethod
+    def _schema_field(name, parsed, mode="NULLABLE"):
+        from google.cloud import bigquery
+
+        if isinstance(parsed, PrimitiveType):
+            return bigquery.SchemaField(name, parsed.name, mode=mode)
+        if isinstance(parsed, ArrayType):
+            return ColumnMeta._schema_field(name, parsed.element, mode="REPEATED")
+
+        fields = []
+        for field_name, field_type in parsed.fields:
+            field = None
+            if field_name is not None:
+                field = ColumnMeta._schema_field(field_name, field_type)
+            if field is None:
+                return None
+            fields.append(field)
+        return bigquery.SchemaField(name, "RECORD", mode=mode, fields=fields)
+
 
 class Schema:
     def __init__(self, columns: list):
         assert type(columns) is list and columns
         self.column_list = self.list_to_columns(columns)
+        self._names = [col.name() for col in self.column_list]
+        self._types = [col.typ().lower() for col in self.column_list]
 
     def list_to_columns(self, columns: list):
         return [ColumnMeta(column["name"], column["type"]) for column in columns]
 
     def __str__(self):
-        if len(self.column_list) == 1:
-            return ""
-
         c = ", ".join([str(cl) for cl in self.column_list])
         return f"STRUCT<{c}>"
 
     def names(self):
-        return [col.name() for col in self.column_list]
+        return list(self._names)
 
     def types(self):
-        return [col.typ().lower() for col in self.column_list]
+        return list(self._types)
+
+    def parsed_types(self):
+        """列の型の構文木のリスト"""
+        return [col.parsed_type() for col in self.column_list]
+
+    def schema_fields(self):
+        """ロードジョブ用のスキーマに変換する
+
+        Returns:
+            list: ``bigquery.SchemaField`` のリスト。変換できない列があればNone
+        """
+        fields = [col.schema_field() for col in self.column_list]
+        if any(field is None for field in fields):
+            return None
+        return fields
+
+
+# FLOAT64の値ひとつをリテラルにする。 inf と -inf は CAST にする
+_encode_float = value_encoder(PrimitiveType("FLOAT64"))
+
 
 class Table:
-    # pandasを使っても良いかもしれない
     _schema = None
     _rows = None
     _name = None
+    # SQLを生成するときに一度に変換する行数
+    chunk_size = 10000
+    # テストデータの持ち方。 "pandas" なら pd.DataFrame 、 "columns" なら ColumnStore
+    backend = "pandas"
+    # 列ごとにまとめてリテラルにする型。ほかの型は encoders で値ごとに変換する
+    vectorized_types = ("int64", "float64", "bool", "string")
 
-    def __init__(self, _filename_or_list, _schema: list, _name: str = ""):
+    def __init__(
+        self, _filename_or_list, _schema, _name: str = "", backend: str = None
+    ):
+        """
+        Args:
+            _filename_or_list: データのファイルパスか、レコードのリスト
+            _schema: スキーマを表す辞書のリストか、検証済みの ``Schema``
+            _name (str): WITH句でのテーブル名
+            backend (str): "pandas" か "columns"。省略時は ``Table.backend`` 。
+                "columns" はpandasを使わないので、小さいテストデータを大量に作るときに軽い
+        """
         assert type(_filename_or_list) is str or type(_filename_or_list) is list
-        assert type(_schema) is list and _schema
+        assert (type(_schema) is list and _schema) or isinstance(_schema, Schema)
+        backend = self.backend if backend is None else backend
+        assert backend in ("pandas", "columns"), f"{backend} は未対応のバックエンド"
 
-        self._schema = Schema(_schema)
+        self._schema = _schema if isinstance(_schema, Schema) else Schema(_schema)
         self._name = _name
 
         header = self._schema.names()
@@ -125,44 +224,164 @@ class Table:
             assert Path(filename).exists()
 
             if Path(filename).suffix == ".csv":
-                self._rows = pd.read_csv(
-                    filename, header=None, names=header, quoting=csv.QUOTE_ALL
-                )
+                if backend == "columns":
+                    self._rows = ColumnStore.read_csv(
+                        filename, header, self._schema.types()
+                    )
+                else:
+                    import pandas as pd
+
+                    self._rows = pd.read_csv(
+                        filename, header=None, names=header, quoting=csv.QUOTE_ALL
+                    )
+                return
             elif Path(filename).suffix == ".json":
                 with open(filename, "r") as f:
                     records = json.load(f)
-                self._rows = pd.DataFrame.from_records(records, columns=header)
             else:
-                raise ValueError(f"{filename} は未対応のファイル形式")
+                records = read_records(filename, header, self._schema.types())
         elif type(_filename_or_list) is list:
             records = _filename_or_list
-            self._rows = pd.DataFrame.from_records(records, columns=header)
         else:
             raise ValueError("ファイルパスか、listのみに対応しています")
 
-    def dataframe_to_string_list(self):
-        df_types = dict(zip(self._schema.names(), self._schema.types()))
-        rows = []
-        for columns in self._rows.itertuples():
-            cols = columns._asdict()
-            new_columns = []
-            for key in cols.keys():
-                if key == 'Index':
-                    continue
-                if cols[key] is None:
-                    new_columns += ['null']
-                elif repr(cols[key]) == 'nan':
-                    new_columns += ['null']
-                elif df_types[key] == 'int64':
-                    new_columns += [str(int(cols[key]))]
-                elif type(cols[key]) is str:
-                    escaped_double_quotes = re.sub('"', r"\"", str(cols[key]))
-                    new_columns += [f'"{escaped_double_quotes}"']
+        if backend == "columns":
+            self._rows = ColumnStore.from_records(records, header)
+        else:
+            import pandas as pd
+
+            self._rows = pd.DataFrame.from_records(records, columns=header)
+
+    @staticmethod
+    def column_to_literals(column: "pd.Series", typ: str):
+        """列をまとめてSQLのリテラル文字列に変換する
+
+        Args:
+            column (pd.Series): 変換する列
+            typ (str): 列の型名(小文字)
+
+        Returns:
+            np.ndarray: SQLのリテラル文字列の配列
+        """
+        import numpy as np
+        import pandas as pd
+
+        literals = np.full(len(column), "null", dtype=object)
+        not_null = ~column.isna().to_numpy()
+        values = column[not_null]
+        if values.empty:
+            return literals
+
+        if typ == "int64":
+            literals[not_null] = values.to_numpy().astype("int64").astype(str)
+            return literals
+
+        if pd.api.types.is_numeric_dtype(values) or pd.api.types.is_bool_dtype(values):
+            # NumPyの文字列変換はPythonのstr()と同じ表記になる
+            array = values.to_numpy()
+            literals[not_null] = array.astype(str)
+            if typ == "float64":
+                # inf と -inf はそのままではリテラルにならない
+                infinite = np.isinf(array.astype(float))
+                if infinite.any():
+                    positions = np.flatnonzero(not_null)[infinite]
+                    literals[positions] = [_encode_float(v) for v in array[infinite]]
+            return literals
+
+        values = values.to_numpy(object)
+        if pd.api.types.is_string_dtype(column.dtype) and column.dtype != object:
+            is_str = np.ones(len(values), dtype=bool)
+        else:
+            is_str = np.fromiter((type(v) is str for v in values), bool, len(values))
+        converted = np.empty(len(values), dtype=object)
+        if is_str.any():
+            converted[is_str] = Table.quote_strings(values[is_str].tolist())
+        if not is_str.all():
+            to_text = _encode_float if typ == "float64" else str
+            converted[~is_str] = [to_text(v) for v in values[~is_str]]
+        literals[not_null] = converted
+        return literals
+
+    @staticmethod
+    def quote_strings(strings: list):
+        """文字列をまとめてダブルクォートで囲み、ダブルクォート、バックスラッシュと改行をエスケープする
+
+        区切り文字で連結した1つの文字列に対して置換してから分割するので、
+        要素ごとに置換するよりも速い
+
+        Args:
+            strings (list): 文字列のリスト
+
+        Returns:
+            list: SQLの文字列リテラルのリスト
+        """
+        separator = "\x00"
+        joined = separator.join(strings)
+        if joined.count(separator) != len(strings) - 1:
+            # 区切り文字を含む値があるときは1つずつ変換する
+            return [f'"{escape(s)}"' for s in strings]
+
+        joined = escape(joined).replace(separator, f'"{separator}"')
+        return f'"{joined}"'.split(separator)
+
+    @staticmethod
+    def values_to_literals(values: list, typ: str):
+        """``column_to_literals`` のpandasを使わない版。欠損値はNoneで表す
+
+        Returns:
+            list: SQLのリテラル文字列のリスト
+        """
+        if typ == "int64":
+            return ["null" if v is None else str(int(v)) for v in values]
+
+        to_text = _encode_float if typ == "float64" else str
+        literals = [
+            "null" if v is None else v if type(v) is str else to_text(v)
+            for v in values
+        ]
+        strings = [i for i, v in enumerate(values) if type(v) is str]
+        if strings:
+            quoted = Table.quote_strings([values[i] for i in strings])
+            for i, literal in zip(strings, quoted):
+                literals[i] = literal
+        return literals
+
+    def literal_columns(self, rows=None):
+        """列ごとのSQLのリテラル文字列のリスト
+
+        INT64、FLOAT64、BOOL、STRINGの列はまとめて変換し、
+        それ以外の型は ``encoders.encode_values`` でスキーマの型に合わせたリテラルにする
+        """
+        rows = self._rows if rows is None else rows
+        columns = []
+        for name, typ, parsed in zip(
+            self._schema.names(), self._schema.types(), self._schema.parsed_types()
+        ):
+            if isinstance(rows, ColumnStore):
+                values = rows.column(name)
+                if typ in self.vectorized_types:
+                    columns.append(Table.values_to_literals(values, typ))
                 else:
-                    new_columns += [str(cols[key])]
-            rows += [new_columns]
+                    columns.append(encode_values(values, parsed))
+            elif typ in self.vectorized_types:
+                columns.append(Table.column_to_literals(rows[name], typ))
+            else:
+                columns.append(Table.series_to_literals(rows[name], parsed))
+        return columns
+
+    @staticmethod
+    def series_to_literals(column: "pd.Series", parsed):
+        """``column_to_literals`` で扱わない型の列をリテラル文字列の配列にする"""
+        import numpy as np
 
-        return rows
+        literals = np.full(len(column), "null", dtype=object)
+        not_null = ~column.isna().to_numpy()
+        literals[not_null] = encode_values(column[not_null].tolist(), parsed)
+        return literals
+
+    def dataframe_to_string_list(self):
+        columns = [list(column) for column in self.literal_columns()]
+        return [list(row) for row in zip(*columns)]
 
     @staticmethod
     def sql_string(rows):
@@ -173,24 +392,203 @@ class Table:
         with_parens_string = ",".join(with_parens)
         return f"[{with_parens_string}]"
 
-    def to_sql(self):
-        header = str(self._schema)
-        datum = Table.sql_string(self.dataframe_to_string_list())
+    def iter_chunks(self):
+        """テストデータを ``chunk_size`` 行ずつ返す"""
+        for start in range(0, len(self._rows), self.chunk_size):
+            if isinstance(self._rows, ColumnStore):
+                yield self._rows.slice(start, start + self.chunk_size)
+            else:
+                yield self._rows.iloc[start : start + self.chunk_size]
+
+    def iter_rows_sql(self):
+        """データ部分のSQLを ``chunk_size`` 行ずつ生成する
+
+        列が2つ以上あれば、すべて連結すると
+        ``Table.sql_string(self.dataframe_to_string_list())`` と同じ文字列になる
+        """
+        # 1列だけのときは (x) がただの括弧になるので、 STRUCT(x) と書く
+        opening = "STRUCT(" if len(self._schema.names()) == 1 else "("
+        yield "["
+        for i, chunk in enumerate(self.iter_chunks()):
+            columns = self.literal_columns(chunk)
+            yield "," + opening if i else opening
+            if isinstance(chunk, ColumnStore):
+                yield (")," + opening).join(",".join(row) for row in zip(*columns))
+                yield ")"
+                continue
+
+            import numpy as np
+
+            # 値と区切り文字を交互に並べた行列を作り、一度だけjoinする
+            cells = np.empty((len(chunk), len(columns) * 2), dtype=object)
+            cells[:, 0::2] = np.column_stack(columns)
+            cells[:, 1::2] = ","
+            cells[:, -1] = ")," + opening
+            cells[-1, -1] = ")"
+            yield "".join(cells.ravel().tolist())
+        yield "]"
+
+    def rows_sql(self):
+        return "".join(self.iter_rows_sql())
+
+    def name(self):
+        return self._name
+
+    def schema(self):
+        return self._schema
+
+    def dataframe(self):
+        if isinstance(self._rows, ColumnStore):
+            return self._rows.to_dataframe()
+        return self._rows
+
+    def schema_fields(self):
+        return self._schema.schema_fields()
 
+    def records(self):
+        """ロードジョブ用にJSONへ変換できる辞書のリストを返す
+
+        欠損値はNoneにし、値は ``encoders.json_value_encoder`` で列の型に合わせて変換する
+        """
+        if isinstance(self._rows, ColumnStore):
+            return self._json_records(self._rows.rows())
+
+        columns = []
+        for name in self._schema.names():
+            column = self._rows[name].astype(object)
+            columns.append(column.where(column.notna(), None).tolist())
+        return self._json_records(zip(*columns))
+
+    def _json_records(self, rows):
+        names = self._schema.names()
+        encoders = [json_value_encoder(p) for p in self._schema.parsed_types()]
+        return [
+            {
+                name: None if v is None else encode(v)
+                for name, encode, v in zip(names, encoders, row)
+            }
+            for row in rows
+        ]
+
+    def iter_sql(self):
+        header = str(self._schema)
         if header != "":
             header = f"<{header}>"
 
-        return "\n".join(
-            [
-                f"{self._name} AS (",
-                f"SELECT * FROM UNNEST(ARRAY{header}",
-                f"{datum}",
-                ")",
-                ")",
-            ]
+        yield f"{self._name} AS (\nSELECT * FROM UNNEST(ARRAY{header}\n"
+        yield from self.iter_rows_sql()
+        yield "\n)\n)"
+
+    def to_sql(self):
+        return "".join(self.iter_sql())
+
+
+class StreamingTable(Table):
+    """ファイルを読み込んでおかずに、SQLを作るたびに ``chunk_size`` 行ずつ読むテーブル
+
+    数GBのテストデータでも、メモリに載るのは ``chunk_size`` 行分だけになる。
+    CSV、JSON、改行区切りのJSON(.ndjson, .jsonl)とそれらのgzip圧縮(.gz)、
+    Parquet(pyarrowが必要)に対応する。列の数と値の型は読みながらスキーマと照らし合わせ、
+    合わなければ行番号付きの ``ValueError`` にする
+
+    Args:
+        filename (str): データのファイルパス
+        _schema: スキーマを表す辞書のリストか、検証済みの ``Schema``
+        _name (str): WITH句でのテーブル名
+    """
+
+    _filename = ""
+
+    def __init__(self, filename: str, _schema, _name: str = ""):
+        assert type(filename) is str and Path(filename).exists()
+        assert (type(_schema) is list and _schema) or isinstance(_schema, Schema)
+        file_format(filename)
+
+        self._schema = _schema if isinstance(_schema, Schema) else Schema(_schema)
+        self._name = _name
+        self._filename = filename
+
+    def filename(self):
+        return self._filename
+
+    def iter_chunks(self):
+        names = self._schema.names()
+        for records in iter_record_chunks(
+            self._filename, names, self._schema.types(), self.chunk_size
+        ):
+            yield ColumnStore.from_records(records, names)
+
+    def _read(self):
+        names = self._schema.names()
+        return ColumnStore.from_records(
+            read_records(self._filename, names, self._schema.types()), names
+        )
+
+    def literal_columns(self, rows=None):
+        return super().literal_columns(self._read() if rows is None else rows)
+
+    def dataframe(self):
+        return self._read().to_dataframe()
+
+    def records(self):
+        return self._json_records(
+            row for chunk in self.iter_chunks() for row in chunk.rows()
         )
 
 
+class PooledTable(Table):
+    """``FixtureRegistry`` で共有するテーブル
+
+    同じテストデータとスキーマのテーブルは、プロセスの中で一度だけ読み込んでSQLにする。
+    データ部分のSQLは、同じ内容を使うすべてのテストで同じものを使う。
+    読み込んだデータはレジストリに入れず、ローカル実行などで必要になったときに読み直す
+    """
+
+    _rows_sql = ""
+    _datum = None
+    _loaded = None
+
+    @classmethod
+    def load(
+        cls,
+        registry: "FixtureRegistry",
+        datum,
+        _schema,
+        _name: str = None,
+        source: str = None,
+    ):
+        """レジストリから取り出す。なければ読み込んでレジストリに入れる
+
+        Args:
+            registry (FixtureRegistry): テストデータを共有するレジストリ
+            datum: データのファイルパスか、レコードのリスト
+            _schema: 検証済みの ``Schema``
+            _name (str): WITH句でのテーブル名。省略すると ``source`` と内容から決まる名前
+            source (str): クエリの中の元のテーブル名
+        """
+        key = registry.key(datum, _schema)
+
+        def build():
+            rows_sql = Table(datum, _schema).rows_sql()
+            return rows_sql, sys.getsizeof(rows_sql)
+
+        pooled = cls.__new__(cls)
+        pooled._schema = _schema
+        pooled._datum = datum
+        pooled._rows_sql = registry.get(key, build)
+        pooled._name = registry.alias(key, source) if _name is None else _name
+        return pooled
+
+    @property
+    def _rows(self):
+        if self._loaded is None:
+            self._loaded = Table(self._datum, self._schema)._rows
+        return self._loaded
+
+    def iter_rows_sql(self):
+        yield self._rows_sql
+
+
 class NamedQueryTable:
     _name = ""
     _query = ""
@@ -202,8 +600,17 @@ class NamedQueryTable:
         self._name = name
         self._query = query
 
+    def iter_sql(self):
+        yield f"{quote_identifier(self._name)} AS (\n{self._query}\n)"
+
     def to_sql(self):
-        return "\n".join([f"{self._name} AS (", f"{self._query}", ")"])
+        return "".join(self.iter_sql())
+
+    def name(self):
+        return self._name
+
+    def query(self):
+        return self._query
 
 
 class TemporaryTables:
@@ -215,9 +622,15 @@ class TemporaryTables:
             Table(filename, schema, name) for filename, schema, name in pairs
         ]
 
+    def iter_sql(self):
+        yield "WITH "
+        for i, table in enumerate(self._tables):
+            if i > 0:
+                yield ","
+            yield from table.iter_sql()
+
     def to_sql(self):
-        table_strings = ",".join([table.to_sql() for table in self._tables])
-        return f"WITH {table_strings}"
+        return write_sql(self.iter_sql())
 
 
 class Query:
@@ -225,6 +638,9 @@ class Query:
     _query = ""
     _query_parameters = []
     _table_map = {}
+    _rewriter = None
+    _rewritten = None
+    _referenced = None
 
     def __init__(self, name: str, query: str, query_parameters: list, table_map: dict):
         assert type(name) is str and name != "" and " " not in name and "," not in name
@@ -238,12 +654,32 @@ class Query:
         self._query = query
         self._query_parameters = query_parameters
         self._table_map = table_map
+        self._rewriter = TableRewriter(table_map)
+
+    def name(self):
+        return self._name
+
+    def rewritten_query(self):
+        """テーブル名を書き換えたクエリ"""
+        if self._rewritten is None:
+            self._rewritten, self._referenced = self._rewriter.rewrite(self._query)
+        return self._rewritten
+
+    def unreferenced_tables(self):
+        """``table_map`` にあるがクエリで参照されていないテーブル名のリスト"""
+        self.rewritten_query()
+        return [name for name in self._table_map if name not in self._referenced]
+
+    def referenced_tables(self):
+        """``table_map`` にあり、クエリで参照されているテーブル名のリスト"""
+        self.rewritten_query()
+        return [name for name in self._table_map if name in self._referenced]
+
+    def iter_sql(self):
+        yield f"{self._name} AS ({self.rewritten_query()})"
 
     def to_sql(self):
-        query = self._query
-        for before, after in self._table_map.items():
-            query = re.sub(before, after, query)
-        return f"{self._name} AS ({query})"
+        return "".join(self.iter_sql())
 
     def query_parameters(self):
         return self._query_parameters
@@ -256,17 +692,70 @@ class QueryLogicTest:
     _tables = []
     _expected = None
     _query = None
+    _spill_dataset = None
+    # arun でジョブの状態を確認する間隔の上限(秒)。間隔は poll_interval から倍々に延ばす
+    max_poll_interval = 5.0
+    _max_query_length = MAX_QUERY_LENGTH
+    _spilled = []
+    _aliases = {}
+    _graph = None
+    _diff_total_rows = None
+    _name = ""
+    _metrics = None
+    _query_cache = False
+    _load_seconds = None
 
     def __init__(
-        self, client, expected_table: "Table", input_tables: list, query: "Query"
+        self,
+        client,
+        expected_table: "Table",
+        input_tables: list,
+        query: "Query",
+        spill_dataset: str = None,
+        max_query_length: int = MAX_QUERY_LENGTH,
+        aliases: dict = None,
+        graph: "DependencyGraph" = None,
+        name: str = "",
+        query_cache: bool = False,
+        load_seconds: float = None,
     ):
+        """
+        Args:
+            spill_dataset (str): クエリが ``max_query_length`` を超えるときに、
+                大きいテーブルから順にロードジョブで書き出す先のデータセット
+            max_query_length (int): クエリの長さの上限
+            aliases (dict): テストデータに付けたテーブル名から元のテーブル名への対応。
+                ``RunMetrics`` に元のテーブル名で記録するために使う
+            query_cache (bool): TrueならBigQueryのクエリキャッシュを使う。
+                ロードジョブで書き出したテーブルがあるときは使わない
+            graph (DependencyGraph): テストデータ、CTEと ACTUAL の参照関係
+            name (str): ``RunMetrics`` に記録するテストの名前
+            load_seconds (float): テストデータの読み込みと変換にかかった秒数。
+                実行のたびに ``RunMetrics`` の ``load`` に記録する
+        """
         self._client = client
         self._expected = expected_table
         self._tables = input_tables
         self._query = query
+        self._spill_dataset = spill_dataset
+        self._max_query_length = max_query_length
+        self._spilled = []
+        self._aliases = aliases or {}
+        self._graph = graph
+        self._name = name
+        self._query_cache = query_cache
+        self._load_seconds = load_seconds
 
-    def build(self):
-        diff = Query(
+    def _new_metrics(self):
+        metrics = RunMetrics(self._name)
+        if self._load_seconds is not None:
+            metrics.phases["load"] = self._load_seconds
+        return metrics
+
+    @staticmethod
+    def diff_query():
+        """ACTUAL と EXPECTED の差分を取るクエリ"""
+        return Query(
             "diff",
             """
 SELECT "+" AS mark , * FROM (SELECT *, ROW_NUMBER() OVER() AS n FROM ACTUAL EXCEPT DISTINCT SELECT *, ROW_NUMBER() OVER() AS n FROM EXPECTED) UNION ALL
@@ -275,78 +764,839 @@ SELECT "-" AS mark , * FROM (SELECT *, ROW_NUMBER() OVER() AS n FROM EXPECTED EX
             [],
             {},
         )
-        tables = self._tables + [self._expected] + [self._query] + [diff]
-        with_clause = ",".join([table.to_sql() for table in tables])
-        return f"WITH {with_clause} SELECT * FROM diff"
 
-    def is_total_bytes_processed_zero(self):
+    def _iter_tables_sql(self, tables: list, lengths: dict = None):
+        for i, table in enumerate(tables):
+            if i > 0:
+                yield ","
+            if lengths is None:
+                yield from table.iter_sql()
+                continue
+            length = 0
+            for fragment in table.iter_sql():
+                length += len(fragment)
+                yield fragment
+            lengths[self._aliases.get(table.name(), table.name())] = length
+
+    def iter_build(self, lengths: dict = None):
+        """テスト用のクエリを断片ごとに生成する
+
+        Args:
+            lengths (dict): 指定すると、テーブル名からWITH句でのSQLの文字数を書き込む
+        """
+        tables = self.tables() + [self._query] + [self.diff_query()]
+        yield "WITH "
+        yield from self._iter_tables_sql(tables, lengths)
+        yield " SELECT * FROM diff"
+
+    def build(self):
+        return write_sql(self.iter_build())
+
+    def iter_build_actual(self, lengths: dict = None):
+        """ACTUAL の結果だけを返すクエリを断片ごとに生成する
+
+        EXPECTED と差分のクエリは含まない。
+        ACTUAL のクエリはWITH句に入れずに末尾に置くので、ORDER BY が結果の順番に効く
+
+        Args:
+            lengths (dict): ``iter_build()`` と同じ
+        """
+        tables = self.tables(include_expected=False)
+        if tables:
+            yield "WITH "
+        yield from self._iter_tables_sql(tables, lengths)
+        yield " "
+        yield self._query.rewritten_query()
+
+    def build_actual(self):
+        return write_sql(self.iter_build_actual())
+
+    def client(self):
+        return self._client
+
+    def query(self):
+        return self._query
+
+    def expected_schema(self):
+        """期待するテーブルの ``Schema``"""
+        return self._expected.schema()
+
+    def graph(self):
+        return self._graph
+
+    def name(self):
+        return self._name
+
+    def metrics(self):
+        """直前の ``run()`` か ``arun()`` の ``RunMetrics``"""
+        return self._metrics
+
+    def tables(self, include_expected: bool = True):
+        """WITH句に並べるテーブル。ロード済みのテーブルは置き換える"""
+        spilled = {id(table.original()): table for table in self._spilled}
+        tables = self._tables + ([self._expected] if include_expected else [])
+        return [spilled.get(id(table), table) for table in tables]
+
+    def _build(self, client_diff: bool = False, lengths: dict = None):
+        if client_diff:
+            return write_sql(self.iter_build_actual(lengths))
+        return write_sql(self.iter_build(lengths))
+
+    def spill(self, client_diff: bool = False):
+        """クエリが長すぎるときに、大きいテーブルから順にロードジョブで書き出す
+
+        ``spill_dataset`` を指定していなければ何もしない
+
+        Args:
+            client_diff (bool): Trueなら ``build_actual()`` のクエリの長さで判定する
+
+        ロードの途中で失敗しても、発行済みのロードジョブのテーブルは ``cleanup()``
+        で削除できる
+
+        Returns:
+            (list): 書き出した ``SpilledTable`` のリスト
+        """
+        if self._spill_dataset is None:
+            return []
+
+        query_length = len(self._build(client_diff))
+        if query_length <= self._max_query_length:
+            return []
+
+        candidates = [
+            table
+            for table in self.tables(include_expected=not client_diff)
+            if isinstance(table, Table) and table.schema_fields() is not None
+        ]
+        sizes = {
+            id(table): sum(len(f) for f in table.iter_sql()) for table in candidates
+        }
+        candidates.sort(key=lambda table: sizes[id(table)], reverse=True)
+
+        targets = []
+        for table in candidates:
+            if query_length <= self._max_query_length:
+                break
+            targets.append(table)
+            # ロード後はテーブルを参照するだけの短いSQLになる
+            query_length -= sizes[id(table)]
+        assert (
+            query_length <= self._max_query_length
+        ), "テーブルを書き出してもクエリの長さが上限を超えます"
+
+        spiller = FixtureSpiller(self._client, self._spill_dataset)
+        return spiller.load(targets, self._spilled)
+
+    def cleanup(self):
+        """ロードジョブで書き出したテーブルを削除する"""
+        FixtureSpiller(self._client, self._spill_dataset).delete(self._spilled)
+        self._spilled = []
+
+    def spilled_bytes(self):
+        """ロードジョブで書き出したテーブルのバイト数の合計"""
+        return sum(table.num_bytes() for table in self._spilled)
+
+    def _job_config(self, dry_run: bool = False):
+        from google.cloud import bigquery
+
+        return bigquery.QueryJobConfig(
+            query_parameters=self._query.query_parameters(),
+            dry_run=dry_run,
+            use_query_cache=self.uses_query_cache(),
+        )
+
+    def uses_query_cache(self):
+        """BigQueryのクエリキャッシュを使うか
+
+        テストデータがすべてクエリの中のリテラルなら、同じクエリの結果は変わらない。
+        ロードジョブで書き出したテーブルは実行ごとに作り直すので、キャッシュを使わない
+        """
+        return self._query_cache and not self._spilled
+
+    def is_total_bytes_processed_zero(
+        self, dry_run: bool = False, client_diff: bool = False
+    ):
         """ドライランによってデータ走査量がゼロかどうか判定する
 
-        セーフティネット
+        セーフティネット。ロードジョブで書き出したテーブルの走査量は除く
+
+        Args:
+            dry_run (bool): Trueなら本物のドライランで判定する。スロット時間を消費しない
+            client_diff (bool): Trueなら ``build_actual()`` のクエリで判定する
 
         Returns:
             (bool): データ走査量がゼロならTrue。それ以外はFalse
         """
-        query_job = self._client.query(
-            self.build(),
-            job_config=bigquery.QueryJobConfig(
-                query_parameters=self._query.query_parameters(),
-                dry_run=False,
-                use_query_cache=False,
-            ),
+        query_job = self._check_job(self._build(client_diff), dry_run)
+        return self._is_bytes_processed_allowed(query_job)
+
+    def _check_job(self, sql: str, dry_run: bool):
+        """データ走査量を確かめるためのジョブを発行する"""
+        query_job = self._client.query(sql, job_config=self._job_config(dry_run))
+        if not dry_run:
+            query_job.result()
+        return query_job
+
+    def _is_bytes_processed_allowed(self, query_job):
+        return is_bytes_processed_allowed(query_job, self._spilled)
+
+    def cache_key(
+        self,
+        client_diff: bool = False,
+        ordered: bool = False,
+        max_rows: int = None,
+        backend=None,
+    ):
+        """``ResultCache`` のキー
+
+        クエリとクエリパラメータが同じなら同じキーになる。
+        テストデータのテーブル名は内容から決まるので、同じテストならいつも同じキーになる。
+        実行環境が違えば結果も違いうるので、 ``backend`` のクラスもキーに含める
+        """
+        return self._cache_key(
+            self._build(client_diff), client_diff, ordered, max_rows, backend
+        )
+
+    def _cache_key(self, query: str, client_diff, ordered, max_rows, backend):
+        return ResultCache.key(
+            query,
+            self._query.query_parameters(),
+            client_diff=client_diff,
+            ordered=client_diff and ordered,
+            max_rows=max_rows,
+            backend=None if backend is None else type(backend).__qualname__,
         )
-        query_job.result()
-        return query_job.total_bytes_processed == 0
 
-    def run(self):
+    def run(
+        self,
+        single_job: bool = False,
+        dry_run: bool = False,
+        backend=None,
+        client_diff: bool = False,
+        ordered: bool = False,
+        cache: "ResultCache" = None,
+        output: str = "rows",
+        max_rows: int = None,
+    ):
         """テストを実際に走らせる
 
+        Args:
+            single_job (bool): Trueならジョブを1回だけ発行し、そのジョブのデータ走査量で
+                セーフティネットを判定する。判定はクエリ実行後になる
+            dry_run (bool): Trueなら事前にドライランでデータ走査量を確認してから、
+                ジョブを1回だけ発行する
+            backend: ``SQLiteBackend`` などBigQuery以外の実行環境
+            client_diff (bool): TrueならBigQueryでは ACTUAL だけを取得し、
+                差分はPython側で取る
+            ordered (bool): ``client_diff`` のときに行の順番も比べるか
+            cache (ResultCache): 指定すると、クエリもパラメータも変わっていない
+                テストは実行せずに前回の結果を返す。 ``CURRENT_DATE()`` や ``RAND()``
+                のように実行ごとに結果が変わりうるクエリはキャッシュしない
+            output (str): 差分の形式。 ``rows`` なら ``bigquery.Row`` のリスト、
+                ``dataframe`` なら ``pd.DataFrame`` 、 ``arrow`` なら ``pyarrow.Table`` 。
+                ``dataframe`` と ``arrow`` はBigQuery Storage APIが使えれば使う
+            max_rows (int): 取得する差分の行数の上限。差分の全体の行数は
+                ``diff_total_rows()`` で分かる
+
         Returns:
-            tuple: 成功か失敗を示すBoolと文字列
+            tuple: 成功か失敗を示すBoolと差分
         """
-        assert (
-            self.is_total_bytes_processed_zero()
-        ), "クエリのデータ走査量がゼロではありません。クエリを再確認してください"
+        assert output in ("rows", "dataframe", "arrow"), f"{output} は未対応の形式"
+        if output == "arrow":
+            import_pyarrow()
+        assert max_rows is None or max_rows >= 0
+
+        self._metrics = self._new_metrics()
+        with recording(self._metrics) as metrics:
+            success, diff = self._run_with_options(
+                single_job,
+                dry_run,
+                backend,
+                client_diff,
+                ordered,
+                cache,
+                output,
+                max_rows,
+            )
+            metrics.success = success
+            metrics.diff_rows = self._diff_total_rows
+            return (success, diff)
+
+    def _run_with_options(
+        self,
+        single_job: bool,
+        dry_run: bool,
+        backend,
+        client_diff: bool,
+        ordered: bool,
+        cache: "ResultCache",
+        output: str,
+        max_rows: int,
+    ):
+        metrics = self._metrics
+        if cache is not None:
+            with metrics.phase("result_cache"):
+                query = self._build(client_diff)
+                key = None
+                if is_deterministic(query):
+                    key = self._cache_key(
+                        query, client_diff, ordered, max_rows, backend
+                    )
+                outcome = None if key is None else cache.get(key)
+            metrics.result_cache_hit = outcome is not None
+            if outcome is None:
+                outcome = self._run_with_options(
+                    single_job,
+                    dry_run,
+                    backend,
+                    client_diff,
+                    ordered,
+                    None,
+                    "rows",
+                    max_rows,
+                )
+                if key is not None:
+                    with metrics.phase("result_cache"):
+                        cache.set(key, outcome)
+            else:
+                self._diff_total_rows = None
+            success, diff = outcome
+            return (success, self._format(diff, output))
+
+        if backend is not None:
+            with metrics.phase("backend"):
+                return backend.run(
+                    self,
+                    single_job=single_job,
+                    dry_run=dry_run,
+                    client_diff=client_diff,
+                    ordered=ordered,
+                    output=output,
+                    max_rows=max_rows,
+                )
+
+        spilled = len(self._spilled)
+        try:
+            with metrics.phase("spill"):
+                self.spill(client_diff)
+            return self._run(
+                single_job, dry_run, client_diff, ordered, output, max_rows
+            )
+        finally:
+            if len(self._spilled) > spilled:
+                self.cleanup()
+
+    def diff_total_rows(self):
+        """直前の ``run()`` で見つかった差分の行数
+
+        ``max_rows`` で取得を打ち切っても、打ち切る前の行数を返す。
+        キャッシュから結果を返したときはNone
+        """
+        return self._diff_total_rows
+
+    def _run(
+        self,
+        single_job: bool,
+        dry_run: bool,
+        client_diff: bool,
+        ordered: bool,
+        output: str = "rows",
+        max_rows: int = None,
+    ):
+        metrics = self._metrics
+        with metrics.phase("build"):
+            sql = self._build(client_diff, metrics.table_lengths)
+        metrics.sql_bytes = len(sql.encode("utf-8"))
+
+        if dry_run or not single_job:
+            with metrics.phase("check"):
+                check_job = self._check_job(sql, dry_run)
+            metrics.add_job("dry_run" if dry_run else "check", check_job)
+            assert self._is_bytes_processed_allowed(check_job), ZERO_SCAN_MESSAGE
+
+        with metrics.phase("submit"):
+            query_job = self._client.query(sql, job_config=self._job_config())
+        with metrics.phase("wait"):
+            result = self._result(query_job, client_diff, max_rows)
+        metrics.add_job("query", query_job)
+        if single_job and not dry_run:
+            assert self._is_bytes_processed_allowed(query_job), ZERO_SCAN_MESSAGE
+        with metrics.phase("fetch"):
+            return self._outcome(result, client_diff, ordered, output, max_rows)
 
-        query = self.build()
-        query_parameters = self._query.query_parameters()
-        job_config = bigquery.QueryJobConfig(
-            query_parameters=query_parameters, dry_run=False, use_query_cache=False
+    @staticmethod
+    def _result(query_job, client_diff: bool, max_rows: int = None):
+        if client_diff:
+            return query_job.result()
+        # 差分が大きいときは先頭だけを取得する。total_rows は全体の行数になる
+        return query_job.result(max_results=max_rows)
+
+    def _records_outcome(self, records: list, output: str, max_rows: int):
+        """BigQuery以外で求めた差分のレコードから ``(success, diff)`` を作る"""
+        self._diff_total_rows = len(records)
+        return (records == [], self._format(records[:max_rows], output))
+
+    def _outcome(
+        self,
+        result,
+        client_diff: bool,
+        ordered: bool,
+        output: str = "rows",
+        max_rows: int = None,
+    ):
+        """クエリの結果から ``(success, diff)`` を作る"""
+        if client_diff:
+            success, records = self._diff(result, ordered, output != "rows")
+            self._diff_total_rows = len(records)
+            return (success, self._format(records[:max_rows], output))
+
+        self._diff_total_rows = result.total_rows
+        if output == "dataframe":
+            diff = result.to_dataframe()
+        elif output == "arrow":
+            diff = result.to_arrow()
+        else:
+            diff = [r for r in result]
+        return (result.total_rows == 0, diff)
+
+    async def arun(
+        self,
+        single_job: bool = False,
+        dry_run: bool = False,
+        backend=None,
+        client_diff: bool = False,
+        ordered: bool = False,
+        cache: "ResultCache" = None,
+        output: str = "rows",
+        max_rows: int = None,
+        timeout: float = None,
+        poll_interval: float = 0.5,
+    ):
+        """``run()`` のコルーチン版
+
+        ジョブの完了を確認する間隔は ``poll_interval`` 秒から倍々に延ばし、
+        ``max_poll_interval`` 秒で止める。待っている間はイベントループを止めない。
+        APIの呼び出しはスレッドプールで行う。クライアントの ``query`` とジョブの ``done`` が
+        コルーチン関数なら、スレッドプールを使わずに待つ。
+        キャンセルされたときやタイムアウトしたときは、実行中のジョブもキャンセルする
+
+        Args:
+            timeout (float): テストの制限時間(秒)。超えると ``asyncio.TimeoutError``
+            poll_interval (float): ジョブの状態を確認する最初の間隔(秒)
+            その他: ``run()`` と同じ。 ``backend`` か ``cache`` を指定したときは
+                ``run()`` をスレッドプールで実行する
+
+        Returns:
+            tuple: 成功か失敗を示すBoolと差分
+        """
+        import asyncio
+
+        assert output in ("rows", "dataframe", "arrow"), f"{output} は未対応の形式"
+        if output == "arrow":
+            import_pyarrow()
+        assert max_rows is None or max_rows >= 0
+
+        if backend is not None or cache is not None:
+            run = functools.partial(
+                self.run,
+                single_job,
+                dry_run,
+                backend,
+                client_diff,
+                ordered,
+                cache,
+                output,
+                max_rows,
+            )
+            coroutine = asyncio.get_running_loop().run_in_executor(None, run)
+            return await asyncio.wait_for(coroutine, timeout)
+
+        self._metrics = self._new_metrics()
+        with recording(self._metrics) as metrics:
+            coroutine = self._arun(
+                single_job,
+                dry_run,
+                client_diff,
+                ordered,
+                output,
+                max_rows,
+                poll_interval,
+            )
+            success, diff = await asyncio.wait_for(coroutine, timeout)
+            metrics.success = success
+            metrics.diff_rows = self._diff_total_rows
+            return (success, diff)
+
+    async def _arun(
+        self,
+        single_job: bool,
+        dry_run: bool,
+        client_diff: bool,
+        ordered: bool,
+        output: str,
+        max_rows: int,
+        poll_interval: float,
+    ):
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        metrics = self._metrics
+        spilled = len(self._spilled)
+        try:
+            with metrics.phase("spill"):
+                await loop.run_in_executor(None, self.spill, client_diff)
+            with metrics.phase("build"):
+                sql = self._build(client_diff, metrics.table_lengths)
+            metrics.sql_bytes = len(sql.encode("utf-8"))
+
+            if dry_run or not single_job:
+                with metrics.phase("check"):
+                    check_job = await self._acheck_job(sql, dry_run, poll_interval)
+                metrics.add_job("dry_run" if dry_run else "check", check_job)
+                assert self._is_bytes_processed_allowed(check_job), ZERO_SCAN_MESSAGE
+
+            with metrics.phase("submit"):
+                query_job = await self._asubmit(sql, self._job_config())
+            with metrics.phase("wait"):
+                await self._await_job(query_job, poll_interval)
+            metrics.add_job("query", query_job)
+            if single_job and not dry_run:
+                assert self._is_bytes_processed_allowed(query_job), ZERO_SCAN_MESSAGE
+
+            # 結果のページの取得もブロックするのでスレッドプールで行う
+            def fetch():
+                with metrics.phase("fetch"):
+                    result = self._result(query_job, client_diff, max_rows)
+                    return self._outcome(result, client_diff, ordered, output, max_rows)
+
+            return await loop.run_in_executor(None, fetch)
+        finally:
+            if len(self._spilled) > spilled:
+                await loop.run_in_executor(None, self.cleanup)
+
+    async def ais_total_bytes_processed_zero(
+        self,
+        dry_run: bool = False,
+        client_diff: bool = False,
+        poll_interval: float = 0.5,
+    ):
+        """``is_total_bytes_processed_zero()`` のコルーチン版"""
+        query_job = await self._acheck_job(
+            self._build(client_diff), dry_run, poll_interval
         )
-        query_job = self._client.query(query, job_config=job_config)
+        return self._is_bytes_processed_allowed(query_job)
 
-        result = query_job.result()
-        return (result.total_rows == 0, [r for r in result])
+    async def _acheck_job(self, sql: str, dry_run: bool, poll_interval: float):
+        query_job = await self._asubmit(sql, self._job_config(dry_run))
+        if not dry_run:
+            await self._await_job(query_job, poll_interval)
+        return query_job
 
+    async def _asubmit(self, query: str, job_config):
+        import asyncio
 
-class QueryTest:
-    _qlt = None
+        if inspect.iscoroutinefunction(self._client.query):
+            return await self._client.query(query, job_config=job_config)
+        submit = functools.partial(self._client.query, query, job_config=job_config)
+        return await asyncio.get_running_loop().run_in_executor(None, submit)
+
+    async def _await_job(self, query_job, poll_interval: float):
+        """ジョブの完了を待つ。待っている間にキャンセルされたらジョブもキャンセルする
+
+        ジョブが長いほど確認の回数が増えないように、確認の間隔を倍々に延ばす
+        """
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        interval = poll_interval
+        max_interval = max(poll_interval, self.max_poll_interval)
+        try:
+            while True:
+                if inspect.iscoroutinefunction(query_job.done):
+                    done = await query_job.done()
+                else:
+                    done = await loop.run_in_executor(None, query_job.done)
+                if done:
+                    return
+                await asyncio.sleep(interval)
+                interval = min(interval * 2, max_interval)
+        except asyncio.CancelledError:
+            query_job.cancel()
+            raise
+
+    def _diff(self, result, ordered: bool, columnar: bool = False):
+        import pandas as pd
+
+        from .diff import diff_dataframes
+
+        expected = self._expected.dataframe()
+        if columnar:
+            # 行ごとに Row を作らず、列ごとにまとめて取得する
+            actual = result.to_dataframe()
+            if len(actual.columns) == 0:
+                actual = pd.DataFrame(columns=expected.columns)
+        else:
+            rows = list(result)
+            columns = list(rows[0].keys()) if rows else list(expected.columns)
+            actual = pd.DataFrame.from_records(
+                [row.values() for row in rows], columns=columns
+            )
+        records = diff_dataframes(
+            actual, expected, self._expected.schema().parsed_types(), ordered
+        )
+        return (records == [], records)
+
+    def _format(self, records: list, output: str):
+        """``bigquery.Row`` のリストを ``output`` の形式にする"""
+        if output == "rows":
+            return records
+
+        import pandas as pd
+
+        if records:
+            columns = list(records[0].keys())
+        else:
+            columns = ["mark"] + self._expected.schema().names() + ["n"]
+        df = pd.DataFrame.from_records([r.values() for r in records], columns=columns)
+        if output == "dataframe":
+            return df
+
+        return import_pyarrow().Table.from_pandas(df, preserve_index=False)
+
+
+class CompiledQueryTest:
+    """同じクエリに対して、テストデータだけを変えたテストを作る
+
+    クエリの解析とスキーマの検証は最初の一度だけ行う。
+    ACTUAL から参照されないテストデータとCTEはWITH句から省く
+
+    Args:
+        _client (bigquery.Client): クライアント
+        _query (dict): ``query`` と ``params`` を持つ辞書
+        spill_dataset (str): ``QueryLogicTest`` を参照
+        max_query_length (int): ``QueryLogicTest`` を参照
+        prune (bool): Falseなら参照されないテストデータとCTEも省かずに送る
+        registry (FixtureRegistry): テストデータを共有するレジストリ。
+            省略するとプロセス全体で共有する ``default_registry()``
+        query_cache (bool): ``QueryLogicTest`` を参照
+    """
 
-    def __init__(self, _client, _expected: dict, _tables: dict, _query: dict):
-        expected = Table(_expected["datum"], _expected["schema"], "EXPECTED")
+    _client = None
+    _ctes = []
+    _query = ""
+    _params = []
+    _schemas = {}
+    _prune = True
+    _registry = None
+    _query_cache = False
 
-        table_map = {name: randomname(16) for name, table in _tables.items()}
-        tables = [
-            Table(table["datum"], table["schema"], table_map[name])
+    def __init__(
+        self,
+        _client,
+        _query: dict,
+        spill_dataset: str = None,
+        max_query_length: int = MAX_QUERY_LENGTH,
+        prune: bool = True,
+        registry: FixtureRegistry = None,
+        query_cache: bool = False,
+    ):
+        self._client = _client
+        self._params = _query["params"]
+        self._spill_dataset = spill_dataset
+        self._max_query_length = max_query_length
+        self._schemas = {}
+        self._prune = prune
+        self._registry = default_registry() if registry is None else registry
+        self._query_cache = query_cache
+
+        self._ctes, self._query = split_with_clause(_query["query"])
+
+    def schema(self, schema: list):
+        """検証済みの ``Schema`` を返す。同じスキーマは一度だけ検証する"""
+        key = tuple((column["name"], column["type"]) for column in schema)
+        if key not in self._schemas:
+            self._schemas[key] = Schema(schema)
+        return self._schemas[key]
+
+    def cte_names(self):
+        """WITH句にあるCTEの名前のリスト"""
+        return [name for name, _ in self._ctes]
+
+    def query_logic_test(
+        self,
+        _expected: dict,
+        _tables: dict,
+        params: list = None,
+        target: str = None,
+        name: str = "",
+    ):
+        """テストデータから ``QueryLogicTest`` を作る
+
+        ``_tables`` にCTEと同じ名前のテーブルがあれば、そのCTEはテストデータに差し替える。
+        テストデータのテーブル名は元のテーブル名と内容から決まるので、
+        同じテストからはいつも同じクエリが生成される
+
+        Args:
+            _expected (dict): 期待するテーブルの ``schema`` と ``datum``
+            _tables (dict): テーブル名から ``schema`` と ``datum`` への辞書
+            params (list): クエリパラメータ。省略するとコンパイル時のものを使う
+            target (str): CTEの名前。指定すると本体のクエリではなく、
+                そのCTEの結果を ``_expected`` と比べる
+            name (str): ``RunMetrics`` に記録するテストの名前
+        """
+        started = time.perf_counter()
+        expected = PooledTable.load(
+            self._registry,
+            _expected["datum"],
+            self.schema(_expected["schema"]),
+            "EXPECTED",
+        )
+
+        tables = {
+            name: PooledTable.load(
+                self._registry,
+                table["datum"],
+                self.schema(table["schema"]),
+                source=name,
+            )
             for name, table in _tables.items()
+        }
+        load_seconds = time.perf_counter() - started
+        table_map = {name: table.name() for name, table in tables.items()}
+
+        # CTEの名前は大文字と小文字を区別しない
+        stubbed = {name.lower() for name in _tables}
+        ctes = [
+            (name, query) for name, query in self._ctes if name.lower() not in stubbed
         ]
+        actual = self._query
+        if target is not None:
+            names = [name.lower() for name, _ in ctes]
+            assert (
+                target.lower() in names
+            ), f"{target} はWITH句にないか、テストデータに差し替えられています"
+            actual = ctes[names.index(target.lower())][1]
+            # 後ろのCTEは target から参照できない
+            ctes = ctes[: names.index(target.lower())]
+
+        # CTEの中のテストデータの参照も書き換え、CTEどうしの参照はそのまま数える
+        cte_map = {name: quote_identifier(name) for name, _ in ctes}
+        rewriter = TableRewriter({**cte_map, **table_map})
+        edges = {name: [] for name in tables}
+        for cte, query in ctes:
+            query, referenced = rewriter.rewrite(query)
+            tables[cte] = NamedQueryTable(cte, query)
+            edges[cte] = [n for n in edges if n in referenced]
+
+        params = self._params if params is None else params
+        query = Query("ACTUAL", actual, params, {**cte_map, **table_map})
+        edges["ACTUAL"] = query.referenced_tables()
+        graph = DependencyGraph(edges, "ACTUAL")
+        if self._prune:
+            graph = graph.pruned()
+
+        return QueryLogicTest(
+            self._client,
+            expected,
+            [tables[node] for node in graph.nodes() if node != "ACTUAL"],
+            query,
+            spill_dataset=self._spill_dataset,
+            max_query_length=self._max_query_length,
+            aliases={alias: name for name, alias in table_map.items()},
+            graph=graph,
+            name=name,
+            query_cache=self._query_cache,
+            load_seconds=load_seconds,
+        )
 
-        # FIXME: WITH句の解析を正規表現で強引に行っているため保守性が低い
-        tables = tables + [
-            NamedQueryTable(name, query)
-            for name, query in get_query_from_with_clause(_query["query"])
-        ]
+    def case(
+        self,
+        _expected: dict,
+        _tables: dict,
+        params: list = None,
+        target: str = None,
+        name: str = "",
+    ):
+        """テストデータから ``QueryTest`` を作る。引数は ``query_logic_test`` と同じ"""
+        return QueryTest.from_query_logic_test(
+            self.query_logic_test(_expected, _tables, params, target, name)
+        )
 
-        query = regex.sub(
-            r"WITH\s+(?<name>\w+)\s+AS\s+(?<query>\((?:[^\(\)]+|(?&query))*\))",
-            "",
-            _query["query"],
+
+class QueryTest:
+    _qlt = None
+
+    def __init__(
+        self,
+        _client,
+        _expected: dict,
+        _tables: dict,
+        _query: dict,
+        spill_dataset: str = None,
+        max_query_length: int = MAX_QUERY_LENGTH,
+        prune: bool = True,
+        target: str = None,
+        name: str = "",
+        registry: FixtureRegistry = None,
+        query_cache: bool = False,
+    ):
+        compiled = CompiledQueryTest(
+            _client,
+            _query,
+            spill_dataset=spill_dataset,
+            max_query_length=max_query_length,
+            prune=prune,
+            registry=registry,
+            query_cache=query_cache,
         )
-        query = Query("ACTUAL", query, _query["params"], table_map)
-        self._qlt = QueryLogicTest(_client, expected, tables, query)
+        self._qlt = compiled.query_logic_test(
+            _expected, _tables, target=target, name=name
+        )
+
+    @classmethod
+    def from_query_logic_test(cls, qlt: "QueryLogicTest"):
+        query_test = cls.__new__(cls)
+        query_test._qlt = qlt
+        return query_test
 
     def build(self):
         return self._qlt.build()
 
-    def run(self):
-        return self._qlt.run()
+    def query_logic_test(self):
+        return self._qlt
+
+    def client(self):
+        return self._qlt.client()
+
+    def graph(self):
+        """テストデータ、CTEと ACTUAL の参照関係を表す ``DependencyGraph``
+
+        ``prune`` がTrueなら、WITH句から省いたテーブルを含まない
+        """
+        return self._qlt.graph()
+
+    def cache_key(
+        self,
+        client_diff: bool = False,
+        ordered: bool = False,
+        max_rows: int = None,
+        backend=None,
+    ):
+        return self._qlt.cache_key(client_diff, ordered, max_rows, backend)
+
+    def diff_total_rows(self):
+        return self._qlt.diff_total_rows()
+
+    def metrics(self):
+        return self._qlt.metrics()
+
+    def run(self, **kwargs):
+        """テストを実際に走らせる。引数は ``QueryLogicTest.run`` と同じ"""
+        return self._qlt.run(**kwargs)
+
+    async def arun(self, **kwargs):
+        """``run()`` のコルーチン版。引数は ``QueryLogicTest.arun`` と同じ"""
+        return await self._qlt.arun(**kwargs)
+
+    async def ais_total_bytes_processed_zero(self, **kwargs):
+        return await self._qlt.ais_total_bytes_processed_zero(**kwargs)
@@ -1,16 +1,20 @@
 from .table import (
     Table,
+    StreamingTable,
     ColumnMeta,
+    CompiledQueryTest,
     Schema,
     TemporaryTables,
     Query,
     QueryLogicTest,
     QueryTest,
 )
+from .fake import FakeClient
+from .registry import FixtureRegistry
 from pathlib import Path
 import os
+import sys
 import pytest
-import random
 
 
 def is_githubactions():
@@ -76,6 +80,50 @@ SELECT * FROM UNNEST(ARRAY<STRUCT<name STRING, category STRING, value INT64>>
             ['"ddd"', '"ccc"', "null"]
         ]
 
+    def test_dataframe_to_string_list_mixed_types(self):
+        schema = [
+            {"name": "name", "type": "STRING", "mode": "NULLABLE"},
+            {"name": "value", "type": "INT64", "mode": "NULLABLE"},
+            {"name": "ratio", "type": "FLOAT64", "mode": "NULLABLE"},
+            {"name": "flag", "type": "BOOL", "mode": "NULLABLE"},
+        ]
+        t = Table(
+            [["a\x00\"b", 1, 0.5, True], [None, None, None, None], [3, 2, 1e16, False]],
+            schema,
+        )
+
+        assert t.dataframe_to_string_list() == [
+            ['"a\x00\\"b"', "1", "0.5", "True"],
+            ["null", "null", "null", "null"],
+            ["3", "2", "1e+16", "False"],
+        ]
+
+    def test_rows_sqlはsql_stringと同じ文字列を返す(self):
+        p = Path(__file__).parent / "testdata/test2.json"
+        schema = [
+            {"name": "name", "type": "STRING", "mode": "NULLABLE"},
+            {"name": "category", "type": "STRING", "mode": "NULLABLE"},
+            {"name": "value", "type": "INT64", "mode": "NULLABLE"},
+        ]
+        t = Table(str(p), schema, "TEST_DATA")
+
+        assert t.rows_sql() == Table.sql_string(t.dataframe_to_string_list())
+        assert Table([], schema).rows_sql() == "[]"
+
+    def test_chunk_sizeごとに生成してもSQLは変わらない(self):
+        p = Path(__file__).parent / "testdata/test2.json"
+        schema = [
+            {"name": "name", "type": "STRING", "mode": "NULLABLE"},
+            {"name": "category", "type": "STRING", "mode": "NULLABLE"},
+            {"name": "value", "type": "INT64", "mode": "NULLABLE"},
+        ]
+        t = Table(str(p), schema, "TEST_DATA")
+        want = t.to_sql()
+
+        t.chunk_size = 3
+        assert t.to_sql() == want
+        assert len(list(t.iter_rows_sql())) == 2 + 2 * 2
+
     def test_sql_stringによってリストからsqlのレコードが生成できる(self):
         input_list = [
             ['"abc"', '"bcd"', "300"],
@@ -104,6 +152,155 @@ SELECT * FROM UNNEST(ARRAY<STRUCT<name STRING, value INT64>>
         )
 
 
+    def test_1列のテーブルもSTRUCTにする(self):
+        schema = [{"name": "name", "type": "STRING", "mode": "NULLABLE"}]
+
+        t = Table([["田中"], ["小林"]], schema, "TABLE1")
+        assert (
+            t.to_sql()
+            == """TABLE1 AS (
+SELECT * FROM UNNEST(ARRAY<STRUCT<name STRING>>
+[STRUCT("田中"),STRUCT("小林")]
+)
+)"""
+        )
+
+    @pytest.mark.parametrize("backend", ["pandas", "columns"])
+    def test_FLOAT64のinfはCASTにする(self, backend):
+        schema = [
+            {"name": "f", "type": "FLOAT64", "mode": "NULLABLE"},
+            {"name": "s", "type": "FLOAT64", "mode": "NULLABLE"},
+        ]
+        datum = [
+            [float("inf"), "x"],
+            [float("-inf"), float("inf")],
+            [0.5, None],
+            [float("nan"), 1.5],
+        ]
+
+        t = Table(datum, schema, "T", backend=backend)
+        assert t.rows_sql() == (
+            """[(CAST('inf' AS FLOAT64),"x"),"""
+            """(CAST('-inf' AS FLOAT64),CAST('inf' AS FLOAT64)),"""
+            "(0.5,null),(null,1.5)]"
+        )
+
+    @pytest.mark.parametrize("backend", ["pandas", "columns"])
+    def test_スキーマの型に合わせたリテラルにする(self, backend):
+        import datetime
+
+        schema = [
+            {"name": "d", "type": "DATE", "mode": "NULLABLE"},
+            {
+                "name": "s",
+                "type": "STRUCT<a INT64, b ARRAY<BYTES>>",
+                "mode": "NULLABLE",
+            },
+            {"name": "x", "type": "STRING", "mode": "NULLABLE"},
+        ]
+        datum = [
+            [datetime.date(2020, 1, 2), {"a": 1, "b": [b"\x00"]}, "a\\b"],
+            [None, None, None],
+        ]
+
+        t = Table(datum, schema, "T", backend=backend)
+        assert t.rows_sql() == (
+            r"""[(DATE '2020-01-02',STRUCT(1,[b"\x00"]),"a\\b"),(null,null,null)]"""
+        )
+
+table_backend_params = {
+    "CSV": ("testdata/test1.csv", ["STRING", "STRING", "INT64"]),
+    "JSON": ("testdata/test2.json", ["STRING", "STRING", "INT64"]),
+    "nullを含むJSON": ("testdata/test6.json", ["STRING", "STRING", "INT64"]),
+    "いろいろな型のlist": (
+        [["a\x00\"b", 1, 0.5, True], [None, None, None, None], [3, 2, 1e16, False]],
+        ["STRING", "INT64", "FLOAT64", "BOOL"],
+    ),
+    "dictのlist": (
+        [{"c1": 1, "c0": "a"}, {"c0": "b"}, {"c1": None, "c0": None}],
+        ["STRING", "INT64"],
+    ),
+    "オブジェクトのJSON": ("testdata/test7.json", ["STRING", "STRING", "INT64"]),
+}
+
+
+@pytest.mark.parametrize(
+    "data, types",
+    list(table_backend_params.values()),
+    ids=list(table_backend_params.keys()),
+)
+def test_columnsバックエンドはpandasと同じSQLとレコードを作る(data, types):
+    if isinstance(data, str):
+        data = str(Path(__file__).parent / data)
+    schema = [
+        {"name": f"c{i}", "type": typ, "mode": "NULLABLE"}
+        for i, typ in enumerate(types)
+    ]
+    pandas_table = Table(data, schema, "T", backend="pandas")
+    columns_table = Table(data, schema, "T", backend="columns")
+
+    assert columns_table.to_sql() == pandas_table.to_sql()
+    assert columns_table.records() == pandas_table.records()
+    assert len(columns_table.dataframe()) == len(pandas_table.dataframe())
+
+    columns_table.chunk_size = 1
+    assert columns_table.to_sql() == pandas_table.to_sql()
+
+
+
+@pytest.mark.parametrize(
+    "filename", ["testdata/test1.csv", "testdata/test2.json", "testdata/test6.json"]
+)
+def test_StreamingTableはTableと同じSQLとレコードを作る(filename):
+    filename = str(Path(__file__).parent / filename)
+    schema = [
+        {"name": "name", "type": "STRING", "mode": "NULLABLE"},
+        {"name": "category", "type": "STRING", "mode": "NULLABLE"},
+        {"name": "value", "type": "INT64", "mode": "NULLABLE"},
+    ]
+    table = Table(filename, schema, "T", backend="columns")
+    streaming = StreamingTable(filename, schema, "T")
+
+    assert streaming.to_sql() == table.to_sql()
+    assert streaming.records() == table.records()
+    assert streaming.dataframe_to_string_list() == table.dataframe_to_string_list()
+
+    streaming.chunk_size = 1
+    assert streaming.to_sql() == table.to_sql()
+
+
+def test_gzipしたNDJSONからTableを作る(tmp_path):
+    from .loaders import write_records
+
+    path = str(tmp_path / "t.ndjson.gz")
+    write_records(path, [{"name": "田中", "value": 78}, {"name": "小林"}])
+    schema = [
+        {"name": "name", "type": "STRING", "mode": "NULLABLE"},
+        {"name": "value", "type": "INT64", "mode": "NULLABLE"},
+    ]
+
+    want = Table([["田中", 78], ["小林", None]], schema, "T").to_sql()
+    assert Table(path, schema, "T").to_sql() == want
+    assert Table(path, schema, "T", backend="columns").to_sql() == want
+    assert StreamingTable(path, schema, "T").to_sql() == want
+
+
+def test_StreamingTableは読みながらスキーマと照らし合わせる(tmp_path):
+    path = tmp_path / "t.csv"
+    path.write_text("a,1\nb,2,3\n")
+    schema = [
+        {"name": "name", "type": "STRING", "mode": "NULLABLE"},
+        {"name": "value", "type": "INT64", "mode": "NULLABLE"},
+    ]
+    table = StreamingTable(str(path), schema, "T")
+    table.chunk_size = 1
+
+    fragments = table.iter_sql()
+    # 1行目のSQLを返してから、2行目を読んだところで失敗する
+    assert "".join(next(fragments) for _ in range(5)).endswith('[("a",1)')
+    with pytest.raises(ValueError, match="2 行目"):
+        next(fragments)
+
 class TestColumnMeta:
     def test_STRINGは使えるタイプ(self):
         assert ColumnMeta("name", "STRING")
@@ -134,11 +331,25 @@ class TestColumnMeta:
         with pytest.raises(AssertionError):
             ColumnMeta("", "ARRAY<STRING>")
 
-    @pytest.mark.skip(reason="ARRAYの直下にARRAYは入れられないが、バグっている")
     def test_ARRAYの直下にARRAYは入れられない(self):
         with pytest.raises(AssertionError):
             ColumnMeta("name", "ARRAY<ARRAY<STRING>>")
 
+    def test_STRUCTはフィールドを並べられる(self):
+        meta = ColumnMeta("name", "STRUCT<a INT64, b ARRAY<STRUCT<c STRING>>>")
+        assert str(meta) == "name STRUCT<a INT64, b ARRAY<STRUCT<c STRING>>>"
+
+    def test_STRUCTはRECORDのスキーマになる(self):
+        meta = ColumnMeta("name", "ARRAY<STRUCT<a INT64, b ARRAY<STRING>>>")
+        field = meta.schema_field()
+        assert field.field_type == "RECORD"
+        assert field.mode == "REPEATED"
+        assert [(f.name, f.field_type, f.mode) for f in field.fields] == [
+            ("a", "INT64", "NULLABLE"),
+            ("b", "STRING", "REPEATED"),
+        ]
+        assert ColumnMeta("name", "STRUCT<INT64>").schema_field() is None
+
 
 class TestSchema:
     def test_スキーマは空配列から生成しようとするとAssertionErrorになる(self):
@@ -217,6 +428,18 @@ SELECT * FROM UNNEST(ARRAY<STRUCT<name STRING, category STRING, value INT64>>
         )
 
 
+class TestQuery:
+    def test_テーブル名をまとめて書き換える(self):
+        query = Query(
+            "ACTUAL",
+            "SELECT * FROM `test.table1` UNION ALL SELECT * FROM test.table2",
+            [],
+            {"test.table1": "T1", "test.table2": "T2", "test.unused": "T3"},
+        )
+        assert query.to_sql() == "ACTUAL AS (SELECT * FROM T1 UNION ALL SELECT * FROM T2)"
+        assert query.unreferenced_tables() == ["test.unused"]
+
+
 class TestQueryLogicTest:
     @pytest.mark.skipif(is_githubactions(), reason="GitHub Actions")
     def test_BigQueryのクエリを生成できる(self):
@@ -371,6 +594,295 @@ SELECT "-" AS mark , * FROM (SELECT *, ROW_NUMBER() OVER() AS n FROM EXPECTED EX
         ]
 
 
+def fake_query_logic_test(client):
+    schema = [
+        {"name": "name", "type": "STRING", "mode": "NULLABLE"},
+        {"name": "category", "type": "STRING", "mode": "NULLABLE"},
+        {"name": "value", "type": "INT64", "mode": "NULLABLE"},
+    ]
+    expected = Table(
+        str(Path(__file__).parent / "testdata/test3.json"), schema, "EXPECTED"
+    )
+    input_tables = [
+        Table(str(Path(__file__).parent / "testdata/test3.json"), schema, "INPUT_DATA")
+    ]
+    query = Query("ACTUAL", """SELECT * FROM abc""", [], {"abc": "INPUT_DATA"})
+    return QueryLogicTest(client, expected, input_tables, query)
+
+
+class TestQueryLogicTestFakeClient:
+    def test_通常はセーフティネットと本番で2回ジョブを発行する(self):
+        client = FakeClient()
+        success, diff = fake_query_logic_test(client).run()
+        assert success and diff == []
+        assert len(client.jobs) == 2
+        assert all(not job.job_config.dry_run for job in client.jobs)
+
+    def test_single_jobならジョブは1回だけ(self):
+        client = FakeClient(lambda query, job_config: ([("+", "x")], 0))
+        success, diff = fake_query_logic_test(client).run(single_job=True)
+        assert not success and diff == [("+", "x")]
+        assert len(client.jobs) == 1
+        assert client.jobs[0].result_called == 1
+
+    def test_single_jobでもデータ走査量がゼロでなければAssertionError(self):
+        client = FakeClient(lambda query, job_config: ([], 100))
+        with pytest.raises(AssertionError):
+            fake_query_logic_test(client).run(single_job=True)
+        assert len(client.jobs) == 1
+
+    def test_dry_runなら事前にドライランしてから1回だけ実行する(self):
+        client = FakeClient()
+        success, _ = fake_query_logic_test(client).run(dry_run=True)
+        assert success
+        assert [job.job_config.dry_run for job in client.jobs] == [True, False]
+        assert client.jobs[0].result_called == 0
+
+    def test_iter_buildの断片をつなげるとbuildと同じになる(self):
+        qlt = fake_query_logic_test(FakeClient())
+        assert "".join(qlt.iter_build()) == qlt.build()
+
+    def test_client_diffならACTUALだけを取得してPython側で差分を取る(self):
+        from google.cloud import bigquery
+
+        rows = [
+            bigquery.Row(("ddd", "ccc", 400), {"name": 0, "category": 1, "value": 2}),
+            bigquery.Row(("xxx", "yyy", 1), {"name": 0, "category": 1, "value": 2}),
+        ]
+        client = FakeClient(lambda query, job_config: (rows, 0))
+        success, diff = fake_query_logic_test(client).run(
+            single_job=True, client_diff=True
+        )
+
+        assert not client.jobs[0].query.endswith("SELECT * FROM diff")
+        assert "EXPECTED" not in client.jobs[0].query
+        assert client.jobs[0].query.endswith(" SELECT * FROM INPUT_DATA")
+        assert not success
+        assert [tuple(r.values()) for r in diff] == [
+            ("-", "abc", "bcd", 300, 1),
+            ("+", "xxx", "yyy", 1, 2),
+        ]
+
+    def test_dry_runでデータ走査量がゼロでなければ本番のジョブは発行しない(self):
+        client = FakeClient(
+            lambda query, job_config: ([], 100 if job_config.dry_run else 0)
+        )
+        with pytest.raises(AssertionError):
+            fake_query_logic_test(client).run(dry_run=True)
+        assert len(client.jobs) == 1
+
+    def test_max_rowsで取得する差分の行数を打ち切る(self):
+        from google.cloud import bigquery
+
+        fields = {"mark": 0, "name": 1, "n": 2}
+        rows = [bigquery.Row(("+", f"x{i}", i), fields) for i in range(10)]
+        client = FakeClient(lambda query, job_config: (rows, 0))
+        qlt = fake_query_logic_test(client)
+
+        success, diff = qlt.run(single_job=True, max_rows=3)
+        assert not success and diff == rows[:3]
+        assert qlt.diff_total_rows() == 10
+
+        success, diff = qlt.run(single_job=True, output="dataframe", max_rows=2)
+        assert list(diff.columns) == ["mark", "name", "n"]
+        assert diff["name"].tolist() == ["x0", "x1"]
+
+    def test_client_diffでも差分をDataFrameで返せる(self):
+        from google.cloud import bigquery
+
+        fields = {"name": 0, "category": 1, "value": 2}
+        rows = [bigquery.Row(("xxx", "yyy", i), fields) for i in range(5)]
+        client = FakeClient(lambda query, job_config: (rows, 0))
+        qlt = fake_query_logic_test(client)
+        success, diff = qlt.run(
+            single_job=True, client_diff=True, output="dataframe", max_rows=2
+        )
+        assert not success
+        assert len(diff) == 2 and list(diff.columns)[0] == "mark"
+        assert qlt.diff_total_rows() == 7
+
+    def test_差分がなくても列名の付いたDataFrameを返す(self):
+        from google.cloud import bigquery
+
+        fields = {"name": 0, "category": 1, "value": 2}
+        rows = [
+            bigquery.Row(("abc", "bcd", 300), fields),
+            bigquery.Row(("ddd", "ccc", 400), fields),
+        ]
+        client = FakeClient(lambda query, job_config: (rows, 0))
+        success, diff = fake_query_logic_test(client).run(
+            single_job=True, client_diff=True, output="dataframe"
+        )
+        assert success and len(diff) == 0
+        assert list(diff.columns) == ["mark", "name", "category", "value", "n"]
+
+    def test_arrowで返す(self):
+        pytest.importorskip("pyarrow")
+        from google.cloud import bigquery
+
+        rows = [bigquery.Row(("+", "x", 1), {"mark": 0, "name": 1, "n": 2})]
+        client = FakeClient(lambda query, job_config: (rows, 0))
+        success, diff = fake_query_logic_test(client).run(
+            single_job=True, output="arrow"
+        )
+        assert diff.num_rows == 1
+
+    def test_pyarrowがなければ実行する前にextrasを案内する(self, monkeypatch):
+        monkeypatch.setitem(sys.modules, "pyarrow", None)
+        client = FakeClient()
+        with pytest.raises(ImportError, match=r"bqqtest\[pyarrow\]"):
+            fake_query_logic_test(client).run(output="arrow")
+        assert client.jobs == []
+
+
+class TestSpill:
+    schema = [
+        {"name": "name", "type": "STRING", "mode": "NULLABLE"},
+        {"name": "value", "type": "INT64", "mode": "NULLABLE"},
+    ]
+
+    def query_logic_test(self, client, **kwargs):
+        small = Table([["a", 1]], self.schema, "SMALL")
+        large = Table([["b" * 100, i] for i in range(100)], self.schema, "LARGE")
+        expected = Table([["a", None]], self.schema, "EXPECTED")
+        query = Query("ACTUAL", "SELECT * FROM s", [], {"s": "SMALL"})
+        return QueryLogicTest(client, expected, [small, large], query, **kwargs)
+
+    def test_クエリが短ければロードしない(self):
+        client = FakeClient()
+        qlt = self.query_logic_test(client, spill_dataset="p.d")
+        assert qlt.run() == (True, [])
+        assert client.load_jobs == []
+
+    def test_クエリが長ければ大きいテーブルだけロードする(self):
+        client = FakeClient()
+        qlt = self.query_logic_test(client, spill_dataset="p.d", max_query_length=5000)
+        spilled = qlt.spill()
+
+        assert [job.destination for job in client.load_jobs] == [
+            spilled[0].table_id()
+        ]
+        assert spilled[0].table_id().startswith("p.d.bqqtest_LARGE_")
+        assert client.load_jobs[0].rows[0] == {"name": "b" * 100, "value": 0}
+        sql = qlt.build()
+        assert len(sql) <= 5000
+        assert f"LARGE AS (\nSELECT * FROM `{spilled[0].table_id()}`\n)" in sql
+        assert "SMALL AS (\nSELECT * FROM UNNEST" in sql
+
+    def test_ロードしたテーブルの走査量は許容して最後に削除する(self):
+        client = FakeClient(
+            lambda query, job_config: ([], client.load_jobs[0].output_bytes)
+        )
+        qlt = self.query_logic_test(client, spill_dataset="p.d", max_query_length=5000)
+        assert qlt.run() == (True, [])
+        assert client.deleted_tables == [client.load_jobs[0].destination]
+        assert "LARGE AS (\nSELECT * FROM UNNEST" in qlt.build()
+
+    def test_ロードしていないテーブルの走査はAssertionError(self):
+        client = FakeClient(lambda query, job_config: ([], 1))
+        small = Table([["a", 1]], self.schema, "SMALL")
+        large = Table([["b" * 100, i] for i in range(100)], self.schema, "LARGE")
+        expected = Table([["a", None]], self.schema, "EXPECTED")
+        query = Query(
+            "ACTUAL", "SELECT * FROM s JOIN `p.d.real` USING (name)", [], {"s": "SMALL"}
+        )
+        qlt = QueryLogicTest(
+            client,
+            expected,
+            [small, large],
+            query,
+            spill_dataset="p.d",
+            max_query_length=5000,
+        )
+        with pytest.raises(AssertionError):
+            qlt.run()
+        assert len(client.deleted_tables) == 1
+
+    @pytest.mark.parametrize("use_arun", [False, True], ids=["run", "arun"])
+    def test_ロードが失敗してもロード済みのテーブルを削除する(self, use_arun):
+        import asyncio
+
+        def fail():
+            raise RuntimeError("load failed")
+
+        class FailingClient(FakeClient):
+            def load_table_from_json(self, json_rows, destination, job_config=None):
+                job = super().load_table_from_json(json_rows, destination, job_config)
+                if len(self.load_jobs) == 2:
+                    job.result = fail
+                return job
+
+        client = FailingClient()
+        small = Table([["a", 1]], self.schema, "SMALL")
+        large = Table([["b" * 100, i] for i in range(100)], self.schema, "LARGE")
+        other = Table([["c" * 90, i] for i in range(100)], self.schema, "OTHER")
+        expected = Table([["a", None]], self.schema, "EXPECTED")
+        query = Query("ACTUAL", "SELECT * FROM s", [], {"s": "SMALL"})
+        qlt = QueryLogicTest(
+            client,
+            expected,
+            [small, large, other],
+            query,
+            spill_dataset="p.d",
+            max_query_length=5000,
+        )
+        with pytest.raises(RuntimeError, match="load failed"):
+            if use_arun:
+                asyncio.run(qlt.arun())
+            else:
+                qlt.run()
+        assert client.deleted_tables == [job.destination for job in client.load_jobs]
+        assert len(client.deleted_tables) == 2
+        assert client.jobs == []
+
+    def test_ロードするレコードはJSONにできる値にする(self):
+        import datetime
+        import decimal
+        import json
+
+        schema = [
+            {"name": "d", "type": "DATE", "mode": "NULLABLE"},
+            {"name": "ts", "type": "TIMESTAMP", "mode": "NULLABLE"},
+            {"name": "n", "type": "NUMERIC", "mode": "NULLABLE"},
+            {"name": "b", "type": "BYTES", "mode": "NULLABLE"},
+            {"name": "f", "type": "FLOAT64", "mode": "NULLABLE"},
+            {"name": "s", "type": "STRUCT<x DATE, y ARRAY<BYTES>>", "mode": "NULLABLE"},
+        ]
+        datum = [
+            [
+                datetime.date(2020, 1, 2),
+                datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc),
+                decimal.Decimal("1.10"),
+                b"\x00\xff",
+                float("inf"),
+                {"x": datetime.date(2020, 1, 2), "y": [b"a", None]},
+            ],
+            [None] * 6,
+        ]
+        want = [
+            {
+                "d": "2020-01-02",
+                "ts": "2020-01-02 03:04:05+00:00",
+                "n": "1.10",
+                "b": "AP8=",
+                "f": "Infinity",
+                "s": {"x": "2020-01-02", "y": ["YQ==", None]},
+            },
+            dict.fromkeys(["d", "ts", "n", "b", "f", "s"]),
+        ]
+        for backend in ("pandas", "columns"):
+            records = Table(datum, schema, backend=backend).records()
+            assert records == want
+            json.dumps(records, allow_nan=False)
+
+    def test_ロードできない型のテーブルは埋め込んだまま(self):
+        schema = [{"name": "s", "type": "STRUCT<INT64>", "mode": "NULLABLE"}]
+        assert Table([[1]], schema).schema_fields() is None
+        schema = [{"name": "a", "type": "ARRAY<STRING>", "mode": "REPEATED"}]
+        field = Table([[["x"]]], schema).schema_fields()[0]
+        assert (field.field_type, field.mode) == ("STRING", "REPEATED")
+
+
 class TestQueryTest:
     @pytest.mark.skipif(is_githubactions(), reason="GitHub Actions")
     def test_辞書データからクエリのテストが実行できる差分なし(self):
@@ -486,7 +998,6 @@ class TestQueryTest:
     def test_WITH(self):
         from google.cloud import bigquery
 
-        random.seed(a=0)
         client = bigquery.Client()
         tables = {
             "fuga": {
@@ -508,20 +1019,437 @@ class TestQueryTest:
 
         qt = QueryTest(client, expected, tables, query)
         assert (
-            """WITH RNvnAvOpyEVAoNGn AS (
-SELECT * FROM UNNEST(ARRAY
-[("ddd")]
+            """WITH fixture_fuga_4327396b67aa21e3 AS (
+SELECT * FROM UNNEST(ARRAY<STRUCT<name STRING>>
+[STRUCT("ddd")]
 )
 ),INPUT AS (
 SELECT * FROM UNNEST(ARRAY<STRUCT<name STRING, value INT64>>[("aaa", 100),("bbb", 200)])
 ),EXPECTED AS (
-SELECT * FROM UNNEST(ARRAY
-[(1)]
+SELECT * FROM UNNEST(ARRAY<STRUCT<word_count INT64>>
+[STRUCT(1)]
 )
-),ACTUAL AS ( SELECT * FROM INPUT UNION ALL SELECT * FROM RNvnAvOpyEVAoNGn),diff AS (
+),ACTUAL AS ( SELECT * FROM INPUT UNION ALL SELECT * FROM fixture_fuga_4327396b67aa21e3),diff AS (
 SELECT "+" AS mark , * FROM (SELECT *, ROW_NUMBER() OVER() AS n FROM ACTUAL EXCEPT DISTINCT SELECT *, ROW_NUMBER() OVER() AS n FROM EXPECTED) UNION ALL
 SELECT "-" AS mark , * FROM (SELECT *, ROW_NUMBER() OVER() AS n FROM EXPECTED EXCEPT DISTINCT SELECT *, ROW_NUMBER() OVER() AS n FROM ACTUAL) ORDER BY n ASC
 ) SELECT * FROM diff"""
             == qt.build()
         )
 
+
+
+class TestCompiledQueryTest:
+    schema = [
+        {"name": "name", "type": "STRING", "mode": "NULLABLE"},
+        {"name": "value", "type": "INT64", "mode": "NULLABLE"},
+    ]
+    query = {
+        "query": "WITH a AS (SELECT * FROM t) SELECT * FROM a WHERE value > @v",
+        "params": [],
+    }
+
+    def case(self, compiled, value, params=None):
+        tables = {"t": {"schema": self.schema, "datum": [["abc", value]]}}
+        expected = {"schema": self.schema, "datum": [["abc", value]]}
+        return compiled.case(expected, tables, params)
+
+    def test_QueryTestと同じクエリを生成する(self):
+        compiled = CompiledQueryTest(FakeClient(), self.query)
+        got = self.case(compiled, 1).build()
+
+        tables = {"t": {"schema": self.schema, "datum": [["abc", 1]]}}
+        expected = {"schema": self.schema, "datum": [["abc", 1]]}
+        assert got == QueryTest(FakeClient(), expected, tables, self.query).build()
+
+    def test_スキーマは一度だけ検証して使い回す(self):
+        compiled = CompiledQueryTest(FakeClient(), self.query)
+        qlt1 = compiled.query_logic_test(
+            {"schema": self.schema, "datum": []},
+            {"t": {"schema": list(self.schema), "datum": []}},
+        )
+        qlt2 = compiled.query_logic_test(
+            {"schema": self.schema, "datum": []},
+            {"t": {"schema": self.schema, "datum": []}},
+        )
+        assert qlt1.tables()[0].schema() is qlt2.tables()[0].schema()
+        assert qlt1.tables()[-1].schema() is qlt1.tables()[0].schema()
+
+    def test_テストごとにクエリパラメータを変えられる(self):
+        compiled = CompiledQueryTest(FakeClient(), self.query)
+        from google.cloud import bigquery
+
+        params = [bigquery.ScalarQueryParameter("v", "INT64", 0)]
+        assert compiled.query_logic_test(
+            {"schema": self.schema, "datum": []}, {}
+        ).query().query_parameters() == []
+        assert (
+            compiled.query_logic_test(
+                {"schema": self.schema, "datum": []}, {}, params
+            ).query().query_parameters()
+            == params
+        )
+
+    def test_テストごとに実行できる(self):
+        client = FakeClient()
+        compiled = CompiledQueryTest(client, self.query)
+        for value in range(3):
+            assert self.case(compiled, value).run(single_job=True) == (True, [])
+        assert len(client.jobs) == 3
+
+    def test_参照されないテストデータとCTEは送らない(self):
+        query = {
+            "query": """WITH a AS (SELECT * FROM t), dead AS (SELECT * FROM unused),
+`b-c` AS (SELECT * FROM a) SELECT * FROM `b-c`""",
+            "params": [],
+        }
+        tables = {
+            "t": {"schema": self.schema, "datum": [["abc", 1]]},
+            "unused": {"schema": self.schema, "datum": [["zzz", 2]]},
+        }
+        expected = {"schema": self.schema, "datum": [["abc", 1]]}
+        qt = QueryTest(FakeClient(), expected, tables, query)
+
+        assert qt.graph().to_dict() == {
+            "t": [],
+            "a": ["t"],
+            "b-c": ["a"],
+            "ACTUAL": ["b-c"],
+        }
+        sql = qt.build()
+        assert "zzz" not in sql and "dead" not in sql
+        assert "`b-c` AS (\nSELECT * FROM a\n)" in sql
+
+        qt = QueryTest(FakeClient(), expected, tables, query, prune=False)
+        assert qt.graph().unreachable() == ["unused", "dead"]
+        assert "zzz" in qt.build()
+
+    def test_CTEの名前は大文字と小文字を区別しない(self):
+        query = {
+            "query": "WITH Base AS (SELECT * FROM test.t1) SELECT * FROM base",
+            "params": [],
+        }
+        tables = {"test.t1": {"schema": self.schema, "datum": [["abc", 1]]}}
+        expected = {"schema": self.schema, "datum": [["abc", 1]]}
+        qt = QueryTest(FakeClient(), expected, tables, query)
+
+        assert qt.graph().to_dict() == {
+            "test.t1": [],
+            "Base": ["test.t1"],
+            "ACTUAL": ["Base"],
+        }
+        assert "Base AS (" in qt.build()
+
+        # テストデータへの差し替えと、テストするCTEの指定も同じ
+        stub = {"BASE": {"schema": self.schema, "datum": [["abc", 1]]}}
+        qlt = QueryTest(FakeClient(), expected, stub, query).query_logic_test()
+        assert qlt.graph().to_dict() == {"BASE": [], "ACTUAL": ["BASE"]}
+        qt = QueryTest(FakeClient(), expected, tables, query, target="BASE")
+        assert qt.graph().to_dict() == {"test.t1": [], "ACTUAL": ["test.t1"]}
+
+    def test_同じ内容のテストデータは一度だけ読み込んで共有する(self):
+        registry = FixtureRegistry()
+        compiled = CompiledQueryTest(FakeClient(), self.query, registry=registry)
+        qlt1 = self.case(compiled, 1).query_logic_test()
+        qlt2 = self.case(compiled, 1).query_logic_test()
+        self.case(compiled, 2)
+
+        fixture1, fixture2 = qlt1.tables()[0], qlt2.tables()[0]
+        assert fixture1.name() == fixture2.name()
+        assert fixture1.name().startswith("fixture_t_")
+        assert fixture1.rows_sql() is fixture2.rows_sql()
+        # t と EXPECTED は同じ内容なので、値ごとに1つずつ
+        assert registry.stats()["entries"] == 2
+        assert qlt1.build() == qlt2.build()
+
+    def test_同じ内容でもテーブル名が違えば別のテーブルになる(self):
+        query = {"query": "SELECT * FROM t UNION ALL SELECT * FROM u", "params": []}
+        fixture = {"schema": self.schema, "datum": [["abc", 1]]}
+        expected = {"schema": self.schema, "datum": [["abc", 1], ["abc", 1]]}
+        qt = QueryTest(
+            FakeClient(),
+            expected,
+            {"t": fixture, "u": dict(fixture)},
+            query,
+            registry=FixtureRegistry(),
+        )
+        t, u = qt.query_logic_test().tables(include_expected=False)
+        assert t.name() != u.name()
+        assert t.rows_sql() is u.rows_sql()
+        assert qt.run(single_job=True) == (True, [])
+
+    def test_CTEの中のテストデータの参照も書き換える(self):
+        compiled = CompiledQueryTest(FakeClient(), self.query)
+        qlt = compiled.query_logic_test(
+            {"schema": self.schema, "datum": []},
+            {"t": {"schema": self.schema, "datum": []}},
+        )
+        fixture, cte = qlt.tables(include_expected=False)
+        assert cte.query() == f"SELECT * FROM {fixture.name()}"
+
+
+class TestSnapshot:
+    """``build()`` の結果を testdata/snapshots のファイルと比べる
+
+    テストデータのテーブル名は実行ごとに変わらないので、生成するクエリをそのまま比べられる。
+    BQQTEST_UPDATE_SNAPSHOTS=1 で実行するとファイルを書き直す
+    """
+
+    schema = [
+        {"name": "name", "type": "STRING", "mode": "NULLABLE"},
+        {"name": "category", "type": "STRING", "mode": "NULLABLE"},
+        {"name": "value", "type": "INT64", "mode": "NULLABLE"},
+    ]
+
+    def assert_snapshot(self, name: str, sql: str):
+        path = Path(__file__).parent / "testdata" / "snapshots" / f"{name}.sql"
+        if os.environ.get("BQQTEST_UPDATE_SNAPSHOTS"):
+            path.parent.mkdir(exist_ok=True)
+            path.write_text(sql, encoding="utf-8")
+        assert sql == path.read_text(encoding="utf-8")
+
+    def test_レコードのテストデータ(self):
+        query = {
+            "query": """WITH total AS (
+SELECT category, SUM(value) AS value FROM `project.dataset.items` GROUP BY category
+)
+SELECT * FROM total WHERE value > @threshold""",
+            "params": [],
+        }
+        tables = {
+            "project.dataset.items": {
+                "schema": self.schema,
+                "datum": [["a", "x", 1], ["b", "x", 2], ["c", None, 3]],
+            }
+        }
+        expected = {"schema": self.schema[1:], "datum": [["x", 3]]}
+        qt = QueryTest(
+            FakeClient(), expected, tables, query, registry=FixtureRegistry()
+        )
+        self.assert_snapshot("records", qt.build())
+
+    def test_ファイルのテストデータとCTEの差し替え(self):
+        p = Path(__file__).parent / "testdata/test2.json"
+        query = {
+            "query": """WITH a AS (SELECT * FROM src), b AS (SELECT name FROM a)
+SELECT * FROM b""",
+            "params": [],
+        }
+        tables = {
+            "src": {"schema": self.schema, "datum": []},
+            "a": {"schema": self.schema, "datum": str(p)},
+        }
+        expected = {"schema": self.schema[:1], "datum": [["abc"]]}
+        qt = QueryTest(
+            FakeClient(), expected, tables, query, registry=FixtureRegistry()
+        )
+        self.assert_snapshot("file_and_cte", qt.build())
+
+    def test_実行ごとに同じクエリになる(self):
+        tables = {"t": {"schema": self.schema, "datum": [["a", "x", 1]]}}
+        expected = {"schema": self.schema, "datum": [["a", "x", 1]]}
+        query = {"query": "SELECT * FROM t", "params": []}
+        built = [
+            QueryTest(
+                FakeClient(), expected, tables, query, registry=FixtureRegistry()
+            ).build()
+            for _ in range(2)
+        ]
+        assert built[0] == built[1]
+
+
+class TestQueryCache:
+    schema = [{"name": "value", "type": "INT64", "mode": "NULLABLE"}]
+    query = {"query": "SELECT * FROM t", "params": []}
+
+    def query_test(self, client, rows: int = 1, **kwargs):
+        tables = {"t": {"schema": self.schema, "datum": [[1]] * rows}}
+        expected = {"schema": self.schema, "datum": [[1]] * rows}
+        return QueryTest(client, expected, tables, self.query, **kwargs)
+
+    def test_既定ではクエリキャッシュを使わない(self):
+        client = FakeClient()
+        self.query_test(client).run()
+        assert [job.job_config.use_query_cache for job in client.jobs] == [
+            False,
+            False,
+        ]
+
+    def test_2回目からはキャッシュから返す(self):
+        client = FakeClient(latency=0.2)
+        self.query_test(client, query_cache=True).run(single_job=True)
+        qt = self.query_test(client, query_cache=True)
+        assert qt.run(single_job=True) == (True, [])
+
+        assert [job.cache_hit for job in client.jobs] == [False, True]
+        assert qt.metrics().jobs[0]["cache_hit"] is True
+        assert qt.metrics().phases["wait"] < 0.2
+
+    def test_ロードしたテーブルがあればクエリキャッシュを使わない(self):
+        client = FakeClient(lambda query, job_config: ([], 10 ** 6))
+        qlt = self.query_test(
+            client,
+            rows=200,
+            query_cache=True,
+            spill_dataset="p.d",
+            max_query_length=2000,
+        ).query_logic_test()
+        assert qlt.uses_query_cache()
+        qlt.spill()
+        assert not qlt.uses_query_cache()
+
+
+class TestCTETarget:
+    schema = [{"name": "value", "type": "INT64", "mode": "NULLABLE"}]
+    query = {
+        "query": """WITH a AS (SELECT value FROM src),
+b AS (SELECT value * 2 AS value FROM a),
+c AS (SELECT value + 1 AS value FROM b)
+SELECT * FROM c""",
+        "params": [],
+    }
+
+    def test_指定したCTEの結果をテストする(self):
+        compiled = CompiledQueryTest(FakeClient(), self.query)
+        qlt = compiled.query_logic_test(
+            {"schema": self.schema, "datum": [[2]]},
+            {"src": {"schema": self.schema, "datum": [[1]]}},
+            target="b",
+        )
+        assert qlt.graph().nodes() == ["src", "a", "ACTUAL"]
+        assert qlt.query().to_sql() == "ACTUAL AS (SELECT value * 2 AS value FROM a)"
+        assert "value + 1" not in qlt.build()
+
+    def test_上流のCTEはテストデータに差し替えられる(self):
+        compiled = CompiledQueryTest(FakeClient(), self.query)
+        qlt = compiled.query_logic_test(
+            {"schema": self.schema, "datum": [[2]]},
+            {
+                "src": {"schema": self.schema, "datum": [[100]]},
+                "b": {"schema": self.schema, "datum": [[1]]},
+            },
+            target="c",
+        )
+        stub = qlt.tables(include_expected=False)
+        assert len(stub) == 1 and stub[0].records() == [{"value": 1}]
+        assert (
+            qlt.query().to_sql()
+            == f"ACTUAL AS (SELECT value + 1 AS value FROM {stub[0].name()})"
+        )
+        assert qlt.graph().to_dict() == {"b": [], "ACTUAL": ["b"]}
+
+    def test_QueryTestでもCTEを指定できる(self):
+        client = FakeClient()
+        qt = QueryTest(
+            client,
+            {"schema": self.schema, "datum": [[2]]},
+            {"a": {"schema": self.schema, "datum": [[1]]}},
+            self.query,
+            target="b",
+        )
+        assert qt.run(single_job=True) == (True, [])
+        assert "src" not in client.jobs[0].query
+
+    def test_ないCTEを指定するとAssertionError(self):
+        compiled = CompiledQueryTest(FakeClient(), self.query)
+        with pytest.raises(AssertionError):
+            compiled.case({"schema": self.schema, "datum": []}, {}, target="x")
+        with pytest.raises(AssertionError):
+            compiled.case(
+                {"schema": self.schema, "datum": []},
+                {"b": {"schema": self.schema, "datum": []}},
+                target="b",
+            )
+
+
+class TestAsync:
+    def test_arunはrunと同じ結果を返す(self):
+        import asyncio
+
+        client = FakeClient(lambda query, job_config: ([("+", "x")], 0))
+        success, diff = asyncio.run(
+            fake_query_logic_test(client).arun(single_job=True, poll_interval=0.001)
+        )
+        assert not success and diff == [("+", "x")]
+        assert len(client.jobs) == 1
+
+    def test_セーフティネットも待つ(self):
+        import asyncio
+
+        client = FakeClient(lambda query, job_config: ([], 100))
+        with pytest.raises(AssertionError):
+            asyncio.run(fake_query_logic_test(client).arun(poll_interval=0.001))
+        assert len(client.jobs) == 1
+        assert asyncio.run(
+            fake_query_logic_test(FakeClient()).ais_total_bytes_processed_zero(
+                dry_run=True
+            )
+        )
+
+    def test_ジョブを待つ間もイベントループを止めない(self):
+        import asyncio
+        import time
+
+        client = FakeClient(latency=0.2)
+        tests = [fake_query_logic_test(client) for _ in range(20)]
+
+        async def main():
+            return await asyncio.gather(
+                *[t.arun(single_job=True, poll_interval=0.01) for t in tests]
+            )
+
+        started = time.perf_counter()
+        results = asyncio.run(main())
+        assert time.perf_counter() - started < 1.0
+        assert all(success for success, _ in results)
+        assert client.max_running_jobs == 20
+        assert all(
+            job.result_called == 1 and job.done_called > 1 for job in client.jobs
+        )
+
+    def test_タイムアウトしたらジョブをキャンセルする(self):
+        import asyncio
+
+        client = FakeClient(latency=10)
+        with pytest.raises(asyncio.TimeoutError):
+            asyncio.run(
+                fake_query_logic_test(client).arun(
+                    single_job=True, timeout=0.05, poll_interval=0.01
+                )
+            )
+        assert client.jobs[0].cancelled
+        assert client.running_jobs == 0
+
+    def test_ジョブの状態を確認する間隔を延ばす(self):
+        import asyncio
+
+        client = FakeClient(latency=0.3)
+        qlt = fake_query_logic_test(client)
+        qlt.max_poll_interval = 0.1
+        assert asyncio.run(qlt.arun(single_job=True, poll_interval=0.01)) == (True, [])
+        # 0.01, 0.02, 0.04, 0.08 秒のあとは 0.1 秒ごとに確認する
+        assert 5 <= client.jobs[0].done_called <= 8
+
+    def test_非同期のクライアントのジョブも待つ(self):
+        import asyncio
+
+        from .fake import FakeAsyncClient
+
+        client = FakeAsyncClient(latency=0.05)
+        assert asyncio.run(
+            fake_query_logic_test(client).arun(poll_interval=0.01)
+        ) == (True, [])
+        # done() のコルーチンを待って完了を確認している
+        assert len(client.jobs) == 2
+        assert client.jobs[1].done_called > 1 and client.jobs[1].result_called == 1
+
+    def test_QueryTestからも呼べる(self):
+        import asyncio
+
+        schema = [{"name": "value", "type": "INT64", "mode": "NULLABLE"}]
+        qt = QueryTest(
+            FakeClient(),
+            {"schema": schema, "datum": [[1]]},
+            {"t": {"schema": schema, "datum": [[1]]}},
+            {"query": "SELECT * FROM t", "params": []},
+        )
+        assert asyncio.run(qt.arun(dry_run=True)) == (True, [])
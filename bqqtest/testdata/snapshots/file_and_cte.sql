@@ -0,0 +1,15 @@
+WITH fixture_a_6a3f52857043eac4 AS (
+SELECT * FROM UNNEST(ARRAY<STRUCT<name STRING, category STRING, value INT64>>
+[("abc","bcd",300),("ddd","ccc",400),("\"xxx\"","yyy",123),("\"xxx\"","[\"y\",\"y\",\"y\"]",123)]
+)
+),b AS (
+SELECT name FROM fixture_a_6a3f52857043eac4
+),EXPECTED AS (
+SELECT * FROM UNNEST(ARRAY<STRUCT<name STRING>>
+[STRUCT("abc")]
+)
+),ACTUAL AS (
+SELECT * FROM b),diff AS (
+SELECT "+" AS mark , * FROM (SELECT *, ROW_NUMBER() OVER() AS n FROM ACTUAL EXCEPT DISTINCT SELECT *, ROW_NUMBER() OVER() AS n FROM EXPECTED) UNION ALL
+SELECT "-" AS mark , * FROM (SELECT *, ROW_NUMBER() OVER() AS n FROM EXPECTED EXCEPT DISTINCT SELECT *, ROW_NUMBER() OVER() AS n FROM ACTUAL) ORDER BY n ASC
+) SELECT * FROM diff
\ No newline at end of file
@@ -0,0 +1,15 @@
+WITH fixture_project_dataset_items_b74170cd2b34a279 AS (
+SELECT * FROM UNNEST(ARRAY<STRUCT<name STRING, category STRING, value INT64>>
+[("a","x",1),("b","x",2),("c",null,3)]
+)
+),total AS (
+SELECT category, SUM(value) AS value FROM fixture_project_dataset_items_b74170cd2b34a279 GROUP BY category
+),EXPECTED AS (
+SELECT * FROM UNNEST(ARRAY<STRUCT<category STRING, value INT64>>
+[("x",3)]
+)
+),ACTUAL AS (
+SELECT * FROM total WHERE value > @threshold),diff AS (
+SELECT "+" AS mark , * FROM (SELECT *, ROW_NUMBER() OVER() AS n FROM ACTUAL EXCEPT DISTINCT SELECT *, ROW_NUMBER() OVER() AS n FROM EXPECTED) UNION ALL
+SELECT "-" AS mark , * FROM (SELECT *, ROW_NUMBER() OVER() AS n FROM EXPECTED EXCEPT DISTINCT SELECT *, ROW_NUMBER() OVER() AS n FROM ACTUAL) ORDER BY n ASC
+) SELECT * FROM diff
\ No newline at end of file
@@ -0,0 +1,151 @@
+"""BigQueryの型の文法
+
+``STRUCT<a INT64, b ARRAY<STRING>>`` のような型の文字列を構文木にする。
+同じ型の文字列は何度も現れるので、構文木は型の文字列ごとにキャッシュする
+"""
+import functools
+import re
+from collections import namedtuple
+
+PRIMITIVE_TYPES = (
+    "INT64",
+    "NUMERIC",
+    "FLOAT64",
+    "BOOL",
+    "STRING",
+    "BYTES",
+    "DATE",
+    "DATETIME",
+    "GEOGRAPHY",
+    "TIME",
+    "TIMESTAMP",
+)
+
+
+class PrimitiveType(namedtuple("PrimitiveType", ["name"])):
+    __slots__ = ()
+
+    def __str__(self):
+        return self.name
+
+
+class ArrayType(namedtuple("ArrayType", ["element"])):
+    __slots__ = ()
+
+    def __str__(self):
+        return f"ARRAY<{self.element}>"
+
+
+class StructType(namedtuple("StructType", ["fields"])):
+    """fields は ``(フィールド名, 型)`` のタプル。名前のないフィールドのフィールド名はNone"""
+
+    __slots__ = ()
+
+    def __str__(self):
+        fields = ", ".join(
+            str(typ) if name is None else f"{name} {typ}" for name, typ in self.fields
+        )
+        return f"STRUCT<{fields}>"
+
+
+_token = re.compile(r"\s*(?:([<>,])|([A-Za-z_]\w*|`[^`]+`))")
+
+
+def _tokenize(t: str):
+    tokens = []
+    position = 0
+    while position < len(t):
+        m = _token.match(t, position)
+        if m is None:
+            if t[position:].strip() == "":
+                break
+            raise ValueError(f"{t} の {position} 文字目を解釈できません")
+        tokens.append(m.group(1) or m.group(2))
+        position = m.end()
+    return tokens
+
+
+class _Parser:
+    def __init__(self, t: str):
+        self._text = t
+        self._tokens = _tokenize(t)
+        self._position = 0
+
+    def _peek(self, offset: int = 0):
+        i = self._position + offset
+        return self._tokens[i] if i < len(self._tokens) else None
+
+    def _next(self):
+        token = self._peek()
+        if token is None:
+            raise ValueError(f"{self._text} は途中で終わっています")
+        self._position += 1
+        return token
+
+    def _expect(self, expected: str):
+        token = self._next()
+        if token != expected:
+            raise ValueError(f"{self._text} で {expected} の位置に {token} があります")
+
+    def parse(self):
+        parsed = self._type()
+        if self._peek() is not None:
+            raise ValueError(f"{self._text} の末尾に余分な {self._peek()} があります")
+        return parsed
+
+    def _type(self):
+        token = self._next()
+        if token == "ARRAY":
+            self._expect("<")
+            element = self._type()
+            if isinstance(element, ArrayType):
+                raise ValueError(f"{self._text}: ARRAYの直下にARRAYは入れられません")
+            self._expect(">")
+            return ArrayType(element)
+        if token == "STRUCT":
+            self._expect("<")
+            fields = [self._field()]
+            while self._peek() == ",":
+                self._next()
+                fields.append(self._field())
+            self._expect(">")
+            return StructType(tuple(fields))
+        if token in PRIMITIVE_TYPES:
+            return PrimitiveType(token)
+        raise ValueError(f"{self._text}: {token} は使えない型です")
+
+    def _field(self):
+        # 識別子が2つ続くときは、1つ目をフィールド名とみなす
+        following = self._peek(1)
+        if following is not None and following not in ("<", ">", ","):
+            name = self._next()
+            if name.startswith("`"):
+                name = name[1:-1]
+            return (name, self._type())
+        return (None, self._type())
+
+
+@functools.lru_cache(maxsize=None)
+def parse_type(t: str):
+    """型の文字列を構文木にする
+
+    Args:
+        t (str): ``INT64`` や ``ARRAY<STRUCT<a INT64, b STRING>>`` のような型
+
+    Returns:
+        ``PrimitiveType`` 、 ``ArrayType`` 、 ``StructType`` のいずれか。
+        ``str()`` で正規化した型の文字列に戻る
+
+    Raises:
+        ValueError: 文法に合わないか、BigQueryで使えない型
+    """
+    return _Parser(t).parse()
+
+
+def is_valid_type(t: str):
+    """BigQueryで使える型かどうか"""
+    try:
+        parse_type(t)
+    except ValueError:
+        return False
+    return True
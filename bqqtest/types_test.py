@@ -0,0 +1,70 @@
+import pytest
+
+from .types import ArrayType, PrimitiveType, StructType, is_valid_type, parse_type
+
+parse_params = {
+    "プリミティブ型": ("INT64", PrimitiveType("INT64")),
+    "ARRAY": ("ARRAY<STRING>", ArrayType(PrimitiveType("STRING"))),
+    "名前のあるフィールドのSTRUCT": (
+        "STRUCT<a INT64, b ARRAY<STRING>>",
+        StructType(
+            (("a", PrimitiveType("INT64")), ("b", ArrayType(PrimitiveType("STRING"))))
+        ),
+    ),
+    "名前のないフィールドのSTRUCT": (
+        "STRUCT<INT64, STRUCT<x DATE>>",
+        StructType(
+            (
+                (None, PrimitiveType("INT64")),
+                (None, StructType((("x", PrimitiveType("DATE")),))),
+            )
+        ),
+    ),
+    "STRUCTのARRAYの中のARRAY": (
+        "ARRAY<STRUCT<ARRAY<INT64>>>",
+        ArrayType(StructType(((None, ArrayType(PrimitiveType("INT64"))),))),
+    ),
+    "空白と改行": (
+        " STRUCT < `a b` INT64 ,\n c BOOL > ",
+        StructType((("a b", PrimitiveType("INT64")), ("c", PrimitiveType("BOOL")))),
+    ),
+}
+
+
+@pytest.mark.parametrize(
+    "t, want", list(parse_params.values()), ids=list(parse_params.keys())
+)
+def test_型を構文木にする(t, want):
+    assert parse_type(t) == want
+
+
+def test_構文木は正規化した型の文字列に戻る():
+    assert str(parse_type("STRUCT<a INT64,b  ARRAY<STRING>>")) == (
+        "STRUCT<a INT64, b ARRAY<STRING>>"
+    )
+
+
+def test_同じ型の文字列の構文木はキャッシュする():
+    assert parse_type("ARRAY<DATE>") is parse_type("ARRAY<DATE>")
+
+
+invalid_params = {
+    "ARRAYの直下のARRAY": "ARRAY<ARRAY<STRING>>",
+    "カッコのないARRAY": "ARRAY",
+    "閉じていないARRAY": "ARRAY<INT64",
+    "空のSTRUCT": "STRUCT<>",
+    "末尾のカンマ": "STRUCT<a INT64,>",
+    "余分な閉じカッコ": "ARRAY<INT64>>",
+    "使えない型": "INTEGER",
+    "使えない記号": "STRING(10)",
+    "空文字列": "",
+}
+
+
+@pytest.mark.parametrize(
+    "t", list(invalid_params.values()), ids=list(invalid_params.keys())
+)
+def test_使えない型はValueError(t):
+    with pytest.raises(ValueError):
+        parse_type(t)
+    assert not is_valid_type(t)
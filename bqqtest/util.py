@@ -1,22 +1,291 @@
-import regex
+import bisect
+import re
+from collections import namedtuple
 
+Token = namedtuple("Token", ["kind", "text", "start", "end"])
 
-f = regex.compile(
-    r"(?<name>\w+)\s+AS\s+(?<query>\((?:[^\(\)]+|(?&query))*\))",
-    flags=regex.MULTILINE | regex.IGNORECASE,
+# コメント、文字列リテラルとバッククォートで囲んだ識別子。
+# ``tokenize`` と ``scan_literals`` はこの定義を共有して、同じ位置で区切る
+_comment = r"--[^\n]*|\#[^\n]*|/\*.*?(?:\*/|\Z)"
+_string = r"""
+    '''(?:\\.|[^\\])*?(?:'''|\Z)|\"\"\"(?:\\.|[^\\])*?(?:\"\"\"|\Z)
+    |'(?:\\.|[^'\\\n])*(?:'|$)|"(?:\\.|[^"\\\n])*(?:"|$)
+"""
+_quoted = r"`(?:\\.|[^`\\])*(?:`|\Z)"
+_string_prefix = r"(?<!\w)[rRbB]{1,2}"
+
+_token = re.compile(
+    rf"""
+    (?P<comment>{_comment})
+    |(?P<string>(?:{_string_prefix})?(?:{_string}))
+    |(?P<quoted>{_quoted})
+    |(?P<word>[A-Za-z_]\w*)
+    |(?P<number>\d+(?:\.\d*)?(?:[eE][+-]?\d+)?|\.\d+(?:[eE][+-]?\d+)?)
+    |(?P<space>\s+)
+    |(?P<symbol>.)
+    """,
+    flags=re.VERBOSE | re.DOTALL | re.MULTILINE,
+)
+# 先頭の文字を先読みで絞ると、reモジュールはその文字の位置だけで照合を試みるので速い。
+# 文字列リテラルのプレフィックスは、見つけた引用符から後ろ向きに探す
+_literal = re.compile(
+    rf"""
+    (?=[-\#/'"`])
+    (?:(?P<comment>{_comment})|(?P<string>{_string})|(?P<quoted>{_quoted}))
+    """,
+    flags=re.VERBOSE | re.DOTALL | re.MULTILINE,
 )
+_prefix = re.compile(rf"{_string_prefix}\Z")
+
+
+def tokenize(sql: str):
+    """BigQuery標準SQLを字句に分ける
+
+    文字列リテラル、バッククォートで囲んだ識別子、コメントを1つの字句として扱う。
+    正規表現の選択肢はどれもバックトラックが入れ子にならないので、クエリの長さに比例した時間で終わる
+
+    Args:
+        sql (str): クエリ
+
+    Returns:
+        list: ``Token(kind, text, start, end)`` のリスト。
+            kind は comment, string, quoted, word, number, space, symbol のいずれか
+    """
+    assert isinstance(sql, str)
+    return [
+        Token(m.lastgroup, m.group(), m.start(), m.end()) for m in _token.finditer(sql)
+    ]
+
+
+def scan_literals(sql: str):
+    """コメント、文字列リテラル、バッククォートで囲んだ識別子と、それ以外の部分に分ける
+
+    ``tokenize`` と同じ規則で区切るが、それ以外の部分は字句に分けないので、
+    テストデータを埋め込んだ長いクエリでも速い
+
+    Args:
+        sql (str): クエリ
+
+    Returns:
+        list: ``Token(kind, text, start, end)`` のリスト。
+            kind は comment, string, quoted と、それ以外の部分を表す code のいずれか
+    """
+    assert isinstance(sql, str)
+    tokens = []
+    position = 0
+    for m in _literal.finditer(sql):
+        start = m.start()
+        if m.lastgroup == "string" and start > position and sql[start - 1] in "rRbB":
+            prefix = _prefix.search(sql, max(position, start - 2), start)
+            if prefix is not None:
+                start = prefix.start()
+        if position < start:
+            tokens.append(Token("code", sql[position:start], position, start))
+        tokens.append(Token(m.lastgroup, sql[start : m.end()], start, m.end()))
+        position = m.end()
+    if position < len(sql):
+        tokens.append(Token("code", sql[position:], position, len(sql)))
+    return tokens
+
+
+_with = re.compile(r"\s*WITH\s+(?:RECURSIVE\s+)?", flags=re.IGNORECASE)
+_cte_head = re.compile(r"\s*(?:(\w+)|`([^`]*)`)\s+AS\s*\(", flags=re.IGNORECASE)
+_comma = re.compile(r"\s*,")
+
+
+def _without_comments(tokens: list):
+    """``scan_literals`` の字句からコメントを除き、位置を付け直す"""
+    stripped = []
+    position = 0
+    for token in tokens:
+        text = token.text
+        if token.kind == "comment":
+            if not text.startswith("/*"):
+                continue
+            # ブロックコメントは前後の字句がつながらないように空白に置き換える
+            text = " "
+        end = position + len(text)
+        stripped.append(Token(token.kind, text, position, end))
+        position = end
+    return stripped
+
+
+def strip_comments(sql: str):
+    """文字列リテラルの中を除いてコメントを取り除く"""
+    return "".join(token.text for token in _without_comments(scan_literals(sql)))
+
+
+def _top_level_closing_parens(tokens: list):
+    """括弧の外に出る閉じ括弧の位置を昇順に返す
+
+    文字列リテラル、バッククォートとコメントの中の括弧は数えない
+
+    Args:
+        tokens (list): ``scan_literals`` の字句
+    """
+    closing = []
+    depth = 0
+    for token in tokens:
+        if token.kind != "code":
+            continue
+        # 閉じ括弧で区切った各部分には開き括弧しかないので、深さは閉じ括弧でだけ減る
+        pieces = token.text.split(")")
+        position = token.start
+        for piece in pieces[:-1]:
+            depth += piece.count("(") - 1
+            position += len(piece)
+            if depth == 0:
+                closing.append(position)
+            position += 1
+        depth += pieces[-1].count("(")
+    return closing
+
+
+def split_with_clause(sql: str):
+    """先頭のWITH句を解析して、CTEと本体のクエリに分ける
+
+    コメントを取り除いてから、文字列リテラルとバッククォートの外の括弧の対応を数える。
+    バックトラックする正規表現を使わないので、クエリの長さに比例した時間で終わる
+
+    Args:
+        sql (str): クエリ
+
+    Returns:
+        tuple: ``(ctes, query)`` 。ctes は ``(name, query)`` のリストで、
+            どちらもコメントを取り除いている
+    """
+    tokens = _without_comments(scan_literals(sql))
+    sql = "".join(token.text for token in tokens)
+    m = _with.match(sql)
+    if m is None:
+        return [], sql
+
+    closing_parens = _top_level_closing_parens(tokens)
+    ctes = []
+    position = m.end()
+    while True:
+        head = _cte_head.match(sql, position)
+        if head is None:
+            break
+        i = bisect.bisect_left(closing_parens, head.end())
+        if i == len(closing_parens):
+            name = head.group(1) or head.group(2)
+            raise ValueError(f"{name} の括弧が閉じていません")
+        close = closing_parens[i]
+
+        ctes.append((head.group(1) or head.group(2), sql[head.end() : close].strip()))
+        position = close + 1
+        comma = _comma.match(sql, position)
+        if comma is None:
+            break
+        position = comma.end()
+
+    if not ctes:
+        return [], sql
+    return ctes, sql[position:]
 
 
 def get_query_from_with_clause(sql: str):
+    """先頭のWITH句にあるCTEの名前とクエリを返す
+
+    Args:
+        sql (str): クエリ
+
+    Returns:
+        list: ``(name, query)`` のリスト
+    """
     assert isinstance(sql, str)
-    sql = regex.sub(r"--.*$", "", sql, flags=regex.MULTILINE | regex.IGNORECASE)
-    sql = regex.sub(r"#.*$", "", sql, flags=regex.MULTILINE | regex.IGNORECASE)
-    sql = regex.sub(
-        r"/\*.*\*/", "", sql, flags=regex.MULTILINE | regex.IGNORECASE | regex.DOTALL
-    )
-    print(sql)
+    ctes, _ = split_with_clause(sql)
+    return ctes
+
+
+def quote_identifier(name: str):
+    """識別子として書けない名前をバッククォートで囲む"""
+    if re.fullmatch(r"[A-Za-z_]\w*", name):
+        return name
+    return f"`{name}`"
+
+
+# テーブル名になりうる識別子のパス。文字列リテラルとコメントの外だけで探す
+_reference = re.compile(
+    r"""
+    (?<![\w@$`.])
+    (?:[A-Za-z_]\w*(?:-\w+)+(?=\.(?:`|[A-Za-z_]))|`[^`]*`|[A-Za-z_]\w*)
+    (?:\.(?:`[^`]*`|\w+))*
+    """,
+    flags=re.VERBOSE,
+)
+_path_part = re.compile(r"`[^`]*`|[^.`]+")
+
+
+def split_table_name(name: str):
+    """テーブル名をバッククォートを外してドットで区切る
+
+    Examples:
+        >>> split_table_name("`project.dataset`.table")
+        ('project', 'dataset', 'table')
+    """
+    return tuple(c for c in name.replace("`", "").split(".") if c)
+
+
+class TableRewriter:
+    """クエリ中のテーブル名を一度の走査でまとめて書き換える
+
+    ``project.dataset.table`` のようなドット区切りの名前は、バッククォートの有無や位置に
+    かかわらず同じテーブルとして扱う。 ``table.column`` のように後ろに続きがあれば
+    テーブル名の部分だけを書き換える。文字列リテラルとコメントの中は書き換えない。
+    ドットを含まない名前はWITH句の名前なので、BigQueryと同じく大文字と小文字を区別しない
+
+    Args:
+        table_map (dict): 書き換え前のテーブル名から書き換え後の名前への辞書
+    """
+
+    _table_map = {}
+    _names = {}
+    _folded = {}
+
+    def __init__(self, table_map: dict):
+        self._table_map = {split_table_name(k): v for k, v in table_map.items()}
+        self._names = {split_table_name(k): k for k in table_map.keys()}
+        self._folded = {
+            key[0].lower(): key for key in self._table_map if len(key) == 1
+        }
+
+    def rewrite(self, sql: str):
+        """テーブル名を書き換える
+
+        Returns:
+            tuple: 書き換えたクエリと、参照されていたテーブル名の集合
+        """
+        referenced = set()
+        if not self._table_map:
+            return sql, referenced
+
+        def replace(m):
+            # パスを構成する部分ごとに、何個目の名前までを含むかを数える
+            path = m.group()
+            components = []
+            boundaries = []
+            for part in _path_part.finditer(path):
+                components += split_table_name(part.group())
+                boundaries.append((len(components), part.end()))
 
-    queries = regex.findall(f, sql)
+            # 長い名前を優先して、部分の区切りで一致するものを探す
+            for count, end in reversed(boundaries):
+                key = tuple(components[:count])
+                if count == 1 and key not in self._table_map:
+                    key = self._folded.get(key[0].lower(), key)
+                if key in self._table_map:
+                    referenced.add(self._names[key])
+                    return self._table_map[key] + path[end:]
+            return path
 
-    # ()が先頭と末尾に入ってくるので取り除く
-    return [(name, query[1:][:-1].strip()) for name, query in queries]
+        pieces = []
+        position = 0
+        for token in scan_literals(sql):
+            if token.kind in ("comment", "string"):
+                pieces.append(_reference.sub(replace, sql[position : token.start]))
+                pieces.append(token.text)
+                position = token.end
+        pieces.append(_reference.sub(replace, sql[position:]))
+        return "".join(pieces), referenced
@@ -1,6 +1,11 @@
 import pytest
 
-from .util import get_query_from_with_clause
+from .util import (
+    TableRewriter,
+    get_query_from_with_clause,
+    split_with_clause,
+    tokenize,
+)
 
 params = {
     "WITHがないときは何も返さない": ("SELECT * FROM test", []),
@@ -53,6 +58,22 @@ SELECT * FROM bbb""",
             ("bbb", "SELECT ARRAY_LENGTH(yyy.ccc) FROM yyy"),
         ],
     ),
+    "ブロックコメントが複数あってもその間のクエリは残す": (
+        """WITH aaa AS (/* a */ SELECT 1), /* b */ bbb AS (SELECT 2) SELECT * FROM bbb""",
+        [("aaa", "SELECT 1"), ("bbb", "SELECT 2")],
+    ),
+    "文字列リテラルとバッククォートの中の括弧は無視する": (
+        """WITH `a-b` AS (SELECT ")", '(' FROM `x(`) SELECT * FROM `a-b`""",
+        [("a-b", """SELECT ")", '(' FROM `x(`""")],
+    ),
+    "サブクエリの中のASは拾わない": (
+        "SELECT * FROM (SELECT x AS (y)) AS t",
+        [],
+    ),
+    "WITH RECURSIVEも解析できる": (
+        "WITH RECURSIVE aaa AS (SELECT 1 UNION ALL SELECT n FROM aaa) SELECT 1",
+        [("aaa", "SELECT 1 UNION ALL SELECT n FROM aaa")],
+    ),
 }
 
 
@@ -62,3 +83,113 @@ SELECT * FROM bbb""",
 def test_get_query_from_with_clause(sql, want):
     got = get_query_from_with_clause(sql)
     assert want == got
+
+
+def test_split_with_clauseはWITH句を除いたクエリを返す():
+    sql = """#standardsql
+WITH aaa AS (SELECT 1), bbb AS (SELECT 2) SELECT * FROM aaa, bbb # comment"""
+    ctes, query = split_with_clause(sql)
+    assert ctes == [("aaa", "SELECT 1"), ("bbb", "SELECT 2")]
+    assert query == " SELECT * FROM aaa, bbb "
+
+
+def test_split_with_clauseはWITHがなければコメントだけ取り除く():
+    assert split_with_clause("SELECT 1 -- x\n") == ([], "SELECT 1 \n")
+
+
+def test_split_with_clauseは文字列リテラルの中のコメント記号を残す():
+    sql = """WITH aaa AS (SELECT '--', "#", r'/*' -- x
+) SELECT * FROM aaa"""
+    ctes, query = split_with_clause(sql)
+    assert ctes == [("aaa", """SELECT '--', "#", r'/*'""")]
+    assert query == " SELECT * FROM aaa"
+
+
+def test_split_with_clauseは閉じていない括弧でValueError():
+    with pytest.raises(ValueError):
+        split_with_clause("WITH aaa AS (SELECT (1) SELECT 1")
+
+
+def test_tokenize():
+    sql = """SELECT 'a''b', r"\\\\", `x`.y -- c\n/* d */1.5"""
+    assert [(t.kind, t.text) for t in tokenize(sql) if t.kind != "space"] == [
+        ("word", "SELECT"),
+        ("string", "'a'"),
+        ("string", "'b'"),
+        ("symbol", ","),
+        ("string", 'r"\\\\"'),
+        ("symbol", ","),
+        ("quoted", "`x`"),
+        ("symbol", "."),
+        ("word", "y"),
+        ("comment", "-- c"),
+        ("comment", "/* d */"),
+        ("number", "1.5"),
+    ]
+    assert "".join(t.text for t in tokenize(sql)) == sql
+
+
+rewrite_params = {
+    "テーブル名を書き換える": (
+        "SELECT * FROM test.target_table",
+        "SELECT * FROM T1",
+        {"test.target_table"},
+    ),
+    "バッククォートで囲んだテーブル名も書き換える": (
+        "SELECT * FROM `test.target_table` JOIN `test`.`other` USING (id)",
+        "SELECT * FROM T1 JOIN T2 USING (id)",
+        {"test.target_table", "`test.other`"},
+    ),
+    "ドットは任意の文字にマッチしない": (
+        "SELECT * FROM testXtarget_table",
+        "SELECT * FROM testXtarget_table",
+        set(),
+    ),
+    "長い識別子の一部は書き換えない": (
+        "SELECT * FROM test.target_table_2, my_test.target_table",
+        "SELECT * FROM test.target_table_2, my_test.target_table",
+        set(),
+    ),
+    "プロジェクト名を含むテーブル名も書き換える": (
+        "SELECT * FROM my-project.dataset.table, `my-project.dataset.table`",
+        "SELECT * FROM T3, T3",
+        {"my-project.dataset.table"},
+    ),
+    "テーブル名で修飾した列名はテーブル名の部分だけ書き換える": (
+        "SELECT test.other.id FROM test.other",
+        "SELECT T2.id FROM T2",
+        {"`test.other`"},
+    ),
+    "ドットのない名前は大文字と小文字を区別しない": (
+        "SELECT Cte.id FROM CTE, TEST.TARGET_TABLE",
+        "SELECT T4.id FROM T4, TEST.TARGET_TABLE",
+        {"cte"},
+    ),
+    "プレフィックス付きの文字列リテラルの中は書き換えない": (
+        "SELECT r'test.other', b\"\"\"test.other\"\"\" FROM test.other",
+        "SELECT r'test.other', b\"\"\"test.other\"\"\" FROM T2",
+        {"`test.other`"},
+    ),
+    "文字列リテラルとコメントの中は書き換えない": (
+        "SELECT 'test.other', \"test.other\" -- test.other\nFROM test.other",
+        "SELECT 'test.other', \"test.other\" -- test.other\nFROM T2",
+        {"`test.other`"},
+    ),
+}
+
+
+@pytest.mark.parametrize(
+    ["sql", "want", "referenced"],
+    list(rewrite_params.values()),
+    ids=list(rewrite_params.keys()),
+)
+def test_TableRewriter(sql, want, referenced):
+    rewriter = TableRewriter(
+        {
+            "test.target_table": "T1",
+            "`test.other`": "T2",
+            "my-project.dataset.table": "T3",
+            "cte": "T4",
+        }
+    )
+    assert rewriter.rewrite(sql) == (want, referenced)